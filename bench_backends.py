@@ -0,0 +1,80 @@
+import argparse
+import glob
+import os
+import time
+from inference_backends import BACKENDS, create_backend
+
+# Throughput of each inference backend on its own, without the server or the
+# network: the same JPEG uploads go through predict_bytes() in batches, as
+# server_opt6.py's inference worker sends them. Run from the directory that
+# holds images/ (the model and the scratch paths are relative to it).
+#
+# The docker backends need the inference container to be running; under
+# fake_docker.py they measure the protocol overhead around the stub model.
+
+DEFAULT_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'eel', 'web', 'images')
+
+
+def load_uploads(directory, limit):
+    uploads = []
+    for file_path in sorted(glob.glob(os.path.join(directory, '*.jpg')))[:limit]:
+        with open(file_path, 'rb') as f:
+            uploads.append((os.path.basename(file_path), f.read()))
+    return uploads
+
+
+def benchmark(backend, uploads, batch_size, repeat, render):
+    timings = []
+    started = time.perf_counter()
+    for _ in range(repeat):
+        for start in range(0, len(uploads), batch_size):
+            batch = [(name, data, render) for name, data in uploads[start:start + batch_size]]
+            batch_started = time.perf_counter()
+            results = backend.predict_bytes(batch)
+            timings.append(time.perf_counter() - batch_started)
+            failed = [result.get('error') for result in results if not result.get('ok')]
+            if failed:
+                raise RuntimeError(failed[0])
+    elapsed = time.perf_counter() - started
+    timings.sort()
+    return len(uploads) * repeat / elapsed, 1000 * sum(timings) / len(timings), 1000 * timings[int(0.95 * (len(timings) - 1))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the inference backends')
+    parser.add_argument('--backends', default='stub,onnx', help=f"Comma separated: {', '.join(BACKENDS)}")
+    parser.add_argument('--model', default='images/best_v8n.engine', help='Model path; the onnx backends use the .onnx files next to it')
+    parser.add_argument('--container', default='ultralytics_inference', help='Container for the docker backends')
+    parser.add_argument('--directory', default=DEFAULT_DIRECTORY, help='JPEG files to send')
+    parser.add_argument('--limit', type=int, default=16)
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--warmup', type=int, default=1, help='Untimed batches before measuring')
+    parser.add_argument('--threads', type=int, default=0, help='ONNX Runtime intra-op threads (0 = tuned setting or default)')
+    parser.add_argument('--labels-only', action='store_true', help='Skip rendering the annotated image')
+    args = parser.parse_args()
+
+    uploads = load_uploads(args.directory, args.limit)
+    if not uploads:
+        print(f'No JPEG files found in {args.directory}')
+        return
+    print(f'{len(uploads)} images, batch size {args.batch_size}, {"labels only" if args.labels_only else "annotated"}')
+
+    for name in args.backends.split(','):
+        options = {'threads': args.threads} if name.startswith('onnx') else {}
+        backend = create_backend(name, args.container, args.model, **options)
+        try:
+            backend.start()
+            for _ in range(args.warmup):
+                backend.predict_bytes(uploads[:args.batch_size])
+            rate, mean, p95 = benchmark(backend, uploads, args.batch_size, args.repeat, not args.labels_only)
+        except Exception as e:
+            print(f'  {name:<12} failed: {e}')
+            continue
+        finally:
+            backend.stop()
+        print(f'  {name:<12} {rate:8.1f} images/s   batch mean {mean:8.1f} ms   p95 {p95:8.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,422 @@
+import argparse
+import glob
+import json
+import os
+import random
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import wire_protocol
+
+# Replays a directory of images against an edge server and reports latency
+# percentiles, throughput and errors. With --server the server is started
+# under fake_docker.py (stub model, no Docker or GPU needed); with --host it
+# targets a server that is already running.
+#
+# Load is either closed-loop (--concurrency clients, each sending its next
+# image as soon as the previous answer arrives) or open-loop (--rate
+# requests per second with Poisson arrivals, regardless of how fast the
+# server answers).
+
+DEFAULT_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'eel', 'web', 'images')
+FAKE_DOCKER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_docker.py')
+SERVERS = {
+    'opt3': 'server_opt3',
+    'opt4': 'server_opt4',
+    'opt5': 'server_opt5',
+    'opt6': 'server_opt6',
+    'gbs': 'server_opt_gbs',
+}
+V2_SERVERS = {'opt5', 'opt6'}
+METRICS_SERVERS = {'opt4', 'opt5', 'opt6'}  # Answer GET /metrics on their port
+
+
+class Images:
+    # Cycles through the directory; with unique=True every request gets
+    # different bytes (a random trailer after the JPEG end marker) so result
+    # caches cannot answer it
+    def __init__(self, directory, unique):
+        self.images = []
+        for file_path in sorted(glob.glob(os.path.join(directory, '*.jpg'))):
+            if not os.path.basename(file_path).startswith('predicted_'):
+                with open(file_path, 'rb') as f:
+                    self.images.append((os.path.basename(file_path), f.read()))
+        if not self.images:
+            raise SystemExit(f'No JPEG files found in {directory}')
+        self.unique = unique
+        self.index = 0
+        self.lock = threading.Lock()
+
+    def next(self):
+        with self.lock:
+            name, data = self.images[self.index % len(self.images)]
+            self.index += 1
+        if self.unique:
+            data = data + os.urandom(16)
+        return name, data
+
+
+class Recorder:
+    def __init__(self, warmup):
+        self.lock = threading.Lock()
+        self.warmup = warmup
+        self.seen = 0
+        self.results = []
+
+    def record(self, started, finished, status):
+        with self.lock:
+            self.seen += 1
+            if self.seen > self.warmup:
+                self.results.append((started, finished, status))
+
+
+def classify_legacy(response):
+    # Legacy servers answer name length, name, size, file (+ labels) and close,
+    # or close without an answer when they refuse the upload
+    if not response:
+        return 'refused'
+    if response.startswith(b'INFERENCE_FAILED') or len(response) < 4:
+        return 'failed'
+    name_length = struct.unpack('!I', response[:4])[0]
+    if name_length == 0 or name_length > 4096 or len(response) < 12 + name_length:
+        return 'failed'
+    file_size = struct.unpack('!Q', response[4 + name_length:12 + name_length])[0]
+    return 'ok' if len(response) >= 12 + name_length + file_size else 'truncated'
+
+
+def legacy_request(host, port, name, data, timeout):
+    try:
+        with socket.create_connection((host, port), timeout=timeout) as conn:
+            name_bytes = name.encode('utf-8')
+            conn.sendall(struct.pack('!I', len(name_bytes)) + name_bytes + struct.pack('!Q', len(data)))
+            conn.sendall(data)
+            response = bytearray()
+            while True:
+                chunk = conn.recv(65536)
+                if not chunk:
+                    break
+                response += chunk
+        return classify_legacy(bytes(response))
+    except socket.timeout:
+        return 'timeout'
+    except OSError:
+        return 'error'
+
+
+def v2_status(frame_type, header):
+    if frame_type == wire_protocol.RESPONSE:
+        return 'ok'
+    return {'busy': 'busy', 'rate_limited': 'rate_limited', 'deadline_exceeded': 'expired'}.get(header.get('status'), 'failed')
+
+
+def hello_header(args):
+    return {'device': args.device} if args.device else None
+
+
+def request_header(args, name):
+    header = {'name': name, 'labels_only': args.labels_only, 'priority': args.priority}
+    if args.deadline_ms:
+        header['deadline_ms'] = args.deadline_ms
+    return header
+
+
+def run_closed_loop(args, images, recorder, deadline, total):
+    sent = [0]
+    sent_lock = threading.Lock()
+
+    def claim():
+        with sent_lock:
+            if sent[0] >= total or time.monotonic() >= deadline:
+                return False
+            sent[0] += 1
+            return True
+
+    def client():
+        session = None
+        request_id = 0
+        while claim():
+            name, data = images.next()
+            started = time.monotonic()
+            if args.protocol == 'legacy':
+                status = legacy_request(args.host, args.port, name, data, args.timeout)
+            else:
+                try:
+                    if session is None:
+                        session = socket.create_connection((args.host, args.port), timeout=args.timeout)
+                        wire_protocol.client_hello(session, hello_header(args))
+                    request_id += 1
+                    wire_protocol.send_frame(session, wire_protocol.REQUEST, request_id, request_header(args, name), data)
+                    frame_type, _, header, _ = wire_protocol.recv_frame(session)
+                    status = v2_status(frame_type, header)
+                except socket.timeout:
+                    status = 'timeout'
+                except (OSError, ConnectionError, ValueError):
+                    status = 'error'
+                if status in ('timeout', 'error') and session is not None:
+                    session.close()
+                    session = None
+            recorder.record(started, time.monotonic(), status)
+        if session is not None:
+            wire_protocol.send_frame(session, wire_protocol.BYE, 0, {})
+            session.close()
+
+    threads = [threading.Thread(target=client) for _ in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def run_open_loop(args, images, recorder, deadline, total):
+    arrivals = []
+    if args.protocol == 'legacy':
+        executor = ThreadPoolExecutor(max_workers=args.max_inflight)
+
+        def send(name, data, started):
+            status = legacy_request(args.host, args.port, name, data, args.timeout)
+            recorder.record(started, time.monotonic(), status)
+    else:
+        # Requests are pipelined over a few persistent connections and
+        # matched to their answers by request id
+        connections = []
+        for _ in range(args.connections):
+            conn = socket.create_connection((args.host, args.port))
+            wire_protocol.client_hello(conn, hello_header(args))
+            connections.append({'conn': conn, 'lock': threading.Lock(), 'pending': {}, 'next_id': 0})
+
+        def receive(connection):
+            while True:
+                try:
+                    frame_type, request_id, header, _ = wire_protocol.recv_frame(connection['conn'])
+                except (OSError, ConnectionError, ValueError):
+                    break
+                started = connection['pending'].pop(request_id, None)
+                if started is not None:
+                    recorder.record(started, time.monotonic(), v2_status(frame_type, header))
+            for started in list(connection['pending'].values()):
+                recorder.record(started, time.monotonic(), 'error')
+            connection['pending'].clear()
+
+        receivers = [threading.Thread(target=receive, args=(connection,), daemon=True) for connection in connections]
+        for receiver in receivers:
+            receiver.start()
+
+        def send(name, data, started):
+            connection = connections[len(arrivals) % len(connections)]
+            with connection['lock']:
+                connection['next_id'] += 1
+                request_id = connection['next_id']
+                connection['pending'][request_id] = started
+                try:
+                    wire_protocol.send_frame(connection['conn'], wire_protocol.REQUEST, request_id,
+                                             request_header(args, name), data)
+                except OSError:
+                    pass
+
+    # Latency is measured from the scheduled arrival, so a backed-up client
+    # does not hide server queueing
+    next_arrival = time.monotonic()
+    while len(arrivals) < total and next_arrival < deadline:
+        delay = next_arrival - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        name, data = images.next()
+        arrivals.append(next_arrival)
+        if args.protocol == 'legacy':
+            executor.submit(send, name, data, next_arrival)
+        else:
+            send(name, data, next_arrival)
+        next_arrival += random.expovariate(args.rate)
+
+    if args.protocol == 'legacy':
+        executor.shutdown(wait=True)
+    else:
+        # Wait for outstanding answers, then close
+        give_up = time.monotonic() + args.timeout
+        while any(connection['pending'] for connection in connections) and time.monotonic() < give_up:
+            time.sleep(0.05)
+        for connection in connections:
+            for started in list(connection['pending'].values()):
+                recorder.record(started, time.monotonic(), 'timeout')
+            connection['pending'].clear()
+            try:
+                wire_protocol.send_frame(connection['conn'], wire_protocol.BYE, 0, {})
+            except OSError:
+                pass
+            connection['conn'].close()
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def summarize(label, results):
+    latencies = sorted(1000 * (finished - started) for started, finished, status in results if status == 'ok')
+    statuses = {}
+    for _, _, status in results:
+        statuses[status] = statuses.get(status, 0) + 1
+    elapsed = (max(finished for _, finished, _ in results) - min(started for started, _, _ in results)) if results else 0
+    return {
+        'server': label,
+        'requests': len(results),
+        'ok': statuses.get('ok', 0),
+        'errors': {status: count for status, count in statuses.items() if status != 'ok'},
+        'throughput_rps': len(latencies) / elapsed if elapsed else 0.0,
+        'p50_ms': percentile(latencies, 0.50),
+        'p95_ms': percentile(latencies, 0.95),
+        'p99_ms': percentile(latencies, 0.99),
+        'mean_ms': sum(latencies) / len(latencies) if latencies else 0.0,
+        'max_ms': latencies[-1] if latencies else 0.0,
+    }
+
+
+def scrape_stage_means(host, port, timeout):
+    # Mean milliseconds per request stage from the server's /metrics
+    with socket.create_connection((host, port), timeout=timeout) as conn:
+        conn.sendall(b'GET /metrics HTTP/1.1\r\nHost: bench\r\n\r\n')
+        response = bytearray()
+        while True:
+            chunk = conn.recv(65536)
+            if not chunk:
+                break
+            response += chunk
+    sums, counts = {}, {}
+    for line in bytes(response).decode('utf-8').split('\r\n\r\n', 1)[-1].splitlines():
+        for suffix, values in (('_sum', sums), ('_count', counts)):
+            prefix = f'edge_stage_seconds{suffix}{{stage="'
+            if line.startswith(prefix):
+                stage, value = line[len(prefix):].split('"} ')
+                values[stage] = float(value)
+    return {stage: 1000 * sums[stage] / counts[stage] for stage in sums if counts.get(stage)}
+
+
+def wait_for_port(host, port, process, timeout):
+    give_up = time.monotonic() + timeout
+    while time.monotonic() < give_up:
+        if process.poll() is not None:
+            raise SystemExit(f'Server exited with code {process.returncode} before listening')
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise SystemExit(f'Server did not start listening on {host}:{port} within {timeout} s')
+
+
+def start_server(name, args, work_directory):
+    command = [sys.executable, FAKE_DOCKER, 'serve', SERVERS[name], '--port', str(args.port),
+               '--work-dir', work_directory, '--latency', str(args.latency), '--per-image', str(args.per_image)]
+    for assignment in args.set:
+        command += ['--set', assignment]
+    log = open(os.path.join(work_directory, 'server.log'), 'wb')
+    process = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT, start_new_session=True)
+    wait_for_port(args.host, args.port, process, args.startup_timeout)
+    return process, log
+
+
+def stop_server(process, log):
+    # SIGINT so the server runs its KeyboardInterrupt cleanup
+    try:
+        os.killpg(process.pid, signal.SIGINT)
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        os.killpg(process.pid, signal.SIGKILL)
+        process.wait()
+    except ProcessLookupError:
+        pass
+    log.close()
+
+
+def run_benchmark(label, args, images):
+    recorder = Recorder(args.warmup)
+    deadline = time.monotonic() + args.duration if args.duration else float('inf')
+    total = args.requests + args.warmup
+    if args.rate:
+        run_open_loop(args, images, recorder, deadline, total)
+    else:
+        run_closed_loop(args, images, recorder, deadline, total)
+    return summarize(label, recorder.results)
+
+
+def print_summary(summary):
+    errors = ', '.join(f'{status} {count}' for status, count in sorted(summary['errors'].items())) or 'none'
+    print(f"{summary['server']:<8} {summary['requests']:>6} req  {summary['throughput_rps']:7.1f} req/s  "
+          f"p50 {summary['p50_ms']:7.1f}  p95 {summary['p95_ms']:7.1f}  p99 {summary['p99_ms']:7.1f}  "
+          f"max {summary['max_ms']:7.1f} ms  errors: {errors}")
+    if summary.get('stages_ms'):
+        print('         mean stage ms: ' + '  '.join(f'{stage} {ms:.1f}' for stage, ms in summary['stages_ms'].items()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the edge servers')
+    parser.add_argument('--server', help=f"Comma separated servers to start under fake_docker.py: {', '.join(SERVERS)}")
+    parser.add_argument('--host', default='127.0.0.1', help='Server to load when --server is not given')
+    parser.add_argument('--port', type=int, default=12345)
+    parser.add_argument('--protocol', choices=('legacy', 'v2'), default='legacy',
+                        help='v2 uses persistent connections; servers without v2 fall back to legacy')
+    parser.add_argument('--directory', default=DEFAULT_DIRECTORY, help='Images to replay')
+    parser.add_argument('--concurrency', type=int, default=4, help='Closed-loop clients')
+    parser.add_argument('--rate', type=float, default=0, help='Open-loop arrival rate in requests per second')
+    parser.add_argument('--connections', type=int, default=1, help='Persistent connections for open-loop v2')
+    parser.add_argument('--max-inflight', type=int, default=256, help='Open-loop legacy connections at once')
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--duration', type=float, default=0, help='Stop after this many seconds (0 = no limit)')
+    parser.add_argument('--warmup', type=int, default=5, help='Requests excluded from the results')
+    parser.add_argument('--timeout', type=float, default=60)
+    parser.add_argument('--unique', action='store_true', help='Make every upload distinct so result caches miss')
+    parser.add_argument('--labels-only', action='store_true', help='Ask v2 servers for detections only')
+    parser.add_argument('--priority', default='normal', help='Scheduling class of v2 requests: interactive, normal or bulk')
+    parser.add_argument('--deadline-ms', type=int, default=0, help='Latency budget of v2 requests, after which the server drops them')
+    parser.add_argument('--device', help='Device id v2 clients send, for per-device fair share and rate limits')
+    parser.add_argument('--latency', type=float, default=0.05, help='Stub model seconds per forward pass')
+    parser.add_argument('--per-image', type=float, default=0.01, help='Stub model extra seconds per image')
+    parser.add_argument('--set', action='append', default=[], metavar='NAME=VALUE', help='Override a server constant')
+    parser.add_argument('--startup-timeout', type=float, default=60)
+    parser.add_argument('--json', help='Append one JSON line per run to this file')
+    parser.add_argument('--metrics', action='store_true', help=f"Report the mean time per request stage ({', '.join(sorted(METRICS_SERVERS))})")
+    args = parser.parse_args()
+
+    images = Images(args.directory, args.unique)
+    summaries = []
+    if args.server:
+        protocol = args.protocol
+        base_port = args.port
+        for index, name in enumerate(args.server.split(',')):
+            # A fresh port per server: the threaded servers do not set SO_REUSEADDR
+            args.port = base_port + index
+            args.protocol = protocol if name in V2_SERVERS else 'legacy'
+            with tempfile.TemporaryDirectory() as work_directory:
+                process, log = start_server(name, args, work_directory)
+                try:
+                    summaries.append(run_benchmark(name, args, images))
+                    summaries[-1]['protocol'] = args.protocol
+                    if args.metrics and name in METRICS_SERVERS:
+                        summaries[-1]['stages_ms'] = scrape_stage_means(args.host, args.port, args.timeout)
+                finally:
+                    stop_server(process, log)
+            print_summary(summaries[-1])
+    else:
+        summaries.append(run_benchmark(f'{args.host}:{args.port}', args, images))
+        summaries[-1]['protocol'] = args.protocol
+        if args.metrics:
+            summaries[-1]['stages_ms'] = scrape_stage_means(args.host, args.port, args.timeout)
+        print_summary(summaries[-1])
+
+    if args.json:
+        with open(args.json, 'a') as f:
+            for summary in summaries:
+                summary.update({'concurrency': args.concurrency, 'rate': args.rate,
+                                'latency': args.latency, 'per_image': args.per_image, 'unique': args.unique})
+                f.write(json.dumps(summary) + '\n')
+
+
+if __name__ == '__main__':
+    main()
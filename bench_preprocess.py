@@ -0,0 +1,90 @@
+import argparse
+import glob
+import os
+import tempfile
+import time
+import cv2
+import numpy as np
+import preprocess
+
+# Compares server_opt4's preprocessing (save upload, cv2.imread, center crop,
+# resize, cv2.imwrite, then YOLO reading the file again) with the in-memory
+# reduced-scale decode in preprocess.py.
+
+DEFAULT_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'eel', 'web', 'images')
+
+
+def current_path(data, work_directory):
+    file_path = os.path.join(work_directory, 'upload.jpg')
+    with open(file_path, 'wb') as f:
+        f.write(data)
+    img = cv2.imread(file_path)
+    h, w, _ = img.shape
+    crop_size = min(h, w)
+    center_x = w // 2
+    center_y = h // 2
+    x = center_x - crop_size // 2
+    y = center_y - crop_size // 2
+    img = img[y:y+crop_size, x:x+crop_size]
+    img = cv2.resize(img, (640, 640))
+    cv2.imwrite(file_path, img)
+    return cv2.imread(file_path)
+
+
+def load_uploads(directory, synthetic_size):
+    uploads = []
+    for file_path in sorted(glob.glob(os.path.join(directory, '*.jpg'))):
+        if os.path.basename(file_path).startswith('predicted_'):
+            continue
+        with open(file_path, 'rb') as f:
+            data = f.read()
+        if synthetic_size:
+            # Upscale to phone-camera resolution to see the effect on 12 MP photos
+            image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+            image = cv2.resize(image, synthetic_size, interpolation=cv2.INTER_CUBIC)
+            data = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, 92])[1].tobytes()
+        uploads.append(data)
+    return uploads
+
+
+def benchmark(name, function, uploads, repeat):
+    timings = []
+    for _ in range(repeat):
+        for data in uploads:
+            started = time.perf_counter()
+            function(data)
+            timings.append(time.perf_counter() - started)
+    timings.sort()
+    mean = 1000 * sum(timings) / len(timings)
+    p95 = 1000 * timings[int(0.95 * (len(timings) - 1))]
+    print(f'{name:<28} mean {mean:8.2f} ms   p95 {p95:8.2f} ms   ({len(timings)} runs)')
+    return mean
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark upload preprocessing paths')
+    parser.add_argument('--directory', default=DEFAULT_DIRECTORY)
+    parser.add_argument('--synthetic-size', default='4032x3024',
+                        help="Re-encode every image at WIDTHxHEIGHT first, or 'none' to use them as they are")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--limit', type=int, default=20)
+    args = parser.parse_args()
+
+    synthetic_size = None
+    if args.synthetic_size != 'none':
+        synthetic_size = tuple(int(v) for v in args.synthetic_size.split('x'))
+    uploads = load_uploads(args.directory, synthetic_size)[:args.limit]
+    if not uploads:
+        print(f'No JPEG files found in {args.directory}')
+        return
+    print(f'{len(uploads)} images, mean upload size {sum(map(len, uploads)) / len(uploads) / 1024:.0f} KiB')
+
+    with tempfile.TemporaryDirectory() as work_directory:
+        baseline = benchmark('imread/crop/imwrite/imread', lambda data: current_path(data, work_directory), uploads, args.repeat)
+    for mode in ('center_crop', 'letterbox'):
+        mean = benchmark(f'reduced decode + {mode}', lambda data: preprocess.preprocess(data, 640, mode), uploads, args.repeat)
+        print(f'{"":<28} {baseline / mean:.1f}x faster than the current path')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+import argparse
+import os
+import socket
+import struct
+import tempfile
+import threading
+import time
+import tracemalloc
+import transfer
+
+# Compares the original transfer code (read the whole file, sendall, then
+# 4096 byte recv() calls written to a file or appended to a bytearray) with
+# transfer.py (sendfile and recv_into on reusable buffers), over a local
+# socket pair with one image per iteration.
+
+
+class CountingSocket:
+    # Counts receive calls; everything else goes to the real socket
+    def __init__(self, conn):
+        self.conn = conn
+        self.calls = 0
+
+    def recv(self, size):
+        self.calls += 1
+        return self.conn.recv(size)
+
+    def recv_into(self, view):
+        self.calls += 1
+        return self.conn.recv_into(view)
+
+
+def old_send_file(conn, file_path):
+    with open(file_path, 'rb') as f:
+        file_data = f.read()
+    file_name = os.path.basename(file_path).encode('utf-8')
+    conn.sendall(struct.pack('!I', len(file_name)))
+    conn.sendall(file_name)
+    conn.sendall(struct.pack('!Q', len(file_data)))
+    conn.sendall(file_data)
+
+
+def old_receive_file(conn, save_directory):
+    name_length = struct.unpack('!I', conn.recv(4))[0]
+    file_name = conn.recv(name_length).decode('utf-8')
+    file_path = os.path.join(save_directory, file_name)
+    file_size = struct.unpack('!Q', conn.recv(8))[0]
+    with open(file_path, 'wb') as f:
+        remaining = file_size
+        while remaining > 0:
+            chunk = conn.recv(4096 if remaining > 4096 else remaining)
+            if not chunk:
+                raise ConnectionError("Connection closed while receiving file")
+            f.write(chunk)
+            remaining -= len(chunk)
+    return file_path
+
+
+def old_receive_upload(conn, save_directory):
+    name_length = struct.unpack('!I', conn.recv(4))[0]
+    conn.recv(name_length)
+    file_size = struct.unpack('!Q', conn.recv(8))[0]
+    data = bytearray()
+    while len(data) < file_size:
+        chunk = conn.recv(min(4096, file_size - len(data)))
+        if not chunk:
+            raise ConnectionError("Connection closed while receiving file")
+        data += chunk
+    return bytes(data)
+
+
+def new_receive_upload(conn, save_directory):
+    _, file_size = transfer.recv_header(conn)
+    return transfer.receive_bytes(conn, file_size)
+
+
+def run(send, receive, file_path, repeat):
+    sender, receiver = socket.socketpair()
+    counting = CountingSocket(receiver)
+    with tempfile.TemporaryDirectory() as save_directory:
+        def run_receiver():
+            for _ in range(repeat):
+                receive(counting, save_directory)
+
+        tracemalloc.start()
+        thread = threading.Thread(target=run_receiver)
+        started = time.perf_counter()
+        thread.start()
+        for _ in range(repeat):
+            send(sender, file_path)
+        thread.join()
+        elapsed = time.perf_counter() - started
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    sender.close()
+    receiver.close()
+    size = os.path.getsize(file_path)
+    return size * repeat / elapsed / 1e6, counting.calls / repeat, peak / 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the socket transfer functions')
+    parser.add_argument('--sizes', default='100000,1000000,8000000', help='Comma separated payload sizes in bytes')
+    parser.add_argument('--repeat', type=int, default=50)
+    args = parser.parse_args()
+
+    cases = (
+        ('read + sendall / recv(4096) to file', old_send_file, old_receive_file),
+        ('sendfile / recv_into to file', transfer.send_file, transfer.receive_file),
+        ('read + sendall / recv(4096) to memory', old_send_file, old_receive_upload),
+        ('sendfile / recv_into to memory', transfer.send_file, new_receive_upload),
+    )
+    with tempfile.TemporaryDirectory() as directory:
+        for size in [int(value) for value in args.sizes.split(',')]:
+            file_path = os.path.join(directory, f'payload_{size}.jpg')
+            with open(file_path, 'wb') as f:
+                f.write(os.urandom(size))
+            print(f'Payload {size / 1e6:.1f} MB')
+            for name, send, receive in cases:
+                rate, calls, peak = run(send, receive, file_path, args.repeat)
+                print(f'  {name:<40} {rate:8.1f} MB/s   {calls:8.1f} receive calls/image   peak traced memory {peak:6.2f} MB')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,192 @@
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import time
+import yolo_worker
+
+# Builds the model files the servers load, once per combination of weights,
+# input size, precision and, for engines, batch size, and keeps them in
+# SAVE_DIRECTORY/artifacts:
+#
+#   best_v8n-<weights hash>-640-fp16-b32.engine   TensorRT, batches of 1 to 32, built in the container
+#   best_v8n-<weights hash>-640-fp32.onnx         ONNX, dynamic batch
+#   best_v8n-<weights hash>-640-int8.onnx         static INT8, see quantize_onnx.py
+#
+# Each artifact has a .json manifest written after a successful build; an
+# artifact without one is rebuilt. Exports run inside the inference container
+# (`docker exec`, or `docker run --rm` from an image) where TensorRT and the
+# right ultralytics version live, or in this process when no container is
+# given. SAVE_DIRECTORY is /ultralytics/images in the container, so the
+# returned paths (images/artifacts/...) work on both sides.
+
+ARTIFACT_DIRECTORY = 'artifacts'
+CONTAINER_MOUNT = 'images'
+EXTENSIONS = {'onnx': '.onnx', 'engine': '.engine'}
+PRECISIONS = {'onnx': ('fp32', 'int8'), 'engine': ('fp32', 'fp16')}
+ENGINE_MAX_BATCH = 32  # Largest batch an engine takes; covers the servers' BATCH_MAX_SIZE and --reanalyze batches
+
+# Formats to try per inference backend, best first. The ultralytics and stub
+# backends load the configured model as it is.
+BACKEND_FORMATS = {
+    'docker': ('engine', 'onnx'),
+    'docker-cli': ('engine', 'onnx'),
+    'onnx': ('onnx',),
+    'onnx-int8': ('onnx',),
+}
+
+
+class BuildError(Exception):
+    pass
+
+
+def artifact_name(weights_path, fmt, size, precision, batch=ENGINE_MAX_BATCH):
+    stem = os.path.splitext(os.path.basename(weights_path))[0]
+    # ONNX exports take any batch; an engine's largest batch is fixed when it is built
+    batch_suffix = f'-b{batch}' if fmt == 'engine' else ''
+    return f'{stem}-{yolo_worker.model_version(weights_path)}-{size}-{precision}{batch_suffix}{EXTENSIONS[fmt]}'
+
+
+def export_options(fmt, size, precision, batch=ENGINE_MAX_BATCH):
+    options = {'format': fmt, 'imgsz': size}
+    if fmt == 'onnx':
+        options.update(dynamic=True, simplify=True)
+    if fmt == 'engine':
+        # Without these the engine is built for exactly one image per forward pass
+        options.update(dynamic=True, batch=batch)
+    if precision == 'fp16':
+        options['half'] = True
+    return options
+
+
+def run_export(save_directory, source_name, options, container=None, image=None):
+    # source_name is relative to save_directory; the export lands next to it
+    if container is None and image is None:
+        from ultralytics import YOLO
+        YOLO(os.path.join(save_directory, source_name), task='detect').export(**options)
+        return
+    command = ['yolo', 'export', f'model={CONTAINER_MOUNT}/{source_name}'] + [f'{key}={value}' for key, value in options.items()]
+    if container is not None:
+        command = ['sudo', 'docker', 'exec', container] + command
+    else:
+        command = ['sudo', 'docker', 'run', '--rm', '--ipc=host', '--runtime=nvidia',
+                   '-v', f'{save_directory}:/ultralytics/{CONTAINER_MOUNT}:rw', image] + command
+    try:
+        subprocess.run(command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    except subprocess.CalledProcessError as e:
+        raise BuildError(f"{' '.join(command)} failed: {e.stderr.strip()[-500:]}")
+
+
+def calibration_images(save_directory):
+    import quantize_onnx
+    calibration, _ = quantize_onnx.split_images(quantize_onnx.list_images(save_directory),
+                                                quantize_onnx.CALIBRATION_SAMPLES, quantize_onnx.EVALUATION_SAMPLES)
+    return quantize_onnx.load_images(calibration)
+
+
+def ensure_artifact(save_directory, weights_name, fmt='onnx', size=640, precision='fp32', container=None, image=None, force=False,
+                    batch=ENGINE_MAX_BATCH):
+    # Returns the artifact path relative to the directory above save_directory
+    if precision not in PRECISIONS[fmt]:
+        raise ValueError(f'{fmt} artifacts are built as {" or ".join(PRECISIONS[fmt])}, not {precision}')
+    weights_path = os.path.join(save_directory, weights_name)
+    if not os.path.exists(weights_path):
+        raise BuildError(f'No weights at {weights_path}')
+
+    directory = os.path.join(save_directory, ARTIFACT_DIRECTORY)
+    os.makedirs(directory, exist_ok=True)
+    name = artifact_name(weights_path, fmt, size, precision, batch)
+    path = os.path.join(directory, name)
+    manifest_path = path + '.json'
+    relative_path = f'{CONTAINER_MOUNT}/{ARTIFACT_DIRECTORY}/{name}'
+    if not force and os.path.exists(path) and os.path.exists(manifest_path):
+        print(f'Using cached model artifact {relative_path}')
+        return relative_path
+
+    print(f'Building model artifact {relative_path}...')
+    started = time.monotonic()
+    if fmt == 'onnx' and precision == 'int8':
+        import quantize_onnx
+        fp32_path = ensure_artifact(save_directory, weights_name, 'onnx', size, 'fp32', container, image, force)
+        images = calibration_images(save_directory)
+        if not images:
+            raise BuildError(f'No calibration images in {save_directory}')
+        quantize_onnx.quantize(os.path.join(directory, os.path.basename(fp32_path)), path, images, 'MinMax')
+    else:
+        # Export a copy named after the artifact, so the output needs no renaming
+        # and builds for different sizes or precisions never collide
+        stem = os.path.splitext(name)[0]
+        source_name = stem + os.path.splitext(weights_name)[1]
+        shutil.copyfile(weights_path, os.path.join(directory, source_name))
+        try:
+            run_export(save_directory, f'{ARTIFACT_DIRECTORY}/{source_name}', export_options(fmt, size, precision, batch), container, image)
+        finally:
+            os.remove(os.path.join(directory, source_name))
+            if fmt == 'engine' and os.path.exists(os.path.join(directory, stem + '.onnx')):
+                os.remove(os.path.join(directory, stem + '.onnx'))  # Intermediate of the TensorRT export
+        if not os.path.exists(path):
+            raise BuildError(f'The export did not produce {relative_path}')
+
+    manifest = {
+        'weights': weights_name, 'version': yolo_worker.model_version(weights_path), 'format': fmt, 'size': size,
+        'precision': precision, 'batch': batch if fmt == 'engine' else None, 'built': time.strftime('%Y-%m-%dT%H:%M:%S'), 'build_seconds': round(time.monotonic() - started, 1),
+    }
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    print(f'Built {relative_path} in {manifest["build_seconds"]} s')
+    return relative_path
+
+
+def artifact_for_backend(backend, save_directory, weights_name, size=640, precision='fp16', container=None, batch=ENGINE_MAX_BATCH):
+    # The best artifact the backend can load, or None to keep the configured model
+    for fmt in BACKEND_FORMATS.get(backend, ()):
+        fmt_precision = 'int8' if backend == 'onnx-int8' else precision if precision in PRECISIONS[fmt] else 'fp32'
+        try:
+            return ensure_artifact(save_directory, weights_name, fmt, size, fmt_precision, container, batch=batch)
+        except (BuildError, ImportError) as e:
+            print(f'Could not build a {fmt} {fmt_precision} model: {e}')
+    return None
+
+
+def list_artifacts(save_directory):
+    directory = os.path.join(save_directory, ARTIFACT_DIRECTORY)
+    if not os.path.isdir(directory):
+        return
+    for file_name in sorted(os.listdir(directory)):
+        if file_name.endswith('.json') and file_name[:-len('.json')].endswith(tuple(EXTENSIONS.values())):
+            with open(os.path.join(directory, file_name)) as f:
+                manifest = json.load(f)
+            artifact = os.path.join(directory, file_name[:-len('.json')])
+            size = os.path.getsize(artifact) / 1e6 if os.path.exists(artifact) else 0
+            print(f"{file_name[:-len('.json')]:<48} {size:7.1f} MB  built {manifest['built']} in {manifest['build_seconds']} s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build and cache optimised model artifacts')
+    parser.add_argument('--save-directory', default=r'/home/jetson/edge_server/images')
+    parser.add_argument('--weights', default='best_v8n.pt', help='Weights file in the save directory')
+    parser.add_argument('--formats', default='onnx', help=f"Comma separated: {', '.join(EXTENSIONS)}")
+    parser.add_argument('--size', type=int, default=640)
+    parser.add_argument('--precision', default='fp32', help=f'Per format: {PRECISIONS}')
+    parser.add_argument('--batch', type=int, default=ENGINE_MAX_BATCH, help='Largest batch a TensorRT engine takes')
+    parser.add_argument('--container', help='Build with docker exec in this running container')
+    parser.add_argument('--image', help='Build in a throwaway container from this image')
+    parser.add_argument('--force', action='store_true', help='Rebuild even when a cached artifact exists')
+    parser.add_argument('--list', action='store_true', help='List the cached artifacts')
+    args = parser.parse_args()
+
+    if args.list:
+        list_artifacts(args.save_directory)
+        return
+    save_directory = os.path.abspath(args.save_directory)
+    for fmt in args.formats.split(','):
+        try:
+            ensure_artifact(save_directory, args.weights, fmt, args.size, args.precision, args.container, args.image, args.force,
+                            args.batch)
+        except (BuildError, ValueError) as e:
+            raise SystemExit(str(e))
+
+
+if __name__ == '__main__':
+    main()
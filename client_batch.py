@@ -0,0 +1,292 @@
+import argparse
+import csv
+import json
+import os
+import queue
+import random
+import socket
+import struct
+import threading
+import time
+from collections import Counter
+import wire_protocol
+import preprocess
+import stream_crypto
+import transfer
+
+# Uploads every image in a directory, e.g. a day's field survey, and records
+# each outcome in a manifest. Run it again after an interruption or a failed
+# run and it skips the files the manifest already has as done.
+#
+# Each of --concurrency workers keeps one v2 session open and sends its
+# images over it one after another; servers that do not speak v2 get one
+# connection per image instead. Failed uploads are retried with backoff,
+# waiting at least as long as the server's retry_after_ms when it sends one.
+#
+# The manifest is JSON lines, or CSV when its name ends in .csv, with one
+# row per file appended as soon as the file is finished.
+
+SERVER_IP = '192.168.173.52'
+SERVER_PORT = 12345
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')  # Matched case-insensitively
+MANIFEST_NAME = 'manifest.jsonl'  # In the image directory unless --manifest is given
+MANIFEST_FIELDS = ('file', 'status', 'objects', 'counts', 'output', 'attempts', 'elapsed_ms', 'finished')
+DONE_STATUSES = ('ok',)  # Skipped on the next run
+HELLO_TIMEOUT = 3  # Seconds to wait for a v2 server before falling back to one connection per image
+RETRY_BACKOFF = 1.0  # Seconds before the first retry, doubled for each further one
+MAX_RETRY_WAIT = 60  # Seconds
+
+
+class Manifest:
+    def __init__(self, path):
+        self.path = path
+        self.csv = path.lower().endswith('.csv')
+        self.lock = threading.Lock()
+
+    def load(self):
+        # The last row of each file
+        rows = {}
+        if not os.path.exists(self.path):
+            return rows
+        with open(self.path, newline='') as f:
+            if self.csv:
+                for row in csv.DictReader(f):
+                    rows[row['file']] = row
+            else:
+                for line in f:
+                    try:
+                        row = json.loads(line)
+                    except ValueError:
+                        continue  # Cut short by an interruption
+                    rows[row['file']] = row
+        return rows
+
+    def write(self, row):
+        with self.lock:
+            new = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+            with open(self.path, 'a', newline='') as f:
+                if self.csv:
+                    writer = csv.DictWriter(f, MANIFEST_FIELDS)
+                    if new:
+                        writer.writeheader()
+                    writer.writerow({field: json.dumps(value) if isinstance(value, (list, dict)) else value
+                                     for field, value in row.items()})
+                else:
+                    f.write(json.dumps(row) + '\n')
+
+
+class Session:
+    # A worker's persistent v2 connection, reopened after errors, or a
+    # connection per upload once the server turned out to be legacy only
+    def __init__(self, args):
+        self.args = args
+        self.conn = None
+        self.legacy = False
+        self.key = None  # Set when the server agreed to encrypt frames
+        self.input_geometry = None
+        self.request_id = 0
+
+    def ensure_open(self):
+        if self.conn is None and not self.legacy:
+            self.legacy = not self.open()
+
+    def open(self):
+        conn = socket.create_connection((self.args.host, self.args.port), timeout=self.args.timeout)
+        hello = {'device': self.args.device}
+        if self.args.aes_key:
+            hello['encryption'] = stream_crypto.CIPHER
+        try:
+            conn.settimeout(HELLO_TIMEOUT)
+            server_hello = wire_protocol.client_hello(conn, hello)
+            conn.settimeout(self.args.timeout)
+        except (OSError, ConnectionError, ValueError):
+            conn.close()
+            return False
+        self.conn = conn
+        self.key = self.args.aes_key if server_hello.get('encryption') == stream_crypto.CIPHER else None
+        self.input_geometry = server_hello.get('input')
+        return True
+
+    def close(self, say_bye=True):
+        if self.conn is None:
+            return
+        try:
+            if say_bye:
+                wire_protocol.send_frame(self.conn, wire_protocol.BYE, 0, {}, key=self.key)
+        except OSError:
+            pass
+        finally:
+            self.conn.close()
+            self.conn = None
+
+    def upload(self, name, body, output_path):
+        self.request_id += 1
+        header = {'name': name, 'priority': self.args.priority, 'labels_only': self.args.labels_only}
+        wire_protocol.send_frame(self.conn, wire_protocol.REQUEST, self.request_id, header, body, self.key)
+        frame_type, _, reply, result_body = wire_protocol.recv_frame(self.conn, self.key)
+        if frame_type != wire_protocol.RESPONSE:
+            return reply
+        if result_body:
+            with open(output_path, 'wb') as f:
+                f.write(result_body)
+        return {'status': 'ok', 'objects': reply.get('objects'),
+                'counts': reply.get('detections', {}).get('counts'), 'output': output_path if result_body else None}
+
+
+def legacy_upload(args, name, body, output_path):
+    # One connection per image: name, size and body, then the result image
+    # and the detected objects. A busy or rate limited server closes the
+    # connection without an answer.
+    with socket.create_connection((args.host, args.port), timeout=args.timeout) as conn:
+        transfer.send_header(conn, name, len(body))
+        conn.sendall(body)
+        try:
+            prefix = transfer.recv_exact(conn, 4)
+        except ConnectionError:
+            return {'status': 'refused'}
+        if prefix == b'INFE':
+            return {'status': 'inference_failed'}
+        name_length = struct.unpack('!I', prefix)[0]
+        _, file_size = transfer.recv_header(conn, name_length)
+        transfer.receive_to_file(conn, output_path, file_size)
+        text_length = struct.unpack('!I', transfer.recv_exact(conn, 4))[0]
+        objects = json.loads(transfer.recv_exact(conn, text_length).decode('utf-8'))
+        return {'status': 'ok', 'objects': sorted(set(objects)), 'counts': dict(Counter(objects)), 'output': output_path}
+
+
+def find_images(directory):
+    # Results saved next to the photos are not uploaded again
+    return sorted(name for name in os.listdir(directory)
+                  if name.lower().endswith(IMAGE_EXTENSIONS) and not name.startswith('predicted_')
+                  and os.path.isfile(os.path.join(directory, name)))
+
+
+def retry_wait(reply, attempt):
+    backoff = RETRY_BACKOFF * 2 ** (attempt - 1) * random.uniform(0.5, 1.5)
+    return min(MAX_RETRY_WAIT, max(backoff, reply.get('retry_after_ms', 0) / 1000.0))
+
+
+def process_file(args, session, name):
+    file_path = os.path.join(args.directory, name)
+    output_path = os.path.join(args.output, 'predicted_' + name)
+    with open(file_path, 'rb') as f:
+        data = f.read()
+    started = time.monotonic()
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            session.ensure_open()
+            geometry = session.input_geometry
+            body = data
+            if geometry:
+                # Send exactly what the model sees instead of the full-resolution photo
+                body = preprocess.fit_upload(data, geometry['size'], geometry['mode'], geometry.get('quality', 90))
+            if session.legacy:
+                reply = legacy_upload(args, name, body, output_path)
+            else:
+                reply = session.upload(name, body, output_path)
+        except (OSError, ConnectionError, ValueError, struct.error) as e:
+            # A broken connection cannot be reused, open a new one for the retry
+            session.close(say_bye=False)
+            reply = {'status': 'timeout' if isinstance(e, socket.timeout) else 'error', 'error': str(e)}
+        if reply.get('status') == 'ok' or attempt > args.retries:
+            break
+        wait = retry_wait(reply, attempt)
+        print(f"{name}: {reply.get('status')}, retrying in {wait:.1f} s")
+        time.sleep(wait)
+    return {
+        'file': name,
+        'status': reply.get('status', 'failed'),
+        'objects': reply.get('objects'),
+        'counts': reply.get('counts'),
+        'output': reply.get('output'),
+        'attempts': attempt,
+        'elapsed_ms': round(1000 * (time.monotonic() - started), 1),
+        'finished': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+
+def worker(args, pending, manifest, totals, stop):
+    session = Session(args)
+    try:
+        while not stop.is_set():
+            try:
+                name = pending.get_nowait()
+            except queue.Empty:
+                break
+            row = process_file(args, session, name)
+            manifest.write(row)
+            with totals['lock']:
+                totals[row['status'] if row['status'] in DONE_STATUSES else 'failed'] += 1
+                done = totals['ok'] + totals['failed']
+            objects = ', '.join(row['objects'] or []) or 'none'
+            print(f"[{done}/{totals['total']}] {name}: {row['status']}, objects: {objects}")
+    finally:
+        session.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Upload a directory of images and record the results in a manifest')
+    parser.add_argument('directory', help='Images to upload')
+    parser.add_argument('--host', default=SERVER_IP)
+    parser.add_argument('--port', type=int, default=SERVER_PORT)
+    parser.add_argument('--output', help='Where result images go, default the image directory')
+    parser.add_argument('--manifest', help=f'JSON lines or .csv manifest, default {MANIFEST_NAME} in the image directory')
+    parser.add_argument('--concurrency', type=int, default=4, help='Uploads in flight, each over its own connection')
+    parser.add_argument('--retries', type=int, default=3, help='Further attempts for a failed upload')
+    parser.add_argument('--timeout', type=float, default=120, help='Seconds to wait on the server before retrying')
+    parser.add_argument('--priority', default='bulk', help='Scheduling class on v2 servers: interactive, normal or bulk')
+    parser.add_argument('--device', default=socket.gethostname(), help='Device id v2 servers share inference fairly by')
+    parser.add_argument('--labels-only', action='store_true', help='Ask v2 servers for detections only, no result images')
+    parser.add_argument('--encrypt', action='store_true', help='Ask v2 servers to encrypt request and response frames')
+    parser.add_argument('--key-file', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), stream_crypto.KEY_FILE),
+                        help='AES key shared with the server for --encrypt, see stream_crypto.load_key')
+    parser.add_argument('--redo', action='store_true', help='Upload files the manifest has as done again')
+    args = parser.parse_args()
+    args.output = args.output or args.directory
+    args.aes_key = None
+    if args.encrypt:
+        try:
+            args.aes_key = stream_crypto.load_key(args.key_file)
+        except ValueError as e:
+            raise SystemExit(str(e))
+        if args.aes_key is None:
+            raise SystemExit(f'--encrypt needs the key shared with the server in {args.key_file}')
+    os.makedirs(args.output, exist_ok=True)
+
+    manifest = Manifest(args.manifest or os.path.join(args.directory, MANIFEST_NAME))
+    names = find_images(args.directory)
+    done = set() if args.redo else {name for name, row in manifest.load().items() if row.get('status') in DONE_STATUSES}
+    todo = [name for name in names if name not in done]
+    print(f'{len(names)} images in {args.directory}, {len(names) - len(todo)} already done, {len(todo)} to upload')
+    if not todo:
+        return
+
+    pending = queue.Queue()
+    for name in todo:
+        pending.put(name)
+    totals = {'lock': threading.Lock(), 'total': len(todo), 'ok': 0, 'failed': 0}
+    stop = threading.Event()
+    started = time.monotonic()
+    threads = [threading.Thread(target=worker, args=(args, pending, manifest, totals, stop), daemon=True)
+               for _ in range(min(args.concurrency, len(todo)))]
+    for thread in threads:
+        thread.start()
+    try:
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(0.5)
+    except KeyboardInterrupt:
+        # The uploads in flight are finished and recorded, the rest go on the next run
+        print('Interrupted, finishing the uploads in flight...')
+        stop.set()
+        for thread in threads:
+            thread.join(args.timeout)
+    elapsed = time.monotonic() - started
+    print(f"Uploaded {totals['ok']} of {len(todo)} images in {elapsed:.1f} s, {totals['failed']} failed; "
+          f'manifest at {manifest.path}')
+
+
+if __name__ == "__main__":
+    main()
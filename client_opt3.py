@@ -2,59 +2,38 @@ import socket
 import os
 import sys
 import struct
+import wire_protocol
+import preprocess
+import stream_crypto
+import transfer
 
 # Configuration
 DIRECTORY = '/Users/hendri/Documents/PROJECTS/portable_a3/images'  
 SERVER_IP = '192.168.173.52'
 SERVER_PORT = 12345
 BUFFER_SIZE = 4096
+FILE_NAMES = ['hama2.jpg']  # Sent back to back over one connection
+KEY_FILE = stream_crypto.KEY_FILE  # Next to this file: the AES key shared with the server, see stream_crypto.load_key
+ENCRYPT = True  # Ask v2 servers to encrypt request and response frames; needs KEY_FILE
+PRIORITY = 'interactive'  # Scheduling class on v2 servers: 'interactive', 'normal' or 'bulk'
+DEADLINE_MS = 0  # Let the server drop a request still queued after this long, 0 waits however long it takes
+HELLO_TIMEOUT = 3  # Seconds to wait for a v2 server before falling back to one connection per image
 
 def send_file(conn, file_path):
-    with open(file_path, 'rb') as f:
-        file_data = f.read()
-    
-    file_name = os.path.basename(file_path).encode('utf-8')
-    name_length = len(file_name)
-    file_size = len(file_data)
-
-    # Send file name length, file name, and file size
-    conn.sendall(struct.pack('!I', name_length))
-    conn.sendall(file_name)
-    conn.sendall(struct.pack('!Q', file_size))
-
-    # Send file data
-    conn.sendall(file_data)
+    transfer.send_file(conn, file_path)
     print(f'Sent file: {file_path}')
 
 def receive_file(conn, save_directory):
-    # Receive file name length
-    name_length = struct.unpack('!I', conn.recv(4))[0]
-
-    # Receive file name
-    file_name = conn.recv(name_length).decode('utf-8')
+    file_name, file_size = transfer.recv_header(conn)
     file_path = os.path.join(save_directory, 'predicted_' + file_name)
 
-    # Receive file size
-    file_size = struct.unpack('!Q', conn.recv(8))[0]
-
     print(f'Receiving file: {file_name}, Size: {file_size} bytes')
-
-    # Receive and save the file
-    with open(file_path, 'wb') as f:
-        remaining = file_size
-        while remaining > 0:
-            chunk_size = BUFFER_SIZE if remaining > BUFFER_SIZE else remaining
-            chunk = conn.recv(chunk_size)
-            if not chunk:
-                raise ConnectionError("Connection closed while receiving file")
-            f.write(chunk)
-            remaining -= len(chunk)
+    transfer.receive_to_file(conn, file_path, file_size)
 
     print(f'File successfully saved at {file_path}')
     return file_path
 
-def process_image():
-    file_name = 'hama2.jpg'  # You can modify this to allow user input or iterate through multiple files
+def process_image(file_name):
     file_path = os.path.join(DIRECTORY, file_name)
     
     # Check if the file exists
@@ -85,5 +64,78 @@ def process_image():
     except Exception as e:
         print(f"An unexpected error occurred: {e}")
 
+def load_key():
+    if not ENCRYPT:
+        return None
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), KEY_FILE)
+    key = stream_crypto.load_key(path)
+    if key is None:
+        print(f'No key file at {path}, sending images unencrypted')
+    return key
+
+def open_session():
+    aes_key = load_key()
+    client_socket = socket.create_connection((SERVER_IP, SERVER_PORT))
+    try:
+        client_socket.settimeout(HELLO_TIMEOUT)
+        server_hello = wire_protocol.client_hello(client_socket, {'encryption': stream_crypto.CIPHER} if aes_key else None)
+        client_socket.settimeout(None)
+        key = aes_key if server_hello.get('encryption') == stream_crypto.CIPHER else None
+        print(f"Connected to server (protocol version {server_hello.get('version')}, input {server_hello.get('input')}, encrypted {key is not None})")
+        return client_socket, server_hello.get('input'), key
+    except (OSError, ConnectionError, ValueError):
+        client_socket.close()
+        return None, None, None
+
+def process_images(file_names):
+    file_paths = [os.path.join(DIRECTORY, file_name) for file_name in file_names]
+    for file_path in file_paths:
+        if not os.path.exists(file_path):
+            print(f"File {file_path} not found. Exiting program.")
+            sys.exit(1)
+
+    try:
+        client_socket, input_geometry, key = open_session()
+    except ConnectionRefusedError:
+        print(f"Could not connect to server at {SERVER_IP}:{SERVER_PORT}. Is the server running?")
+        return
+
+    if client_socket is None:
+        print("Server does not support persistent connections, sending one image per connection.")
+        for file_name in file_names:
+            process_image(file_name)
+        return
+
+    with client_socket:
+        # Pipeline every request, then collect the responses in whatever order they come back
+        requests = {}
+        for request_id, file_path in enumerate(file_paths, start=1):
+            with open(file_path, 'rb') as f:
+                body = f.read()
+            if input_geometry:
+                # Send exactly what the model sees instead of the full-resolution photo
+                body = preprocess.fit_upload(body, input_geometry['size'], input_geometry['mode'], input_geometry.get('quality', 90))
+            header = {'name': os.path.basename(file_path), 'priority': PRIORITY}
+            if DEADLINE_MS:
+                header['deadline_ms'] = DEADLINE_MS
+            wire_protocol.send_frame(client_socket, wire_protocol.REQUEST, request_id, header, body, key)
+            requests[request_id] = file_path
+        wire_protocol.send_frame(client_socket, wire_protocol.BYE, 0, {}, key=key)
+
+        while requests:
+            frame_type, request_id, header, body = wire_protocol.recv_frame(client_socket, key)
+            file_path = requests.pop(request_id, None)
+            if frame_type == wire_protocol.RESPONSE:
+                received_file_path = os.path.join(DIRECTORY, 'predicted_' + header['name'])
+                with open(received_file_path, 'wb') as f:
+                    f.write(body)
+                print(f"Processed image saved at: {received_file_path}, objects: {header.get('objects')}")
+            elif header.get('status') == 'deadline_exceeded':
+                print(f"Server could not process {file_path} within {DEADLINE_MS} ms")
+            elif header.get('status') == 'busy':
+                print(f"Server busy, {file_path} was not processed. Retry after {header.get('retry_after_ms')} ms")
+            else:
+                print(f"Server failed to process {file_path}: {header.get('status')}")
+
 if __name__ == "__main__":
-    process_image()
\ No newline at end of file
+    process_images(FILE_NAMES)
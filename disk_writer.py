@@ -0,0 +1,40 @@
+import os
+import queue
+import threading
+
+# Writes files from a background thread so the request path never waits on
+# the SD card / eMMC. Writes are dropped (and counted) when the queue is full.
+
+
+class DiskWriter:
+    def __init__(self, max_pending=64):
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.dropped = 0
+        self.written = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def write(self, file_path, data):
+        try:
+            self.queue.put_nowait((file_path, data))
+        except queue.Full:
+            self.dropped += 1
+            print(f'Disk writer queue full, not saving {file_path}')
+
+    def run(self):
+        while True:
+            file_path, data = self.queue.get()
+            try:
+                os.makedirs(os.path.dirname(file_path), exist_ok=True)
+                with open(file_path, 'wb') as f:
+                    f.write(data)
+                self.written += 1
+            except OSError as e:
+                print(f'Error saving {file_path}: {e}')
+            finally:
+                self.queue.task_done()
+
+    def flush(self):
+        self.queue.join()
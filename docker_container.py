@@ -0,0 +1,139 @@
+import hashlib
+import json
+import os
+import subprocess
+import time
+
+# Lifecycle of the inference container. Rather than force-removing and
+# recreating the container on every server start, a running container from
+# the expected image with the expected mounts that passes the readiness probe
+# is reused as it is, and a stopped one is started again.
+#
+# The image is derived from the ultralytics base with the container
+# dependencies installed (docker/Dockerfile, docker/requirements.txt). It is
+# built once and tagged with a hash of those files and the base image, so
+# editing either produces a new tag and the old containers stop matching.
+
+DOCKERFILE_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'docker')
+REQUIREMENTS_FILE = os.path.join(DOCKERFILE_DIRECTORY, 'requirements.txt')
+DERIVED_IMAGE = 'edge-inference'
+READY_COMMAND = ['python3', '-c', 'import ultralytics, Crypto']  # Same probe as the Dockerfile HEALTHCHECK
+READY_TIMEOUT = 120
+READY_POLL_INTERVAL = 0.5
+
+
+class ContainerError(Exception):
+    pass
+
+
+def docker(*args, check=True):
+    result = subprocess.run(['sudo', 'docker'] + list(args), stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            universal_newlines=True)
+    if check and result.returncode != 0:
+        raise ContainerError(f"docker {' '.join(args[:2])} failed: {result.stderr.strip()}")
+    return result
+
+
+def derived_image_tag(base_image):
+    digest = hashlib.sha256(base_image.encode('utf-8'))
+    for file_name in sorted(os.listdir(DOCKERFILE_DIRECTORY)):
+        with open(os.path.join(DOCKERFILE_DIRECTORY, file_name), 'rb') as f:
+            digest.update(f.read())
+    return f'{DERIVED_IMAGE}:{digest.hexdigest()[:12]}'
+
+
+def ensure_image(base_image):
+    # Returns the derived image, building it the first time; falls back to the
+    # base image (dependencies installed at start) when the build fails
+    tag = derived_image_tag(base_image)
+    if docker('image', 'inspect', tag, check=False).returncode == 0:
+        return tag
+    print(f'Building inference image {tag} from {base_image}...')
+    started = time.monotonic()
+    result = docker('build', '-t', tag, '--build-arg', f'BASE_IMAGE={base_image}', DOCKERFILE_DIRECTORY, check=False)
+    if result.returncode != 0:
+        print(f'Could not build {tag}, using {base_image}: {result.stderr.strip()[-500:]}')
+        return base_image
+    print(f'Built {tag} in {time.monotonic() - started:.0f} s')
+    return tag
+
+
+def inspect(name):
+    result = docker('inspect', '--type', 'container', name, check=False)
+    if result.returncode != 0:
+        return None
+    return json.loads(result.stdout)[0]
+
+
+def mismatch(info, image, mounts):
+    # What keeps an existing container from being reused, or None
+    if info['Config']['Image'] != image:
+        return f"it runs {info['Config']['Image']}, not {image}"
+    existing = {(m['Source'], m['Destination']) for m in info.get('Mounts', [])}
+    for host_path, container_path in mounts:
+        if (os.path.abspath(host_path), container_path) not in existing:
+            return f'{host_path} is not mounted at {container_path}'
+    return None
+
+
+def is_ready(name, info=None):
+    health = info and info['State'].get('Health')
+    if health and health.get('Status') == 'unhealthy':
+        return False
+    return docker('exec', name, *READY_COMMAND, check=False).returncode == 0
+
+
+def wait_until_ready(name, timeout=None):
+    timeout = timeout or READY_TIMEOUT
+    give_up = time.monotonic() + timeout
+    while not is_ready(name):
+        if time.monotonic() > give_up:
+            raise ContainerError(f'Container {name} did not pass the readiness probe within {timeout} s')
+        time.sleep(READY_POLL_INTERVAL)
+
+
+def install_requirements(name):
+    with open(REQUIREMENTS_FILE) as f:
+        requirements = [line.strip() for line in f if line.strip() and not line.startswith('#')]
+    print(f"Installing {', '.join(requirements)} in {name}...")
+    docker('exec', name, 'pip3', 'install', *requirements)
+
+
+def ensure_container(name, image, mounts, run_options=()):
+    # mounts are (host path, container path) pairs. Returns once the container
+    # is ready; True when an existing container was reused.
+    started = time.monotonic()
+    info = inspect(name)
+    if info is not None:
+        reason = mismatch(info, image, mounts)
+        if reason is None and info['State']['Running']:
+            if is_ready(name, info):
+                print(f'Reusing running container {name} ({time.monotonic() - started:.1f} s)')
+                return True
+            reason = 'it failed the readiness probe'
+        elif reason is None:
+            print(f'Starting stopped container {name}...')
+            try:
+                docker('start', name)
+                wait_until_ready(name)
+                print(f'Container {name} is ready ({time.monotonic() - started:.1f} s)')
+                return True
+            except ContainerError as e:
+                reason = str(e)
+        print(f'Replacing container {name}: {reason}')
+        docker('rm', '-f', name)
+
+    print(f'Starting container {name} from {image}...')
+    volumes = []
+    for host_path, container_path in mounts:
+        volumes += ['-v', f'{os.path.abspath(host_path)}:{container_path}:rw']
+    docker('run', '-d', '--name', name, *run_options, *volumes, image, 'sleep', 'infinity')
+    if not image.startswith(DERIVED_IMAGE + ':'):
+        install_requirements(name)
+    wait_until_ready(name)
+    print(f'Container {name} is ready ({time.monotonic() - started:.1f} s)')
+    return False
+
+
+def stop_container(name):
+    docker('stop', name)
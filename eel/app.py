@@ -6,6 +6,13 @@ import struct
 import time
 from collections import Counter
 import ast
+import sys
+
+# The v2 framing and stream encryption are the servers' own modules, imported
+# from the repository root this app's directory sits in
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import stream_crypto
+import wire_protocol
 
 # Configuration
 DIRECTORY = '/Users/hendri/Documents/PROJECTS/portable_a3/eel/web/images'
@@ -13,6 +20,18 @@ SERVER_IP = '192.168.100.221'
 # SERVER_IP = '10.252.133.225'
 SERVER_PORT = 12345
 BUFFER_SIZE = 4096
+HELLO_TIMEOUT = 3  # Seconds to wait for a v2 server before falling back to one connection per image
+HELLO_RETRY_INTERVAL = 60  # Seconds on one connection per image before trying the v2 handshake again
+KEY_FILE = stream_crypto.KEY_FILE  # Next to this file: the AES key shared with the server, see stream_crypto.load_key
+ENCRYPT = True  # Ask the server to encrypt request and response frames; needs KEY_FILE
+LABELS_ONLY = True  # Only download detections and draw the boxes here instead of the annotated JPEG
+
+session = None
+legacy_until = 0  # time.monotonic() until which requests go one per connection
+next_request_id = 0
+session_key = None
+aes_key = None  # From KEY_FILE, loaded with the first session
+input_geometry = None  # Model input advertised by the server, the page crops and resizes to it
 
 @eel.expose
 def process_image(base64String):
@@ -24,34 +43,110 @@ def process_image(base64String):
         f.write(file_bytes)
     
     try:
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as client_socket:
-            client_socket.connect((SERVER_IP, SERVER_PORT))
-            send_file(client_socket, file_path)
-            
-            try:
-                received_file_path = receive_file(client_socket, DIRECTORY)
-                received_text = receive_text(client_socket)
-                received_text = ast.literal_eval(received_text)
-                received_text = list(set(received_text))
-
-                object_count = Counter(received_text)
-                output_string = ', '.join(f'{count} {obj}' for obj, count in object_count.items())
-
-                print(received_file_path)
-                print(output_string)
-                print(received_text)
-                return [received_file_path, output_string, received_text]
-                # return f'{received_file_path}, {received_text}'
-            except ConnectionError as e:
-                return f"Error receiving file or text: {e}"
-            except struct.error:
-                return "Received invalid data from server. The inference might have failed."
-    
+        if time.monotonic() >= legacy_until:
+            received_file_path, detections, draw = request_inference(file_path)
+        else:
+            received_file_path, detections, draw = request_inference_legacy(file_path)
+
+        object_count = detections['counts']
+        received_text = list(object_count)
+        output_string = ', '.join(f'{count} {obj}' for obj, count in object_count.items())
+
+        print(received_file_path)
+        print(output_string)
+        print(received_text)
+        # detections are only passed on when the page has to draw the boxes itself
+        return [received_file_path, output_string, received_text, detections if draw else None]
     except ConnectionRefusedError:
         return f"Could not connect to server at {SERVER_IP}:{SERVER_PORT}. Is the server running?"
+    except ConnectionError as e:
+        return f"Error receiving file or text: {e}"
+    except struct.error:
+        return "Received invalid data from server. The inference might have failed."
     except Exception as e:
         return f"An unexpected error occurred: {e}"
 
+def load_key():
+    global aes_key
+    if aes_key is None and ENCRYPT:
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), KEY_FILE)
+        aes_key = stream_crypto.load_key(path)
+        if aes_key is None:
+            print(f'No key file at {path}, sending images unencrypted')
+    return aes_key
+
+def open_session():
+    global session, legacy_until, input_geometry, session_key
+    key = load_key()
+    conn = socket.create_connection((SERVER_IP, SERVER_PORT))
+    try:
+        conn.settimeout(HELLO_TIMEOUT)
+        server_hello = wire_protocol.client_hello(conn, {'encryption': stream_crypto.CIPHER} if key else None)
+        conn.settimeout(None)
+        session = conn
+        input_geometry = server_hello.get('input')
+        session_key = key if server_hello.get('encryption') == stream_crypto.CIPHER else None
+    except (OSError, ConnectionError, ValueError, struct.error):
+        # Older servers only understand one image per connection, but this may
+        # as well be a server restarting, so try v2 again after a while
+        conn.close()
+        legacy_until = time.monotonic() + HELLO_RETRY_INTERVAL
+    return session
+
+@eel.expose
+def get_input_geometry():
+    if session is None and time.monotonic() >= legacy_until:
+        try:
+            open_session()
+        except OSError:
+            return None
+    return input_geometry
+
+def request_inference(file_path):
+    global session, next_request_id
+    with open(file_path, 'rb') as f:
+        body = f.read()
+
+    # Reuse the open connection; reconnect once if the server dropped it
+    for attempt in range(2):
+        if session is None and open_session() is None:
+            return request_inference_legacy(file_path)
+        next_request_id += 1
+        try:
+            header = {'name': os.path.basename(file_path), 'labels_only': LABELS_ONLY}
+            wire_protocol.send_frame(session, wire_protocol.REQUEST, next_request_id, header, body, session_key)
+            while True:
+                frame_type, request_id, header, response_body = wire_protocol.recv_frame(session, session_key)
+                if request_id == next_request_id:
+                    break
+            break
+        except (OSError, ConnectionError, ValueError):
+            session.close()
+            session = None
+            if attempt:
+                raise
+
+    if header.get('status') == 'busy':
+        raise ConnectionError(f"Server is busy, try again in {header.get('retry_after_ms', 0) / 1000:.1f} seconds")
+    if frame_type != wire_protocol.RESPONSE:
+        raise ConnectionError(f"Server failed to process the image: {header.get('status')}")
+    detections = header['detections']
+    if not response_body:
+        # Labels only: the page draws the boxes over the original photo
+        return file_path, detections, True
+    received_file_path = os.path.join(DIRECTORY, 'predicted_' + header['name'])
+    with open(received_file_path, 'wb') as f:
+        f.write(response_body)
+    return received_file_path, detections, False
+
+def request_inference_legacy(file_path):
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as client_socket:
+        client_socket.connect((SERVER_IP, SERVER_PORT))
+        send_file(client_socket, file_path)
+        received_file_path = receive_file(client_socket, DIRECTORY)
+        received_text = ast.literal_eval(receive_text(client_socket))
+        return received_file_path, {'counts': dict(Counter(received_text)), 'boxes': []}, False
+
 def send_file(conn, file_path):
     with open(file_path, 'rb') as f:
         file_data = f.read()
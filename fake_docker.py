@@ -0,0 +1,443 @@
+import argparse
+import ast
+import asyncio
+import hashlib
+import importlib
+import json
+import os
+import random
+import shutil
+import stat
+import sys
+import time
+import yolo_worker
+from inference_backends import StubModel
+
+# Stand-in for `sudo docker` and the YOLOv8 container, so the servers can be
+# run and load tested on any Linux box without a Jetson, Docker or a model.
+#
+# `serve` installs `sudo` and `docker` shims at the front of PATH, points the
+# server's SAVE_DIRECTORY and PORT at a scratch directory and runs its main().
+# The docker shim keeps container records in a state directory and builds a
+# root directory per container whose mount points are symlinks to the host
+# paths given with -v, so paths inside the container (/ultralytics/images,
+# /workspace, ...) resolve to the same files the server sees.
+#
+# `docker exec ... yolo_worker.py` runs the real worker protocol with a stub
+# model, `yolo detect predict ...` writes the same outputs as the CLI and
+# `yolo export ...` leaves a placeholder file where the export would be.
+# `docker build` and `docker inspect` keep enough state for the servers to
+# find and reuse their container; FAKE_DOCKER_UNHEALTHY fails its probes.
+# The stub sleeps FAKE_DOCKER_LATENCY seconds per forward pass plus
+# FAKE_DOCKER_PER_IMAGE per image, and returns a few deterministic boxes.
+#
+# To run a server by hand: eval "$(python3 fake_docker.py env --state DIR)"
+
+STATE_ENV = 'FAKE_DOCKER_STATE'
+LATENCY_ENV = 'FAKE_DOCKER_LATENCY'
+PER_IMAGE_ENV = 'FAKE_DOCKER_PER_IMAGE'
+UNHEALTHY_ENV = 'FAKE_DOCKER_UNHEALTHY'  # Set to make readiness probes (python3 -c ...) fail
+DEFAULT_WORKDIR = '/ultralytics'
+
+SHIMS = {
+    'docker': '#!/bin/sh\nexec "{python}" "{script}" docker "$@"\n',
+    'sudo': '#!/bin/sh\nexec "$@"\n',
+}
+
+
+def stub_model():
+    return StubModel(float(os.environ.get(LATENCY_ENV, '0.05')), float(os.environ.get(PER_IMAGE_ENV, '0.01')))
+
+
+# Container records
+
+def state_directory():
+    directory = os.environ.get(STATE_ENV)
+    if not directory:
+        sys.exit(f'{STATE_ENV} is not set')
+    os.makedirs(os.path.join(directory, 'containers'), exist_ok=True)
+    return directory
+
+
+def load_containers():
+    directory = os.path.join(state_directory(), 'containers')
+    containers = []
+    for file_name in sorted(os.listdir(directory)):
+        with open(os.path.join(directory, file_name)) as f:
+            containers.append(json.load(f))
+    return containers
+
+
+def save_container(container):
+    with open(os.path.join(state_directory(), 'containers', container['id'] + '.json'), 'w') as f:
+        json.dump(container, f)
+
+
+def remove_container(container):
+    os.remove(os.path.join(state_directory(), 'containers', container['id'] + '.json'))
+    shutil.rmtree(container_root(container), ignore_errors=True)
+
+
+def find_container(reference):
+    for container in load_containers():
+        if reference in (container['name'], container['id']) or (len(reference) >= 12 and container['id'].startswith(reference)):
+            return container
+    return None
+
+
+def container_root(container):
+    return os.path.join(state_directory(), 'roots', container['id'])
+
+
+def prepare_root(container):
+    # Mount points become symlinks to the host directories
+    root = container_root(container)
+    for host_path, container_path in container['mounts']:
+        link = root + container_path
+        if not os.path.lexists(link):
+            os.makedirs(os.path.dirname(link), exist_ok=True)
+            os.symlink(os.path.abspath(host_path), link)
+    workdir = root + container['workdir']
+    os.makedirs(workdir, exist_ok=True)
+    return root, workdir
+
+
+def to_host(root, path):
+    return root + path if path.startswith('/') else path
+
+
+# docker subcommands
+
+def docker_run(args):
+    container = {'id': hashlib.sha256(f'{time.time()}{random.random()}'.encode()).hexdigest(),
+                 'name': None, 'mounts': [], 'workdir': DEFAULT_WORKDIR, 'running': True, 'auto_remove': False}
+    detach = False
+    i = 0
+    while i < len(args) and args[i].startswith('-'):
+        option = args[i]
+        if option in ('-d', '--detach'):
+            detach = True
+        elif option == '--rm':
+            container['auto_remove'] = True
+        elif option in ('--name', '-v', '--volume', '-w', '--workdir', '-e', '--env'):
+            i += 1
+            if option == '--name':
+                container['name'] = args[i]
+            elif option in ('-v', '--volume'):
+                host_path, container_path = args[i].split(':')[:2]
+                container['mounts'].append([host_path, container_path])
+            elif option in ('-w', '--workdir'):
+                container['workdir'] = args[i]
+        i += 1
+    container['image'] = args[i]
+    command = args[i + 1:]
+    container['name'] = container['name'] or container['id'][:12]
+    if find_container(container['name']):
+        sys.stderr.write(f"Conflict. The container name \"/{container['name']}\" is already in use\n")
+        return 125
+    save_container(container)
+    if detach:
+        print(container['id'])
+        return 0
+    try:
+        return run_in_container(container, command)
+    finally:
+        if container['auto_remove']:
+            remove_container(container)
+
+
+def docker_ps(args):
+    name = None
+    for i, option in enumerate(args):
+        if option in ('-f', '--filter') and args[i + 1].startswith('name='):
+            name = args[i + 1][len('name='):]
+    show_all = any(option in ('-a', '-aq', '--all') for option in args)
+    for container in load_containers():
+        if (name is None or name in container['name']) and (show_all or container['running']):
+            print(container['id'][:12])
+    return 0
+
+
+def docker_rm(args):
+    for reference in [arg for arg in args if not arg.startswith('-')]:
+        container = find_container(reference)
+        if container is None:
+            sys.stderr.write(f'No such container: {reference}\n')
+            return 1
+        remove_container(container)
+        print(reference)
+    return 0
+
+
+def docker_stop(args):
+    for reference in [arg for arg in args if not arg.startswith('-')]:
+        container = find_container(reference)
+        if container is None:
+            sys.stderr.write(f'No such container: {reference}\n')
+            return 1
+        if container['auto_remove']:
+            remove_container(container)
+        else:
+            container['running'] = False
+            save_container(container)
+        print(reference)
+    return 0
+
+
+def docker_start(args):
+    for reference in [arg for arg in args if not arg.startswith('-')]:
+        container = find_container(reference)
+        if container is None:
+            sys.stderr.write(f'No such container: {reference}\n')
+            return 1
+        container['running'] = True
+        save_container(container)
+        print(reference)
+    return 0
+
+
+def docker_inspect(args):
+    references = [arg for i, arg in enumerate(args) if not arg.startswith('-') and args[i - 1] != '--type']
+    found = []
+    for reference in references:
+        container = find_container(reference)
+        if container is None:
+            print('[]')
+            sys.stderr.write(f'Error: No such object: {reference}\n')
+            return 1
+        found.append({
+            'Id': container['id'],
+            'Name': '/' + container['name'],
+            'Config': {'Image': container['image']},
+            'State': {'Running': container['running'], 'Status': 'running' if container['running'] else 'exited'},
+            'Mounts': [{'Type': 'bind', 'Source': os.path.abspath(host_path), 'Destination': container_path, 'RW': True}
+                       for host_path, container_path in container['mounts']],
+        })
+    print(json.dumps(found, indent=4))
+    return 0
+
+
+def images_path():
+    return os.path.join(state_directory(), 'images.json')
+
+
+def load_images():
+    if not os.path.exists(images_path()):
+        return {}
+    with open(images_path()) as f:
+        return json.load(f)
+
+
+def docker_image(args):
+    if args[:1] != ['inspect']:
+        sys.stderr.write(f"fake docker: unsupported command image {' '.join(args)}\n")
+        return 1
+    images = load_images()
+    for reference in args[1:]:
+        if reference not in images:
+            print('[]')
+            sys.stderr.write(f'Error: No such image: {reference}\n')
+            return 1
+    print(json.dumps([images[reference] for reference in args[1:]], indent=4))
+    return 0
+
+
+def docker_build(args):
+    tags = [args[i + 1] for i, arg in enumerate(args) if arg in ('-t', '--tag')]
+    build_args = [args[i + 1] for i, arg in enumerate(args) if arg == '--build-arg']
+    context = args[-1]
+    if not os.path.exists(os.path.join(context, 'Dockerfile')):
+        sys.stderr.write(f'unable to prepare context: {context}/Dockerfile not found\n')
+        return 1
+    images = load_images()
+    for tag in tags:
+        images[tag] = {'Id': 'sha256:' + hashlib.sha256(tag.encode()).hexdigest(), 'RepoTags': [tag], 'BuildArgs': build_args}
+        print(f'Successfully tagged {tag}')
+    with open(images_path(), 'w') as f:
+        json.dump(images, f)
+    return 0
+
+
+def docker_cp(args):
+    def resolve(spec):
+        if ':' in spec and not spec.startswith('/'):
+            reference, path = spec.split(':', 1)
+            container = find_container(reference)
+            if container is None:
+                raise FileNotFoundError(f'No such container: {reference}')
+            root, _ = prepare_root(container)
+            return to_host(root, path)
+        return spec
+
+    source, destination = resolve(args[-2]), resolve(args[-1])
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    shutil.copy(source, destination)
+    return 0
+
+
+def docker_exec(args):
+    i = 0
+    while args[i].startswith('-'):
+        i += 2 if args[i] in ('-w', '--workdir', '-e', '--env') else 1
+    container = find_container(args[i])
+    if container is None or not container['running']:
+        sys.stderr.write(f'Error: No such container: {args[i]}\n')
+        return 1
+    return run_in_container(container, args[i + 1:])
+
+
+def run_in_container(container, command):
+    root, workdir = prepare_root(container)
+    os.chdir(workdir)
+    if any(arg.endswith('yolo_worker.py') for arg in command):
+        return run_worker(command)
+    if command[:1] == ['yolo']:
+        return run_yolo_cli(root, command[1:])
+    if command[:2] == ['sleep', 'infinity']:
+        return 0
+    if command[:2] == ['python3', '-c']:
+        return 1 if os.environ.get(UNHEALTHY_ENV) else 0
+    # Anything else (pip installs, shells) is accepted and ignored
+    sys.stderr.write(f"fake docker: ignoring {' '.join(command)}\n")
+    return 0
+
+
+def run_worker(command):
+    model_path = command[command.index('--model') + 1] if '--model' in command else 'images/best_v8n.engine'
+    stdout = sys.stdout.buffer
+    sys.stdout = sys.stderr
+    version = 'stub-' + hashlib.sha256(model_path.encode()).hexdigest()[:11]
+    yolo_worker.serve(stub_model(), model_path, sys.stdin.buffer, stdout, version)
+    return 0
+
+
+def run_yolo_cli(root, args):
+    import cv2
+    options = dict(arg.split('=', 1) if '=' in arg else (arg, 'True') for arg in args if arg not in ('detect', 'predict', 'export'))
+    if 'export' in args:
+        return run_yolo_export(root, options)
+    source = to_host(root, options['source'])
+    project = to_host(root, options.get('project', 'runs/detect'))
+    image = cv2.imread(source)
+    if image is None:
+        sys.stderr.write(f'FileNotFoundError: {source} does not exist\n')
+        return 1
+    result = stub_model().predict([image])[0]
+    _, rows = yolo_worker.save_prediction(result, source, project, options.get('save_txt') == 'True',
+                                          options.get('save_conf') == 'True')
+    print(f'image 1/1 {source}: {len(rows)} detections')
+    return 0
+
+
+def run_yolo_export(root, options):
+    # A placeholder file where the export would be; the stub worker never reads it
+    source = to_host(root, options['model'])
+    if not os.path.exists(source):
+        sys.stderr.write(f'FileNotFoundError: {source} does not exist\n')
+        return 1
+    extension = '.engine' if options.get('format') == 'engine' else '.onnx'
+    exported = os.path.splitext(source)[0] + extension
+    with open(exported, 'w') as f:
+        f.write(f"fake docker {options.get('format', 'torchscript')} export of {os.path.basename(source)}\n")
+    print(f'Export complete, saved as {exported}')
+    return 0
+
+
+DOCKER_COMMANDS = {
+    'run': docker_run,
+    'ps': docker_ps,
+    'rm': docker_rm,
+    'stop': docker_stop,
+    'cp': docker_cp,
+    'exec': docker_exec,
+    'start': docker_start,
+    'inspect': docker_inspect,
+    'image': docker_image,
+    'build': docker_build,
+}
+
+
+def docker(args):
+    if not args or args[0] not in DOCKER_COMMANDS:
+        sys.stderr.write(f"fake docker: unsupported command {' '.join(args)}\n")
+        return 1
+    return DOCKER_COMMANDS[args[0]](args[1:])
+
+
+# Running the servers
+
+def install_shims(state):
+    # Returns the environment that sends `sudo docker` to this script
+    shim_directory = os.path.join(state, 'bin')
+    os.makedirs(shim_directory, exist_ok=True)
+    for name, template in SHIMS.items():
+        path = os.path.join(shim_directory, name)
+        with open(path, 'w') as f:
+            f.write(template.format(python=sys.executable, script=os.path.abspath(__file__)))
+        os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    return {'PATH': shim_directory + os.pathsep + os.environ.get('PATH', ''), STATE_ENV: os.path.abspath(state)}
+
+
+def serve(args):
+    work_directory = os.path.abspath(args.work_dir)
+    save_directory = os.path.join(work_directory, 'images')
+    os.makedirs(save_directory, exist_ok=True)
+    os.environ.update(install_shims(os.path.join(work_directory, 'docker')))
+    os.environ[LATENCY_ENV] = str(args.latency)
+    os.environ[PER_IMAGE_ENV] = str(args.per_image)
+    os.chdir(work_directory)  # The servers use paths relative to the directory above SAVE_DIRECTORY
+
+    server = importlib.import_module(args.server)
+    server.SAVE_DIRECTORY = save_directory
+    server.PORT = args.port
+    if hasattr(server, 'CACHE_DIRECTORY'):
+        server.CACHE_DIRECTORY = os.path.join(save_directory, 'cache')
+    for assignment in args.set:
+        name, value = assignment.split('=', 1)
+        if not hasattr(server, name):
+            sys.exit(f'{args.server} has no constant {name}')
+        setattr(server, name, ast.literal_eval(value))
+
+    sys.argv = [server.__file__]  # Servers that parse arguments see none of ours
+
+    if asyncio.iscoroutinefunction(server.main):
+        loop = asyncio.get_event_loop()
+        main_task = asyncio.ensure_future(server.main())
+        try:
+            loop.run_until_complete(main_task)
+        except KeyboardInterrupt:
+            main_task.cancel()
+            loop.run_until_complete(asyncio.sleep(0.1))
+    else:
+        server.main()
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == 'docker':
+        sys.exit(docker(sys.argv[2:]))
+
+    parser = argparse.ArgumentParser(description='Run the edge servers against a fake Docker and a stub YOLOv8 model')
+    commands = parser.add_subparsers(dest='command')
+    serve_parser = commands.add_parser('serve', help='Run a server module under the fake docker')
+    serve_parser.add_argument('server', help='Server module, e.g. server_opt5 or server_opt_gbs')
+    serve_parser.add_argument('--port', type=int, default=12345)
+    serve_parser.add_argument('--work-dir', required=True, help='Scratch directory for images and container state')
+    serve_parser.add_argument('--latency', type=float, default=0.05, help='Seconds per forward pass')
+    serve_parser.add_argument('--per-image', type=float, default=0.01, help='Extra seconds per image in a batch')
+    serve_parser.add_argument('--set', action='append', default=[], metavar='NAME=VALUE',
+                              help='Override a server constant, e.g. --set BATCH_MAX_SIZE=4')
+    env_parser = commands.add_parser('env', help='Print shell exports that put the fake docker on PATH')
+    env_parser.add_argument('--state', required=True)
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        serve(args)
+    elif args.command == 'env':
+        for name, value in install_shims(args.state).items():
+            print(f"export {name}='{value}'")
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
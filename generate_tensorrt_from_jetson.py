@@ -1,29 +1,12 @@
-import subprocess
+import build_model
 
 SAVE_DIRECTORY = r'/home/jetson/edge_server/images'
-container_name = 'ultralytics/ultralytics:latest-jetson-jetpack4'
-
-# Command to get docker container ID
-command_get_container_id = [
-    'sudo', 'docker', 'ps', '-aq', '-f', f'name={container_name}'
-]
-
-# Run the command to get the container ID
-result = subprocess.run(command_get_container_id, capture_output=True, text=True)
-container_id = result.stdout.strip()
-
-# Command to run docker and mount the volume
-command_docker_run = [
-    'sudo', 'docker', 'run', '-v', f'{SAVE_DIRECTORY}:/ultralytics/images:rw', container_id
-]
-
-# Run the docker mount command
-subprocess.run(command_docker_run)
-
-# Command to export the model using YOLO
-command_export_tensorrt = [
-    'yolo', 'export', 'model=best_v8n.pt', 'format=engine'
-]
-
-# Run the export command
-subprocess.run(command_export_tensorrt)
\ No newline at end of file
+DOCKER_IMAGE = 'ultralytics/ultralytics:latest-jetson-jetpack4'
+WEIGHTS = 'best_v8n.pt'  # In SAVE_DIRECTORY
+
+# The export has to run inside the container, where TensorRT and ultralytics
+# are installed. This builds the FP16 engine in a throwaway container from the
+# inference image and leaves it in the artifact cache (SAVE_DIRECTORY/artifacts),
+# where the servers pick it up; build_model.py has the other formats.
+engine_path = build_model.ensure_artifact(SAVE_DIRECTORY, WEIGHTS, 'engine', 640, 'fp16', image=DOCKER_IMAGE)
+print(f'TensorRT engine: {engine_path}')
@@ -0,0 +1,362 @@
+import ast
+import hashlib
+import itertools
+import json
+import os
+import random
+import subprocess
+import threading
+import time
+import yolo_worker
+from yolo_client import InferenceBackend, YoloClient, YoloWorkerError
+
+# Inference backends the servers can select with INFERENCE_BACKEND. They all
+# answer the yolo_worker.py requests (predict, predict_bytes, ping) and so
+# expose the same predict(), predict_batch() and predict_bytes() calls:
+#
+#   docker       persistent yolo_worker.py inside the container (YoloClient)
+#   docker-cli   one `yolo detect predict` per image, as server_opt2.py does
+#   ultralytics  the ultralytics YOLO model loaded in the server process
+#   onnx         ONNX Runtime on the CPU, for x86 boxes without a GPU
+#   onnx-int8    the same with the INT8 model from quantize_onnx.py
+#   stub         deterministic boxes with a configurable delay, no model
+
+BACKENDS = ('docker', 'docker-cli', 'ultralytics', 'onnx', 'onnx-int8', 'stub')
+CONTAINER_BACKENDS = ('docker', 'docker-cli')
+
+CONF_THRESHOLD = 0.25
+IOU_THRESHOLD = 0.7
+MAX_DETECTIONS = 300
+STUB_NUM_CLASSES = 10
+
+
+class ResultTensor(list):
+    def tolist(self):
+        return list(self)
+
+
+class ResultBoxes:
+    def __init__(self, rows):
+        self.cls = ResultTensor(row[0] for row in rows)
+        self.conf = ResultTensor(row[1] for row in rows)
+        self.xywhn = ResultTensor(row[2:] for row in rows)
+
+
+class DetectionResult:
+    # The parts of an ultralytics Results object that yolo_worker.py uses,
+    # built from [class id, confidence, x, y, w, h] rows
+    def __init__(self, image, rows, names=None):
+        self.image = image
+        self.boxes = ResultBoxes(rows)
+        self.names = names or {}
+
+    def plot(self):
+        import cv2
+        image = self.image.copy()
+        h, w = image.shape[:2]
+        for cls, conf, (x, y, bw, bh) in zip(self.boxes.cls, self.boxes.conf, self.boxes.xywhn):
+            top_left = (int((x - bw / 2) * w), int((y - bh / 2) * h))
+            cv2.rectangle(image, top_left, (int((x + bw / 2) * w), int((y + bh / 2) * h)), (0, 0, 255), 2)
+            label = f'{self.names.get(cls, cls)} {conf:.2f}'
+            cv2.putText(image, label, (top_left[0], max(top_left[1] - 4, 12)),
+                        cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 255), 1)
+        return image
+
+
+class StubModel:
+    max_batch = None
+
+    def __init__(self, latency=0.0, per_image=0.0):
+        self.latency = latency
+        self.per_image = per_image
+
+    def detect(self, image):
+        # Same boxes for the same picture, seeded from a coarse sample of its pixels
+        h, w = image.shape[:2]
+        sample = image[::max(1, h // 16), ::max(1, w // 16)].tobytes()
+        rng = random.Random(hashlib.md5(sample).hexdigest())
+        rows = []
+        for _ in range(rng.randint(0, 4)):
+            bw, bh = rng.uniform(0.05, 0.4), rng.uniform(0.05, 0.4)
+            rows.append([rng.randrange(STUB_NUM_CLASSES), round(rng.uniform(0.25, 0.99), 3),
+                         rng.uniform(bw / 2, 1 - bw / 2), rng.uniform(bh / 2, 1 - bh / 2), bw, bh])
+        return rows
+
+    def predict(self, images, verbose=False):
+        time.sleep(self.latency + self.per_image * len(images))
+        return [DetectionResult(image, self.detect(image)) for image in images]
+
+
+class OnnxModel:
+    # YOLOv8 detection model exported with `yolo export format=onnx`, run with
+    # ONNX Runtime on the CPU. Images are letterboxed to the model input and
+    # the raw (4 + classes) x anchors output is decoded with NMS on the host.
+    def __init__(self, model_path, threads=0, conf_threshold=CONF_THRESHOLD):
+        import onnxruntime
+        self.conf_threshold = conf_threshold
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        # One run at a time per model, so all the threads go to the operators
+        options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+        options.inter_op_num_threads = 1
+        self.threads = threads or tuned_threads(model_path)
+        if self.threads:
+            options.intra_op_num_threads = self.threads
+        self.session = onnxruntime.InferenceSession(model_path, options, providers=['CPUExecutionProvider'])
+        model_input = self.session.get_inputs()[0]
+        self.input_name = model_input.name
+        self.input_size = model_input.shape[2] if isinstance(model_input.shape[2], int) else 640
+        # Exports without dynamic=True only take one image per run
+        self.max_batch = model_input.shape[0] if isinstance(model_input.shape[0], int) else None
+        names = self.session.get_modelmeta().custom_metadata_map.get('names')
+        self.names = ast.literal_eval(names) if names else {}
+
+    def prepare(self, image):
+        import cv2
+        import numpy as np
+        import preprocess
+        boxed, transform = preprocess.letterbox(image, self.input_size)
+        blob = cv2.cvtColor(boxed, cv2.COLOR_BGR2RGB).transpose(2, 0, 1)
+        return np.ascontiguousarray(blob, dtype=np.float32) / 255.0, transform
+
+    def decode(self, output, transform):
+        import cv2
+        import numpy as np
+        predictions = output.T
+        class_ids = predictions[:, 4:].argmax(axis=1)
+        scores = predictions[np.arange(len(predictions)), 4 + class_ids]
+        keep = scores > self.conf_threshold
+        predictions, class_ids, scores = predictions[keep], class_ids[keep], scores[keep]
+        if not len(predictions):
+            return []
+
+        # Class-aware NMS in one call by moving every class to its own region
+        cx, cy, w, h = predictions[:, 0], predictions[:, 1], predictions[:, 2], predictions[:, 3]
+        offset = class_ids * (self.input_size * 2)
+        corners = np.stack([cx - w / 2 + offset, cy - h / 2, w, h], axis=1)
+        indices = cv2.dnn.NMSBoxes(corners.tolist(), scores.tolist(), self.conf_threshold, IOU_THRESHOLD)
+        indices = np.array(indices).reshape(-1)[:MAX_DETECTIONS]
+
+        scale, (pad_x, pad_y), (source_w, source_h) = transform['scale'], transform['offset'], transform['source_size']
+        rows = []
+        for i in indices:
+            rows.append([int(class_ids[i]), round(float(scores[i]), 3),
+                         (float(cx[i]) - pad_x) / scale / source_w, (float(cy[i]) - pad_y) / scale / source_h,
+                         float(w[i]) / scale / source_w, float(h[i]) / scale / source_h])
+        return rows
+
+    def predict(self, images, verbose=False):
+        import numpy as np
+        prepared = [self.prepare(image) for image in images]
+        step = self.max_batch or len(prepared)
+        outputs = []
+        for start in range(0, len(prepared), step):
+            blobs = np.stack([blob for blob, _ in prepared[start:start + step]])
+            outputs.extend(self.session.run(None, {self.input_name: blobs})[0])
+        return [DetectionResult(image, self.decode(output, transform), self.names)
+                for image, output, (_, transform) in zip(images, outputs, prepared)]
+
+
+class InProcessBackend(InferenceBackend):
+    # Runs the yolo_worker.py handlers in this process. Paths in requests
+    # (images/..., images/pred) are relative to the server's working
+    # directory, the same directory the container mounts as /ultralytics/images.
+    def __init__(self, model_path):
+        self.model_path = model_path
+        self.model = None
+        self.lock = threading.Lock()
+
+    def load_model(self):
+        raise NotImplementedError
+
+    def start(self):
+        if self.model is None:
+            self.model = self.load_model()
+            self.model_version = yolo_worker.model_version(self.model_path)
+            self.max_batch = yolo_worker.model_max_batch(self.model, self.model_path)
+            print(f'{type(self).__name__} ready: {self.model_path} ({self.model_version})')
+
+    def stop(self):
+        self.model = None
+
+    def request(self, header, payload=b''):
+        if self.model is None:
+            raise YoloWorkerError('Backend is not started')
+        # Models are not safe to call from several threads at once
+        with self.lock:
+            return yolo_worker.handle_message(self.model, header, payload, self.max_batch)
+
+
+class UltralyticsBackend(InProcessBackend):
+    def load_model(self):
+        from ultralytics import YOLO
+        return YOLO(self.model_path, task='detect')
+
+
+class OnnxRuntimeBackend(InProcessBackend):
+    def __init__(self, model_path, threads=0):
+        super().__init__(model_path)
+        self.threads = threads
+
+    def load_model(self):
+        return OnnxModel(self.model_path, self.threads)
+
+
+class StubBackend(InProcessBackend):
+    def __init__(self, model_path, latency=0.0, per_image=0.0):
+        super().__init__(model_path)
+        self.latency = latency
+        self.per_image = per_image
+
+    def load_model(self):
+        return StubModel(self.latency, self.per_image)
+
+    def start(self):
+        if self.model is None:
+            self.model = self.load_model()
+            self.model_version = 'stub-' + hashlib.sha256(self.model_path.encode()).hexdigest()[:11]
+            self.max_batch = self.model.max_batch
+
+
+class DockerCliBackend(InferenceBackend):
+    # The original path: a `yolo detect predict` process per image, which
+    # loads the model every time. Kept as the baseline the others are measured
+    # against. Uploads are written under images/ so the container can read them.
+    NEEDS_CONTAINER = True
+    SCRATCH_DIRECTORY = 'images/cli'
+    PROJECT = 'images/pred_cli'
+
+    def __init__(self, container_name, model_path):
+        self.container_name = container_name
+        self.model_path = model_path
+        self.counter = itertools.count()
+
+    def start(self):
+        self.model_version = yolo_worker.model_version(self.model_path) if os.path.exists(self.model_path) else os.path.basename(self.model_path)
+
+    def run_cli(self, source, project):
+        command = [
+            'sudo', 'docker', 'exec', self.container_name, 'yolo', 'detect', 'predict',
+            f'model={self.model_path}', f'source={source}', f'project={project}',
+            'exist_ok=True', 'save_txt=True', 'save_conf=True'
+        ]
+        subprocess.run(command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        pure_name = os.path.splitext(os.path.basename(source))[0]
+        rows = []
+        labels_path = os.path.join(project, 'predict', 'labels', pure_name + '.txt')
+        if os.path.exists(labels_path):
+            with open(labels_path) as f:
+                for line in f:
+                    values = line.split()
+                    rows.append([int(values[0]), round(float(values[5]), 3)] + [round(float(v), 4) for v in values[1:5]])
+            os.remove(labels_path)  # exist_ok=True appends to an existing labels file
+        return pure_name, rows
+
+    def predict_sources(self, sources, project):
+        results = []
+        for source in sources:
+            try:
+                pure_name, rows = self.run_cli(source, project)
+                results.append({'ok': True, 'name': pure_name, 'labels': [row[0] for row in rows], 'boxes': rows})
+            except subprocess.CalledProcessError as e:
+                results.append({'ok': False, 'error': e.stderr.strip() or str(e)})
+        return results
+
+    def request(self, header, payload=b''):
+        op = header.get('op')
+        if op == 'ping':
+            return {'ok': True}, b''
+        if op == 'predict':
+            return {'ok': True, 'results': self.predict_sources(header['sources'], header.get('project', 'images/pred'))}, b''
+        if op != 'predict_bytes':
+            return {'ok': False, 'error': f'Unknown op: {op}'}, b''
+
+        import cv2
+        import numpy as np
+        os.makedirs(self.SCRATCH_DIRECTORY, exist_ok=True)
+        sources = []
+        offset = 0
+        for item in header['images']:
+            data = payload[offset:offset + item['size']]
+            offset += item['size']
+            source = os.path.join(self.SCRATCH_DIRECTORY, f'{os.getpid()}_{next(self.counter)}.jpg')
+            if item.get('shape'):
+                cv2.imwrite(source, np.frombuffer(data, dtype=np.uint8).reshape(item['shape']))
+            else:
+                with open(source, 'wb') as f:
+                    f.write(data)
+            sources.append(source)
+
+        results = []
+        blobs = []
+        try:
+            for item, source, result in zip(header['images'], sources, self.predict_sources(sources, self.PROJECT)):
+                blob = b''
+                predicted_path = os.path.join(self.PROJECT, 'predict', os.path.basename(source))
+                if result['ok'] and item.get('render', True) and os.path.exists(predicted_path):
+                    with open(predicted_path, 'rb') as f:
+                        blob = f.read()
+                if os.path.exists(predicted_path):
+                    os.remove(predicted_path)
+                result.pop('name', None)
+                result['size'] = len(blob)
+                results.append(result)
+                blobs.append(blob)
+        finally:
+            for source in sources:
+                os.remove(source)
+        return {'ok': True, 'results': results}, b''.join(blobs)
+
+
+def warm_up(backend, count, size=640):
+    # The first inferences pay for CUDA context creation, TensorRT and ONNX
+    # Runtime allocations and lazy imports; get them done before serving
+    if count <= 0:
+        return
+    import numpy as np
+    image = np.random.RandomState(0).randint(0, 256, (size, size, 3), dtype=np.uint8)
+    started = time.monotonic()
+    for i in range(count):
+        backend.predict_bytes([(f'warmup_{i}.jpg', image, False)])
+    print(f'Warm-up: {count} inferences in {time.monotonic() - started:.2f} s')
+
+
+def onnx_model_path(model_path):
+    # MODEL_PATH usually names the TensorRT engine; the ONNX export sits next to it
+    return model_path if model_path.endswith('.onnx') else os.path.splitext(model_path)[0] + '.onnx'
+
+
+def int8_model_path(model_path):
+    # Built artifacts already name the precision (...-int8.onnx)
+    if model_path.endswith('int8.onnx'):
+        return model_path
+    return os.path.splitext(onnx_model_path(model_path))[0] + '.int8.onnx'
+
+
+def runtime_settings_path(model_path):
+    # Written by `quantize_onnx.py tune` next to the model
+    return os.path.splitext(model_path)[0] + '.runtime.json'
+
+
+def tuned_threads(model_path):
+    try:
+        with open(runtime_settings_path(model_path)) as f:
+            return json.load(f).get('intra_op_threads', 0)
+    except (OSError, ValueError):
+        return 0
+
+
+def create_backend(name, container_name, model_path, **options):
+    if name == 'docker':
+        return YoloClient(container_name, model_path)
+    if name == 'docker-cli':
+        return DockerCliBackend(container_name, model_path)
+    if name == 'ultralytics':
+        return UltralyticsBackend(model_path)
+    if name == 'onnx':
+        return OnnxRuntimeBackend(onnx_model_path(model_path), **options)
+    if name == 'onnx-int8':
+        return OnnxRuntimeBackend(int8_model_path(model_path), **options)
+    if name == 'stub':
+        return StubBackend(model_path, **options)
+    raise ValueError(f'Unknown inference backend {name!r}, expected one of {", ".join(BACKENDS)}')
@@ -0,0 +1,244 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+# Counters, gauges and histograms for the servers, rendered in the Prometheus
+# text format. The servers answer `GET /metrics` on their normal port: an
+# HTTP request starts with b'GET ', which is neither MAGIC nor a plausible
+# legacy file name length, so it can be told apart from the first 4 bytes.
+#
+# Request stages: receive (upload body, including decryption), preprocess,
+# queue (waiting for a batch), inference (the batch's forward pass),
+# postprocess (box mapping and response header) and send.
+
+HTTP_PREFIX = b'GET '
+MAX_HTTP_HEADER_SIZE = 8192
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+STAGES = ('receive', 'preprocess', 'queue', 'inference', 'postprocess', 'send')
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"')) for name, value in pairs) + '}'
+
+
+def format_value(value):
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Metric:
+    TYPE = None
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.lock = threading.Lock()
+        self.values = {}
+        self.function = None
+
+    def key(self, labels):
+        return tuple(labels.get(name, '') for name in self.label_names)
+
+    def set_function(self, function):
+        # Read the value when scraped, e.g. a queue length or a count kept elsewhere
+        self.function = function
+
+    def render(self):
+        if self.function is not None:
+            with self.lock:
+                self.values[()] = self.function()
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.TYPE}']
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f'{self.name}{format_labels(self.label_names, key)} {format_value(value)}')
+        return lines
+
+
+class Counter(Metric):
+    TYPE = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    TYPE = 'gauge'
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    TYPE = 'histogram'
+
+    def __init__(self, name, documentation, label_names=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.values[key] = (counts, total + value)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.TYPE}']
+        with self.lock:
+            for key, (counts, total) in sorted(self.values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float('inf'),), counts):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else format_value(bound)
+                    lines.append(f"{self.name}_bucket{format_labels(self.label_names, key, [('le', le)])} {cumulative}")
+                lines.append(f'{self.name}_sum{format_labels(self.label_names, key)} {format_value(total)}')
+                lines.append(f'{self.name}_count{format_labels(self.label_names, key)} {cumulative}')
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, label_names=()):
+        return self.add(Counter(name, documentation, label_names))
+
+    def gauge(self, name, documentation, label_names=()):
+        return self.add(Gauge(name, documentation, label_names))
+
+    def histogram(self, name, documentation, label_names=(), buckets=LATENCY_BUCKETS):
+        return self.add(Histogram(name, documentation, label_names, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+REQUESTS = REGISTRY.counter('edge_requests_total', 'Requests answered, by protocol and outcome', ('protocol', 'status'))
+REQUEST_SECONDS = REGISTRY.histogram('edge_request_seconds', 'Time from the first upload byte to the response sent', ('protocol',))
+STAGE_SECONDS = REGISTRY.histogram('edge_stage_seconds', 'Time spent in each request stage', ('stage',))
+QUEUE_WAIT_SECONDS = REGISTRY.histogram('edge_queue_wait_seconds', 'Time waiting for an inference batch, by priority class', ('priority',))
+DEADLINE_EXPIRED = REGISTRY.counter('edge_deadline_expired_total', 'Requests dropped before inference because their deadline passed', ('priority',))
+RATE_LIMITED = REGISTRY.counter('edge_rate_limited_total', 'Uploads refused because the device was over its rate limit')
+TIMEOUTS = REGISTRY.counter('edge_timeouts_total', 'Connections closed because a read or write stalled, by phase', ('phase',))
+ABANDONED = REGISTRY.counter('edge_abandoned_total', 'Requests given up because the client went away before the answer')
+ACTIVE_CLIENTS = REGISTRY.gauge('edge_active_clients', 'Devices with uploads waiting for inference')
+BATCH_SIZE = REGISTRY.histogram('edge_batch_size', 'Images per inference batch', buckets=(1, 2, 4, 8, 16, 32))
+IN_FLIGHT = REGISTRY.gauge('edge_in_flight_requests', 'Uploads received and not answered yet')
+QUEUE_DEPTH = REGISTRY.gauge('edge_queue_depth', 'Uploads waiting for an inference batch')
+QUEUED_BYTES = REGISTRY.gauge('edge_queued_bytes', 'Upload bytes waiting for an inference batch')
+RECEIVED_BYTES = REGISTRY.counter('edge_received_bytes_total', 'Upload bytes received')
+SENT_BYTES = REGISTRY.counter('edge_sent_bytes_total', 'Response bytes sent')
+CACHE_HITS = REGISTRY.counter('edge_cache_hits_total', 'Requests answered without running inference')
+TRACE_DROPPED = REGISTRY.counter('edge_trace_events_dropped_total', 'Trace events dropped because the trace queue was full')
+
+
+class RequestTimer:
+    # Stage durations of one request, added to STAGE_SECONDS when it finishes
+    # and recorded as the "finish" event of its trace, if any
+    def __init__(self, trace=None):
+        self.trace = trace
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.cached = False  # Answered without queueing for inference
+        self.priority = 'normal'  # Scheduling class, see micro_batcher.PRIORITIES
+        self.queued = None
+
+    def enqueue(self):
+        # Called when the upload is put on the batch queue
+        self.queued = time.perf_counter()
+
+    def batched(self, started, finished):
+        # Called by the inference worker with the batch's forward pass times
+        self.record('queue', started - self.queued)
+        self.record('inference', finished - started)
+        QUEUE_WAIT_SECONDS.observe(started - self.queued, priority=self.priority)
+
+    def expired(self):
+        # Called when the request was dropped at its deadline instead of batched
+        waited = time.perf_counter() - self.queued
+        self.record('queue', waited)
+        QUEUE_WAIT_SECONDS.observe(waited, priority=self.priority)
+        DEADLINE_EXPIRED.inc(priority=self.priority)
+
+    def abandoned(self):
+        # Called when the client went away before its answer was sent
+        if self.queued is not None and 'queue' not in self.stages:
+            self.record('queue', time.perf_counter() - self.queued)
+        ABANDONED.inc()
+
+    def record(self, stage, seconds):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - started)
+
+    def finish(self, protocol, status):
+        elapsed = time.perf_counter() - self.started
+        REQUESTS.inc(protocol=protocol, status=status)
+        REQUEST_SECONDS.observe(elapsed, protocol=protocol)
+        for stage, seconds in self.stages.items():
+            STAGE_SECONDS.observe(seconds, stage=stage)
+        if self.trace is not None:
+            # Failed requests are always traced, whatever the sample rate
+            record = self.trace.event if status in ('ok', 'busy', 'rate_limited') else self.trace.error
+            record('finish', protocol=protocol, status=status, total_ms=round(1000 * elapsed, 2),
+                   stages_ms=self.milliseconds(), cached=self.cached)
+
+    def milliseconds(self):
+        return {stage: round(1000 * seconds, 2) for stage, seconds in self.stages.items()}
+
+
+def http_response(request_head):
+    # request_head is the request line and headers, without the body
+    try:
+        method, path = request_head.split(b'\r\n', 1)[0].decode('latin-1').split(' ')[:2]
+    except ValueError:
+        method, path = None, None
+    if method == 'GET' and path.split('?')[0] == '/metrics':
+        status, content_type, body = '200 OK', CONTENT_TYPE, REGISTRY.render().encode('utf-8')
+    else:
+        status, content_type, body = '404 Not Found', 'text/plain; charset=utf-8', b'Only GET /metrics is served here\n'
+    head = f'HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n'
+    return head.encode('latin-1') + body
+
+
+def read_http_head(conn, prefix=HTTP_PREFIX):
+    # Blocking sockets: reads the rest of the request head after the sniffed prefix
+    data = bytearray(prefix)
+    while b'\r\n\r\n' not in data:
+        if len(data) > MAX_HTTP_HEADER_SIZE:
+            raise ConnectionError('HTTP request head too large')
+        chunk = conn.recv(1024)
+        if not chunk:
+            break
+        data += chunk
+    return bytes(data)
@@ -0,0 +1,341 @@
+import asyncio
+import heapq
+import itertools
+import queue
+import threading
+import time
+import json
+
+# Collects queued items into batches of up to max_batch_size, waiting at most
+# max_wait seconds after the first item arrives, and hands each batch to a
+# handler. Batch sizes and per-item queue waits are tracked for tuning.
+#
+# Items carry a priority class and an optional deadline (time.monotonic()).
+# Batches are filled from the highest class first. Within a class, items are
+# shared fairly between clients (a device id or peer address) with
+# start-time fair queuing: each item is tagged with the virtual time at which
+# its client's previous item finishes, so a device that queues a hundred
+# uploads gets every n-th slot when n devices are active, instead of all
+# slots until its backlog is gone.
+#
+# Deadlines do not move an item ahead, or a device could skip its fair share
+# by giving every upload a generous one. Items whose deadline has passed are
+# never batched: they go to the expired handler instead, so the caller can
+# tell the client. The wait for a fuller batch is cut short when it would
+# make an item in it miss its deadline.
+
+PRIORITIES = ('interactive', 'normal', 'bulk')  # Highest first
+DEFAULT_PRIORITY = 'normal'
+MAX_IDLE_CLIENTS = 1024  # Fair-share state kept for clients with nothing queued
+
+sequence = itertools.count()
+
+
+def priority_rank(priority):
+    # Unknown classes are served as the default one
+    try:
+        return PRIORITIES.index(priority)
+    except ValueError:
+        return PRIORITIES.index(DEFAULT_PRIORITY)
+
+
+class Entry:
+    __slots__ = ('key', 'queued', 'size', 'priority', 'deadline', 'client', 'item')
+
+    def __init__(self, item, size=0, priority=DEFAULT_PRIORITY, deadline=None, client=None):
+        self.key = None  # Set by FairShare.schedule
+        self.queued = time.monotonic()
+        self.size = size
+        self.priority = PRIORITIES[priority_rank(priority)]
+        self.deadline = deadline
+        self.client = client
+        self.item = item
+
+    def __lt__(self, other):
+        return self.key < other.key
+
+    def expired(self, now):
+        return self.deadline is not None and self.deadline <= now
+
+
+class FairShare:
+    # Start-time fair queuing; callers serialise access
+    def __init__(self):
+        self.virtual_time = 0.0
+        self.finish = {}  # client: virtual finish time of its last queued item
+        self.queued = {}  # client: items queued
+
+    def schedule(self, entry):
+        start = max(self.virtual_time, self.finish.get(entry.client, 0.0))
+        self.finish[entry.client] = start + 1
+        self.queued[entry.client] = self.queued.get(entry.client, 0) + 1
+        entry.key = (priority_rank(entry.priority), start, next(sequence))
+
+    def served(self, entry):
+        self.virtual_time = max(self.virtual_time, entry.key[1])
+        self.queued[entry.client] -= 1
+        if not self.queued[entry.client]:
+            del self.queued[entry.client]
+        if len(self.finish) > MAX_IDLE_CLIENTS:
+            self.finish = {client: finish for client, finish in self.finish.items() if finish > self.virtual_time}
+
+    def active_clients(self):
+        return len(self.queued)
+
+
+class FairQueue(queue.Queue):
+    # queue.Queue of Entry in scheduling order, for threads that take items
+    # one at a time
+    def _init(self, maxsize):
+        self.queue = []
+        self.fair = FairShare()
+
+    def _qsize(self):
+        return len(self.queue)
+
+    def _put(self, entry):
+        self.fair.schedule(entry)
+        heapq.heappush(self.queue, entry)
+
+    def _get(self):
+        entry = heapq.heappop(self.queue)
+        self.fair.served(entry)
+        return entry
+
+    def active_clients(self):
+        with self.mutex:
+            return self.fair.active_clients()
+
+
+class BatchStats:
+    def __init__(self, max_batch_size):
+        self.lock = threading.Lock()
+        self.size_counts = [0] * (max_batch_size + 1)
+        self.batches = 0
+        self.items = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.total_run_time = 0.0
+        self.class_waits = {}  # priority: [items, total wait, max wait]
+        self.expired = {}  # priority: items dropped at their deadline
+
+    def record(self, batch, started, run_time):
+        waits = [started - entry.queued for entry in batch]
+        with self.lock:
+            self.size_counts[len(waits)] += 1
+            self.batches += 1
+            self.items += len(waits)
+            self.total_wait += sum(waits)
+            self.max_wait = max([self.max_wait] + waits)
+            self.total_run_time += run_time
+            for entry, wait in zip(batch, waits):
+                class_wait = self.class_waits.setdefault(entry.priority, [0, 0.0, 0.0])
+                class_wait[0] += 1
+                class_wait[1] += wait
+                class_wait[2] = max(class_wait[2], wait)
+
+    def record_expired(self, entries):
+        with self.lock:
+            for entry in entries:
+                self.expired[entry.priority] = self.expired.get(entry.priority, 0) + 1
+
+    def mean_run_time(self):
+        with self.lock:
+            return self.total_run_time / self.batches if self.batches else 0.0
+
+    def snapshot(self):
+        with self.lock:
+            batches = self.batches or 1
+            items = self.items or 1
+            return {
+                'batches': self.batches,
+                'items': self.items,
+                'mean_batch_size': self.items / batches,
+                'batch_size_counts': {size: count for size, count in enumerate(self.size_counts) if count},
+                'mean_wait_ms': 1000 * self.total_wait / items,
+                'max_wait_ms': 1000 * self.max_wait,
+                'mean_batch_run_ms': 1000 * self.total_run_time / batches,
+                'wait_by_priority': {
+                    priority: {'items': items, 'mean_wait_ms': 1000 * total / items, 'max_wait_ms': 1000 * longest}
+                    for priority, (items, total, longest) in self.class_waits.items()
+                },
+                'expired': dict(self.expired),
+            }
+
+
+def fill_deadline(batch, max_wait, run_time):
+    # When to stop waiting for more items: after max_wait, or earlier if an
+    # item in the batch would otherwise miss its deadline
+    deadline = time.monotonic() + max_wait
+    for entry in batch:
+        if entry.deadline is not None:
+            deadline = min(deadline, entry.deadline - run_time)
+    return deadline
+
+
+class MicroBatcher:
+    def __init__(self, handler, max_batch_size, max_wait, expired_handler=None):
+        self.handler = handler
+        self.expired_handler = expired_handler
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue = FairQueue()
+        self.stats = BatchStats(max_batch_size)
+
+    def put(self, item, priority=DEFAULT_PRIORITY, deadline=None, client=None):
+        self.queue.put(Entry(item, 0, priority, deadline, client))
+
+    def qsize(self):
+        return self.queue.qsize()
+
+    def expire(self, entries):
+        self.stats.record_expired(entries)
+        try:
+            if self.expired_handler:
+                self.expired_handler([entry.item for entry in entries])
+        except Exception as e:
+            print(f'An error occurred while expiring requests: {e}')
+        finally:
+            for _ in entries:
+                self.queue.task_done()
+
+    def get(self, timeout=None):
+        # The next item that can still make its deadline
+        while True:
+            entry = self.queue.get(timeout=timeout)
+            if not entry.expired(time.monotonic()):
+                return entry
+            self.expire([entry])
+
+    def collect(self):
+        batch = [self.get()]
+        deadline = fill_deadline(batch, self.max_wait, self.stats.mean_run_time())
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.get(timeout=remaining))
+            except queue.Empty:
+                break
+            deadline = min(deadline, fill_deadline(batch[-1:], self.max_wait, self.stats.mean_run_time()))
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.collect()
+            started = time.monotonic()
+            try:
+                self.handler([entry.item for entry in batch])
+            except Exception as e:
+                print(f'An error occurred while running a batch: {e}')
+            finally:
+                self.stats.record(batch, started, time.monotonic() - started)
+                for _ in batch:
+                    self.queue.task_done()
+
+    def report_stats(self, interval):
+        while True:
+            time.sleep(interval)
+            print(f'Batch stats: {json.dumps(self.stats.snapshot())}')
+
+
+class AsyncMicroBatcher:
+    # asyncio counterpart of MicroBatcher with a queue bounded both by item
+    # count and by total payload bytes. Callers reserve room with admit()
+    # as soon as they know the upload size, so a full queue can be reported
+    # before the body has been read.
+    def __init__(self, max_batch_size, max_wait, max_items, max_bytes):
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.items = []  # Heap of Entry
+        self.fair = FairShare()
+        self.reserved_items = 0
+        self.reserved_bytes = 0
+        self.queued_bytes = 0
+        self.rejected = 0
+        self.not_empty = asyncio.Event()
+        self.stats = BatchStats(max_batch_size)
+
+    def depth(self):
+        return len(self.items)
+
+    def admit(self, size):
+        if (len(self.items) + self.reserved_items >= self.max_items
+                or self.queued_bytes + self.reserved_bytes + size > self.max_bytes):
+            self.rejected += 1
+            return False
+        self.reserved_items += 1
+        self.reserved_bytes += size
+        return True
+
+    def release(self, size):
+        self.reserved_items -= 1
+        self.reserved_bytes -= size
+
+    def put(self, item, size, priority=DEFAULT_PRIORITY, deadline=None, client=None):
+        self.release(size)
+        self.queued_bytes += size
+        entry = Entry(item, size, priority, deadline, client)
+        self.fair.schedule(entry)
+        heapq.heappush(self.items, entry)
+        self.not_empty.set()
+
+    def retry_after_ms(self, concurrency=1):
+        snapshot = self.stats.snapshot()
+        batch_ms = snapshot['mean_batch_run_ms'] if snapshot['batches'] else 100.0
+        batches_ahead = (len(self.items) + self.reserved_items) // self.max_batch_size + 1
+        return int(batches_ahead * batch_ms / concurrency)
+
+    def _pop(self, batch, expired):
+        now = time.monotonic()
+        while self.items and len(batch) < self.max_batch_size:
+            entry = heapq.heappop(self.items)
+            self.fair.served(entry)
+            self.queued_bytes -= entry.size
+            (expired if entry.expired(now) else batch).append(entry)
+        if not self.items:
+            self.not_empty.clear()
+
+    async def get_batch(self):
+        # Returns the batch and the entries that expired while it was collected
+        batch = []
+        expired = []
+        # Another runner may have emptied the queue between wake-up and pop
+        while not batch:
+            await self.not_empty.wait()
+            self._pop(batch, expired)
+            if expired and not batch:
+                return batch, expired
+        deadline = fill_deadline(batch, self.max_wait, self.stats.mean_run_time())
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                await asyncio.wait_for(self.not_empty.wait(), remaining)
+            except asyncio.TimeoutError:
+                break
+            count = len(batch)
+            self._pop(batch, expired)
+            deadline = min(deadline, fill_deadline(batch[count:], self.max_wait, self.stats.mean_run_time()))
+        return batch, expired
+
+    async def run(self, handler, expired_handler=None):
+        while True:
+            batch, expired = await self.get_batch()
+            if expired:
+                self.stats.record_expired(expired)
+                if expired_handler:
+                    expired_handler([entry.item for entry in expired])
+            if not batch:
+                continue
+            started = time.monotonic()
+            try:
+                await handler([entry.item for entry in batch])
+            except Exception as e:
+                print(f'An error occurred while running a batch: {e}')
+            finally:
+                self.stats.record(batch, started, time.monotonic() - started)
@@ -0,0 +1,137 @@
+import struct
+import cv2
+import numpy as np
+
+# Turns uploaded JPEG bytes into the square model input without going
+# through the disk. Large photos are decoded at 1/2, 1/4 or 1/8 scale by
+# libjpeg (DCT scaling), picking the smallest scale that still covers the
+# model input, then center-cropped or letterboxed to size x size.
+
+INPUT_SIZE = 640
+LETTERBOX_COLOR = (114, 114, 114)
+
+REDUCED_DECODE_FLAGS = {
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    1: cv2.IMREAD_COLOR,
+}
+
+# Start-of-frame markers carrying the image dimensions
+SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+
+def jpeg_size(data):
+    # Returns (width, height) from the JPEG header, or None if data is not a JPEG
+    if data[:2] != b'\xff\xd8':
+        return None
+    offset = 2
+    while offset + 4 <= len(data):
+        if data[offset] != 0xFF:
+            return None
+        marker = data[offset + 1]
+        if marker == 0xFF:
+            offset += 1
+            continue
+        if marker in (0xD8, 0x01) or 0xD0 <= marker <= 0xD7:
+            offset += 2
+            continue
+        segment_length = struct.unpack('>H', data[offset + 2:offset + 4])[0]
+        if marker in SOF_MARKERS and offset + 9 <= len(data):
+            height, width = struct.unpack('>HH', data[offset + 5:offset + 9])
+            return width, height
+        offset += 2 + segment_length
+    return None
+
+
+def reduction_factor(width, height, size, mode):
+    # center_crop needs the short side to cover size, letterbox the long side
+    side = min(width, height) if mode == 'center_crop' else max(width, height)
+    for factor in (8, 4, 2):
+        if side // factor >= size:
+            return factor
+    return 1
+
+
+def decode(data, size=INPUT_SIZE, mode='letterbox'):
+    dimensions = jpeg_size(data)
+    factor = reduction_factor(dimensions[0], dimensions[1], size, mode) if dimensions else 1
+    buffer = np.frombuffer(data, dtype=np.uint8)
+    return cv2.imdecode(buffer, REDUCED_DECODE_FLAGS[factor])
+
+
+def center_crop(image, size=INPUT_SIZE):
+    h, w = image.shape[:2]
+    crop_size = min(h, w)
+    x = (w - crop_size) // 2
+    y = (h - crop_size) // 2
+    image = image[y:y + crop_size, x:x + crop_size]
+    scale = size / crop_size
+    if crop_size != size:
+        image = cv2.resize(image, (size, size), interpolation=cv2.INTER_AREA if scale < 1 else cv2.INTER_LINEAR)
+    # model input = source * scale + offset
+    return image, {'scale': scale, 'offset': (-x * scale, -y * scale), 'source_size': (w, h), 'size': size}
+
+
+def letterbox(image, size=INPUT_SIZE):
+    h, w = image.shape[:2]
+    scale = size / max(h, w)
+    new_w, new_h = int(round(w * scale)), int(round(h * scale))
+    if (new_w, new_h) != (w, h):
+        image = cv2.resize(image, (new_w, new_h), interpolation=cv2.INTER_AREA if scale < 1 else cv2.INTER_LINEAR)
+    left = (size - new_w) // 2
+    top = (size - new_h) // 2
+    if (new_w, new_h) != (size, size):
+        image = cv2.copyMakeBorder(image, top, size - new_h - top, left, size - new_w - left,
+                                   cv2.BORDER_CONSTANT, value=LETTERBOX_COLOR)
+    return image, {'scale': scale, 'offset': (left, top), 'source_size': (w, h), 'size': size}
+
+
+def preprocess(data, size=INPUT_SIZE, mode='letterbox'):
+    # Returns (image, transform), or (None, None) if the upload cannot be decoded
+    image = decode(data, size, mode)
+    if image is None:
+        return None, None
+    if mode == 'center_crop':
+        return center_crop(image, size)
+    return letterbox(image, size)
+
+
+def unmap_boxes(boxes, transform):
+    # Maps [class id, confidence, x, y, w, h] rows normalized to the model
+    # input back to coordinates normalized to the uploaded photo
+    size = transform['size']
+    scale = transform['scale']
+    offset_x, offset_y = transform['offset']
+    source_w, source_h = transform['source_size']
+    mapped = []
+    for cls, conf, x, y, w, h in boxes:
+        mapped.append([
+            cls, conf,
+            round((x * size - offset_x) / scale / source_w, 4),
+            round((y * size - offset_y) / scale / source_h, 4),
+            round(w * size / scale / source_w, 4),
+            round(h * size / scale / source_h, 4),
+        ])
+    return mapped
+
+
+def fit_upload(data, size=INPUT_SIZE, mode='letterbox', quality=90):
+    # Client side of the input geometry handshake: crop and resize the photo
+    # to what the server feeds the model so it has nothing left to resize.
+    # Letterboxed uploads are only scaled down, the server adds the border.
+    dimensions = jpeg_size(data)
+    if dimensions == (size, size) or (mode != 'center_crop' and dimensions and max(dimensions) <= size):
+        return data
+    image = decode(data, size, mode)
+    if image is None:
+        return data
+    if mode == 'center_crop':
+        image, _ = center_crop(image, size)
+    else:
+        h, w = image.shape[:2]
+        scale = size / max(h, w)
+        if scale < 1:
+            image = cv2.resize(image, (int(round(w * scale)), int(round(h * scale))), interpolation=cv2.INTER_AREA)
+    ok, encoded = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    return encoded.tobytes() if ok else data
@@ -0,0 +1,310 @@
+import argparse
+import glob
+import json
+import os
+import re
+import tempfile
+import time
+import cv2
+from inference_backends import OnnxModel, int8_model_path, onnx_model_path, runtime_settings_path
+
+# CPU deployment of best_v8n for sites without a Jetson:
+#
+#   export    YOLOv8 weights -> ONNX (dynamic batch), next to the weights
+#   quantize  static INT8 (QDQ) calibrated on the uploads in SAVE_DIRECTORY
+#   tune      pick the intra-op thread count with the lowest latency and
+#             store it next to the model, where OnnxModel picks it up
+#   report    latency and mAP of the INT8 model against FP32
+#   all       every step in order
+#
+# The servers run the result with INFERENCE_BACKEND = 'onnx-int8' (or 'onnx'
+# for FP32). Without --labels the report scores both models against the FP32
+# detections, so the INT8 mAP is the drift from FP32 rather than accuracy.
+
+SAVE_DIRECTORY = r'/home/jetson/edge_server/images'
+WEIGHTS_PATH = 'images/best_v8n.pt'
+INPUT_SIZE = 640
+CALIBRATION_SAMPLES = 200
+EVALUATION_SAMPLES = 200
+MAP_CONF_THRESHOLD = 0.001  # Keep low-confidence boxes so the precision-recall curve is complete
+IMAGE_PATTERNS = ('*.jpg', '*.jpeg', '*.png')
+
+
+def list_images(directory):
+    # Uploads only; annotated copies (predicted_*) would bias the calibration
+    paths = []
+    for pattern in IMAGE_PATTERNS:
+        paths.extend(glob.glob(os.path.join(directory, pattern)))
+    return sorted(path for path in paths if not os.path.basename(path).startswith('predicted_'))
+
+
+def split_images(paths, calibration_samples, evaluation_samples):
+    # Alternate images between the two sets so neither is just the oldest uploads
+    calibration, evaluation = paths[0::2], paths[1::2]
+    if not evaluation:
+        evaluation = calibration
+    return spread(calibration, calibration_samples), spread(evaluation, evaluation_samples)
+
+
+def spread(paths, limit):
+    if len(paths) <= limit:
+        return paths
+    step = len(paths) / limit
+    return [paths[int(i * step)] for i in range(limit)]
+
+
+def load_images(paths):
+    images = [(path, cv2.imread(path)) for path in paths]
+    return [(path, image) for path, image in images if image is not None]
+
+
+# export
+
+def export_onnx(weights_path, size):
+    from ultralytics import YOLO
+    exported = YOLO(weights_path, task='detect').export(format='onnx', imgsz=size, dynamic=True, simplify=True)
+    print(f'Exported {weights_path} -> {exported}')
+    return exported
+
+
+# quantize
+
+class CalibrationReader:
+    # onnxruntime.quantization.CalibrationDataReader protocol, one letterboxed image per call
+    def __init__(self, model, images):
+        self.model = model
+        self.images = iter(images)
+
+    def get_next(self):
+        for _, image in self.images:
+            blob, _ = self.model.prepare(image)
+            return {self.model.input_name: blob[None]}
+        return None
+
+    def rewind(self):
+        pass
+
+
+def decode_nodes(model_path):
+    # Box decoding at the end of the Detect head (DFL softmax, anchor math,
+    # concat, sigmoid) stays in FP32: INT8 there costs localisation accuracy
+    # for almost no speed. The head's convolutions are still quantized.
+    import onnx
+    graph = onnx.load(model_path).graph
+    indices = [int(match.group(1)) for match in (re.match(r'/model\.(\d+)/', node.name) for node in graph.node) if match]
+    if not indices:
+        return []
+    head = f'/model.{max(indices)}/'
+    return [node.name for node in graph.node if node.name.startswith(head) and node.op_type != 'Conv']
+
+
+def quantize(fp32_path, int8_path, images, method):
+    from onnxruntime.quantization import CalibrationMethod, QuantFormat, QuantType, quantize_static
+    from onnxruntime.quantization.shape_inference import quant_pre_process
+
+    model = OnnxModel(fp32_path)
+    with tempfile.TemporaryDirectory() as work_directory:
+        prepared_path = os.path.join(work_directory, 'prepared.onnx')
+        try:
+            quant_pre_process(fp32_path, prepared_path)
+        except Exception as e:
+            # Symbolic shape inference needs sympy; plain ONNX shape inference is enough for static exports
+            print(f'Symbolic shape inference failed ({e}), using ONNX shape inference only')
+            quant_pre_process(fp32_path, prepared_path, skip_symbolic_shape=True)
+        excluded = decode_nodes(prepared_path)
+        started = time.perf_counter()
+        quantize_static(
+            prepared_path, int8_path, CalibrationReader(model, images),
+            quant_format=QuantFormat.QDQ, activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8,
+            per_channel=True, calibrate_method=getattr(CalibrationMethod, method), nodes_to_exclude=excluded)
+    print(f'Quantized {fp32_path} -> {int8_path} on {len(images)} images with {method} calibration '
+          f'in {time.perf_counter() - started:.0f} s ({len(excluded)} decode nodes kept in FP32)')
+
+
+# tune
+
+def thread_candidates():
+    count = os.cpu_count() or 1
+    candidates = [1]
+    while candidates[-1] * 2 < count:
+        candidates.append(candidates[-1] * 2)
+    return candidates + [count] if count > 1 else candidates
+
+
+def measure_latency(model, images, repeat, warmup=3):
+    for _, image in images[:warmup]:
+        model.predict([image])
+    timings = []
+    for _ in range(repeat):
+        for _, image in images:
+            started = time.perf_counter()
+            model.predict([image])
+            timings.append(time.perf_counter() - started)
+    timings.sort()
+    return 1000 * sum(timings) / len(timings), 1000 * timings[int(0.95 * (len(timings) - 1))]
+
+
+def tune_threads(model_path, images, repeat):
+    latencies = {}
+    for threads in thread_candidates():
+        latencies[threads], _ = measure_latency(OnnxModel(model_path, threads), images, repeat)
+        print(f'  {os.path.basename(model_path)} {threads:>3} threads  {latencies[threads]:8.1f} ms/image')
+    best = min(latencies, key=latencies.get)
+    with open(runtime_settings_path(model_path), 'w') as f:
+        json.dump({'intra_op_threads': best, 'latency_ms': latencies}, f, indent=2)
+    print(f'  -> {best} intra-op threads, saved to {runtime_settings_path(model_path)}')
+    return best
+
+
+# report
+
+def load_labels(labels_directory, image_path):
+    # YOLO txt labels: class x y w h, normalised
+    label_path = os.path.join(labels_directory, os.path.splitext(os.path.basename(image_path))[0] + '.txt')
+    rows = []
+    if os.path.exists(label_path):
+        with open(label_path) as f:
+            for line in f:
+                values = line.split()
+                if len(values) >= 5:
+                    rows.append([int(values[0]), 1.0] + [float(v) for v in values[1:5]])
+    return rows
+
+
+def box_iou(a, b):
+    ax1, ay1, ax2, ay2 = a[0] - a[2] / 2, a[1] - a[3] / 2, a[0] + a[2] / 2, a[1] + a[3] / 2
+    bx1, by1, bx2, by2 = b[0] - b[2] / 2, b[1] - b[3] / 2, b[0] + b[2] / 2, b[1] + b[3] / 2
+    inter = max(0.0, min(ax2, bx2) - max(ax1, bx1)) * max(0.0, min(ay2, by2) - max(ay1, by1))
+    union = a[2] * a[3] + b[2] * b[3] - inter
+    return inter / union if union > 0 else 0.0
+
+
+def average_precision(predictions, truths, iou_threshold):
+    # predictions: (image index, confidence, box); truths: {image index: [box, ...]}
+    total = sum(len(boxes) for boxes in truths.values())
+    if not total:
+        return None
+    matched = {index: [False] * len(boxes) for index, boxes in truths.items()}
+    hits = []
+    for index, _, box in sorted(predictions, key=lambda prediction: -prediction[1]):
+        best, best_iou = None, iou_threshold
+        for j, truth in enumerate(truths.get(index, [])):
+            iou = box_iou(box, truth)
+            if not matched[index][j] and iou >= best_iou:
+                best, best_iou = j, iou
+        if best is not None:
+            matched[index][best] = True
+        hits.append(best is not None)
+
+    # 101-point interpolated AP, as COCO and ultralytics report it
+    precisions, recalls, true_positives = [], [], 0
+    for count, hit in enumerate(hits, 1):
+        true_positives += hit
+        precisions.append(true_positives / count)
+        recalls.append(true_positives / total)
+    for i in range(len(precisions) - 2, -1, -1):
+        precisions[i] = max(precisions[i], precisions[i + 1])
+    ap = 0.0
+    for step in range(101):
+        level = step / 100
+        ap += next((p for p, r in zip(precisions, recalls) if r >= level), 0.0)
+    return ap / 101
+
+
+def mean_average_precision(detections, truths):
+    # Returns (mAP@0.5, mAP@0.5:0.95) over the classes present in the truths
+    classes = sorted({row[0] for rows in truths for row in rows})
+    if not classes:
+        return None, None
+    scores = {}
+    for threshold in [0.5 + 0.05 * i for i in range(10)]:
+        per_class = []
+        for cls in classes:
+            predictions = [(i, row[1], row[2:]) for i, rows in enumerate(detections) for row in rows if row[0] == cls]
+            class_truths = {i: [row[2:] for row in rows if row[0] == cls] for i, rows in enumerate(truths)}
+            per_class.append(average_precision(predictions, class_truths, threshold))
+        scores[threshold] = sum(per_class) / len(per_class)
+    return scores[0.5], sum(scores.values()) / len(scores)
+
+
+def detect(model, images):
+    return [model.predict([image])[0].boxes for _, image in images]
+
+
+def rows_from(boxes):
+    return [[cls, conf] + list(xywhn) for cls, conf, xywhn in zip(boxes.cls, boxes.conf, boxes.xywhn)]
+
+
+def report(fp32_path, int8_path, images, labels_directory, repeat):
+    results = {}
+    fp32_truths = None
+    for name, model_path in (('fp32', fp32_path), ('int8', int8_path)):
+        model = OnnxModel(model_path)
+        mean, p95 = measure_latency(model, images, repeat)
+        # Scoring model: same weights with the low mAP threshold
+        detections = [rows_from(boxes) for boxes in detect(OnnxModel(model_path, model.threads, MAP_CONF_THRESHOLD), images)]
+        if fp32_truths is None:
+            fp32_truths = [rows_from(boxes) for boxes in detect(model, images)]
+        truths = [load_labels(labels_directory, path) for path, _ in images] if labels_directory else fp32_truths
+        map50, map50_95 = mean_average_precision(detections, truths)
+        results[name] = {'model': model_path, 'size_mb': round(os.path.getsize(model_path) / 1e6, 2),
+                         'threads': model.threads, 'mean_ms': round(mean, 2), 'p95_ms': round(p95, 2),
+                         'map50': map50, 'map50_95': map50_95}
+
+    reference = 'labels in ' + labels_directory if labels_directory else 'FP32 detections'
+    print(f'{len(images)} images, mAP against {reference}')
+    for name, result in results.items():
+        scored = '' if result['map50'] is None else f"   mAP50 {result['map50']:.3f}   mAP50-95 {result['map50_95']:.3f}"
+        print(f"  {name}  {result['size_mb']:6.1f} MB  {result['threads'] or 'default':>7} threads"
+              f"   mean {result['mean_ms']:7.1f} ms   p95 {result['p95_ms']:7.1f} ms{scored}")
+    fp32, int8 = results['fp32'], results['int8']
+    print(f"  INT8 is {fp32['mean_ms'] / int8['mean_ms']:.2f}x the FP32 speed", end='')
+    if fp32['map50'] is not None:
+        print(f", mAP50 drift {int8['map50'] - fp32['map50']:+.3f}, mAP50-95 drift {int8['map50_95'] - fp32['map50_95']:+.3f}")
+    else:
+        print(', no boxes to score mAP against')
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export, INT8-quantize and evaluate best_v8n for ONNX Runtime on the CPU')
+    parser.add_argument('step', choices=('export', 'quantize', 'tune', 'report', 'all'))
+    parser.add_argument('--weights', default=WEIGHTS_PATH)
+    parser.add_argument('--model', help='FP32 ONNX model (default: the .onnx next to --weights)')
+    parser.add_argument('--images', default=SAVE_DIRECTORY, help='Uploads used for calibration and evaluation')
+    parser.add_argument('--labels', help='YOLO txt labels for the evaluation images, for mAP against ground truth')
+    parser.add_argument('--size', type=int, default=INPUT_SIZE)
+    parser.add_argument('--calibration-samples', type=int, default=CALIBRATION_SAMPLES)
+    parser.add_argument('--evaluation-samples', type=int, default=EVALUATION_SAMPLES)
+    parser.add_argument('--method', choices=('MinMax', 'Entropy', 'Percentile'), default='MinMax', help='Calibration method')
+    parser.add_argument('--repeat', type=int, default=1, help='Latency passes over the evaluation images')
+    parser.add_argument('--json', help='Write the report to this file')
+    args = parser.parse_args()
+
+    fp32_path = args.model or onnx_model_path(args.weights)
+    int8_path = int8_model_path(fp32_path)
+    if args.step in ('export', 'all') and not (args.step == 'all' and os.path.exists(fp32_path)):
+        fp32_path = export_onnx(args.weights, args.size)
+        int8_path = int8_model_path(fp32_path)
+    if args.step == 'export':
+        return
+
+    calibration, evaluation = split_images(list_images(args.images), args.calibration_samples, args.evaluation_samples)
+    if not calibration:
+        raise SystemExit(f'No images found in {args.images}')
+    if args.step in ('quantize', 'all'):
+        quantize(fp32_path, int8_path, load_images(calibration), args.method)
+    evaluation = load_images(evaluation)
+    if args.step in ('tune', 'all'):
+        # Tuning on a handful of images is enough to rank thread counts
+        for model_path in (fp32_path, int8_path):
+            tune_threads(model_path, evaluation[:10], args.repeat)
+    if args.step in ('report', 'all'):
+        results = report(fp32_path, int8_path, evaluation, args.labels, args.repeat)
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
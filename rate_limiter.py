@@ -0,0 +1,64 @@
+import threading
+import time
+
+# Token-bucket rate limits per client, a device id or peer address. Every
+# upload takes a token; a client's bucket holds at most `burst` tokens and
+# refills at `rate` tokens per second, so a device may send `burst` photos
+# at once but no more than `rate` per second on average. An upload that
+# finds the bucket empty is refused with the time until the next token.
+
+MAX_CLIENTS = 4096  # Buckets kept; full ones (idle clients) are forgotten beyond this
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, now):
+        # Seconds until a token is available, 0 when one was taken
+        self.refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate if self.rate else float('inf')
+
+
+class RateLimiter:
+    def __init__(self, default=None, limits=None):
+        # default and the values of limits are (rate per second, burst), or
+        # None for no limit; limits is keyed by client
+        self.default = default
+        self.limits = dict(limits or {})
+        self.buckets = {}
+        self.limited = 0
+        self.lock = threading.Lock()
+
+    def check(self, client):
+        # Seconds the client has to wait, 0 when the upload may go ahead
+        limit = self.limits.get(client, self.default)
+        if limit is None:
+            return 0.0
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.get(client)
+            if bucket is None:
+                if len(self.buckets) >= MAX_CLIENTS:
+                    self.forget_idle(now)
+                bucket = self.buckets[client] = TokenBucket(*limit)
+            wait = bucket.take(now)
+            if wait:
+                self.limited += 1
+            return wait
+
+    def forget_idle(self, now):
+        for client, bucket in list(self.buckets.items()):
+            bucket.refill(now)
+            if bucket.tokens >= bucket.burst:
+                del self.buckets[client]
@@ -0,0 +1,178 @@
+import asyncio
+import collections
+import hashlib
+import json
+import os
+import threading
+
+# Inference results keyed by a hash of the uploaded bytes and the model
+# version. A memory tier and an optional disk tier are each evicted LRU within
+# their own byte budget. Identical requests that arrive while the first one
+# is still being inferred wait for that inference instead of running again.
+
+
+def make_key(data, model_version):
+    digest = hashlib.sha256(data)
+    digest.update(str(model_version).encode('utf-8'))
+    return digest.hexdigest()
+
+
+class ResultCache:
+    def __init__(self, max_bytes, disk_directory=None, max_disk_bytes=0):
+        self.max_bytes = max_bytes
+        self.disk_directory = disk_directory
+        self.max_disk_bytes = max_disk_bytes
+        self.memory = collections.OrderedDict()
+        self.memory_bytes = 0
+        self.disk = collections.OrderedDict()
+        self.disk_bytes = 0
+        self.disk_lock = threading.Lock()
+        self.inflight = {}
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        if disk_directory and max_disk_bytes:
+            self._load_disk_index()
+
+    def _load_disk_index(self):
+        os.makedirs(self.disk_directory, exist_ok=True)
+        entries = []
+        for file_name in os.listdir(self.disk_directory):
+            if file_name.endswith('.json'):
+                path = os.path.join(self.disk_directory, file_name)
+                image_path = path[:-len('.json')] + '.jpg'
+                if os.path.exists(image_path):
+                    size = os.path.getsize(path) + os.path.getsize(image_path)
+                    entries.append((os.path.getmtime(path), file_name[:-len('.json')], size))
+        for _, key, size in sorted(entries):
+            self.disk[key] = size
+            self.disk_bytes += size
+
+    @staticmethod
+    def _size(result):
+        return len(result['image']) + 64 * len(result.get('labels', ())) + 256
+
+    def _get_memory(self, key):
+        result = self.memory.get(key)
+        if result is not None:
+            self.memory.move_to_end(key)
+        return result
+
+    def _put_memory(self, key, result):
+        if key in self.memory:
+            return
+        size = self._size(result)
+        if size > self.max_bytes:
+            return
+        self.memory[key] = result
+        self.memory_bytes += size
+        while self.memory_bytes > self.max_bytes:
+            _, evicted = self.memory.popitem(last=False)
+            self.memory_bytes -= self._size(evicted)
+
+    def _disk_path(self, key, extension):
+        return os.path.join(self.disk_directory, key + extension)
+
+    def _read_disk(self, key):
+        with self.disk_lock:
+            if key not in self.disk:
+                return None
+            self.disk.move_to_end(key)
+        try:
+            with open(self._disk_path(key, '.json'), 'r') as f:
+                result = json.load(f)
+            with open(self._disk_path(key, '.jpg'), 'rb') as f:
+                result['image'] = f.read()
+            os.utime(self._disk_path(key, '.json'))
+            return result
+        except (OSError, ValueError):
+            return None
+
+    def _write_disk(self, key, result):
+        header = {k: v for k, v in result.items() if k != 'image'}
+        try:
+            with open(self._disk_path(key, '.jpg'), 'wb') as f:
+                f.write(result['image'])
+            with open(self._disk_path(key, '.json'), 'w') as f:
+                json.dump(header, f)
+        except OSError as e:
+            print(f'Error writing cache entry {key}: {e}')
+            return
+        size = self._size(result)
+        with self.disk_lock:
+            if key not in self.disk:
+                self.disk[key] = size
+                self.disk_bytes += size
+            evicted = []
+            while self.disk_bytes > self.max_disk_bytes and self.disk:
+                old_key, old_size = self.disk.popitem(last=False)
+                self.disk_bytes -= old_size
+                evicted.append(old_key)
+        for old_key in evicted:
+            for extension in ('.json', '.jpg'):
+                try:
+                    os.remove(self._disk_path(old_key, extension))
+                except OSError:
+                    pass
+
+    async def get_or_compute(self, key, compute):
+        result = self._get_memory(key)
+        if result is not None:
+            self.hits += 1
+            return result
+
+        while key in self.inflight:
+            self.coalesced += 1
+            shared = self.inflight[key]
+            try:
+                return await asyncio.shield(shared)
+            except asyncio.CancelledError:
+                if not shared.cancelled():
+                    raise
+                # The client that started it went away, compute it for this one instead
+                self.coalesced -= 1
+
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        self.inflight[key] = future
+        try:
+            result = None
+            if self.disk_directory and self.max_disk_bytes:
+                result = await loop.run_in_executor(None, self._read_disk, key)
+            if result is not None:
+                self.hits += 1
+                self.disk_hits += 1
+            else:
+                self.misses += 1
+                result = await compute()
+                if result and result.get('ok'):
+                    if self.disk_directory and self.max_disk_bytes:
+                        loop.run_in_executor(None, self._write_disk, key, result)
+            if result and result.get('ok'):
+                self._put_memory(key, result)
+            future.set_result(result)
+            return result
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # Only coalesced waiters need to see it
+            raise
+        finally:
+            del self.inflight[key]
+
+    def stats(self):
+        lookups = self.hits + self.misses + self.coalesced
+        return {
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'memory_entries': len(self.memory),
+            'memory_bytes': self.memory_bytes,
+            'disk_entries': len(self.disk),
+            'disk_bytes': self.disk_bytes,
+        }
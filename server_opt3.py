@@ -1,125 +1,63 @@
 import socket
 import os
-import subprocess
 import time
-import struct
 import threading
 from concurrent.futures import ThreadPoolExecutor
 import queue
+from inference_backends import create_backend, warm_up
+import transfer
+import docker_container
 
 # Directory to save the received files
 SAVE_DIRECTORY = r'/home/jetson/edge_server/images'  # Update with your actual path
 MAX_WORKERS = 4  # Adjust based on your system's capabilities
+PORT = 12345
 DOCKER_CONTAINER_NAME = 'ultralytics_inference'
+DOCKER_IMAGE = 'ultralytics/ultralytics:latest-jetson-jetpack4'
+MODEL_PATH = 'images/best_v8n.pt'
+INFERENCE_BACKEND = 'docker'  # See inference_backends.BACKENDS
+KEEP_CONTAINER = True  # Leave the container running on shutdown so the next start reuses it
+WARMUP_INFERENCES = 3  # Run before accepting connections
 
-# Function to remove existing Docker container
-def remove_existing_container():
-    print('Checking for existing container...')
-    command = ['sudo', 'docker', 'ps', '-aq', '-f', f'name={DOCKER_CONTAINER_NAME}']
-    try:
-        result = subprocess.run(command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
-        container_id = result.stdout.strip()
-        if container_id:
-            print(f'Removing existing container {container_id}...')
-            remove_command = ['sudo', 'docker', 'rm', '-f', container_id]
-            subprocess.run(remove_command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
-            print('Existing container removed successfully.')
-        else:
-            print('No existing container found.')
-    except subprocess.CalledProcessError as e:
-        print(f'Error checking/removing existing container: {e}')
-        print(f'Error output: {e.stderr}')
+yolo_client = None
 
-# Function to start the Docker container once
 def start_docker_container():
-    remove_existing_container()
-    print('Starting YOLOv8 Docker container...')
-    command = [
-        'sudo', 'docker', 'run', '-d', '--name', DOCKER_CONTAINER_NAME, '--ipc=host', '--runtime=nvidia',
-        '-v', f'{SAVE_DIRECTORY}:/ultralytics/images:rw',
-        'ultralytics/ultralytics:latest-jetson-jetpack4', 'sleep', 'infinity'
-    ]
+    image = docker_container.ensure_image(DOCKER_IMAGE)
     try:
-        result = subprocess.run(command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
-        print('Docker container started successfully.')
-    except subprocess.CalledProcessError as e:
+        docker_container.ensure_container(DOCKER_CONTAINER_NAME, image, [(SAVE_DIRECTORY, '/ultralytics/images')],
+                                          ['--ipc=host', '--runtime=nvidia'])
+    except docker_container.ContainerError as e:
         print(f'Error starting Docker container: {e}')
-        print(f'Error output: {e.stderr}')
         exit(1)
 
-# Function to stop the Docker container
 def stop_docker_container():
+    if KEEP_CONTAINER:
+        print('Leaving the YOLOv8 Docker container running for the next start.')
+        return
     print('Stopping YOLOv8 Docker container...')
-    command = ['sudo', 'docker', 'stop', DOCKER_CONTAINER_NAME]
     try:
-        subprocess.run(command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        docker_container.stop_container(DOCKER_CONTAINER_NAME)
         print('Docker container stopped successfully.')
-    except subprocess.CalledProcessError as e:
+    except docker_container.ContainerError as e:
         print(f'Error stopping Docker container: {e}')
-        print(f'Error output: {e.stderr}')
 
 # Function to run YOLOv8 inference using the running Docker container
 def run_inference(image_path):
     print(f'Running YOLOv8 inference on {image_path}...')
-    command = [
-        'sudo', 'docker', 'exec', DOCKER_CONTAINER_NAME,
-        'yolo', 'detect', 'predict',
-        f'source=images/{os.path.basename(image_path)}',
-        'model=images/best_v8n.pt',
-        'project=images/pred',
-        'save_txt',
-        'exist_ok=True'
-    ]
     try:
-        result = subprocess.run(command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        yolo_client.predict(image_path)
         print('Inference completed successfully.')
         return f'images/pred/predict/{os.path.basename(image_path)}'
-    except subprocess.CalledProcessError as e:
+    except Exception as e:
         print(f'Error running YOLOv8 inference: {e}')
-        print(f'Error output: {e.stderr}')
         return None
 
 def send_file(conn, file_path):
-    with open(file_path, 'rb') as f:
-        file_data = f.read()
-    
-    file_name = os.path.basename(file_path).encode('utf-8')
-    name_length = len(file_name)
-    file_size = len(file_data)
-
-    # Send file name length, file name, and file size
-    conn.sendall(struct.pack('!I', name_length))
-    conn.sendall(file_name)
-    conn.sendall(struct.pack('!Q', file_size))
-
-    # Send file data
-    conn.sendall(file_data)
+    transfer.send_file(conn, file_path)
     print(f'Sent file: {file_path}')
 
 def receive_file(conn, save_directory):
-    # Receive file name length
-    name_length = struct.unpack('!I', conn.recv(4))[0]
-
-    # Receive file name
-    file_name = conn.recv(name_length).decode('utf-8')
-    file_path = os.path.join(save_directory, file_name)
-
-    # Receive file size
-    file_size = struct.unpack('!Q', conn.recv(8))[0]
-
-    print(f'Receiving file: {file_name}, Size: {file_size} bytes')
-
-    # Receive and save the file
-    with open(file_path, 'wb') as f:
-        remaining = file_size
-        while remaining > 0:
-            chunk_size = 4096 if remaining > 4096 else remaining
-            chunk = conn.recv(chunk_size)
-            if not chunk:
-                raise ConnectionError("Connection closed while receiving file")
-            f.write(chunk)
-            remaining -= len(chunk)
-
+    file_path = transfer.receive_file(conn, save_directory)
     print(f'File successfully saved at {file_path}')
     return file_path
 
@@ -156,9 +94,14 @@ def inference_worker(inference_queue):
             inference_queue.task_done()
 
 def main():
-    start_docker_container()
+    global yolo_client
+    yolo_client = create_backend(INFERENCE_BACKEND, DOCKER_CONTAINER_NAME, MODEL_PATH)
+    if yolo_client.NEEDS_CONTAINER:
+        start_docker_container()
+    yolo_client.start()
+    warm_up(yolo_client, WARMUP_INFERENCES)
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server_socket.bind(('0.0.0.0', 12345))
+    server_socket.bind(('0.0.0.0', PORT))
     server_socket.listen(5)
     print('Server is listening for connections...')
 
@@ -176,7 +119,9 @@ def main():
     except KeyboardInterrupt:
         print('Shutting down server...')
     finally:
-        stop_docker_container()
+        yolo_client.stop()
+        if yolo_client.NEEDS_CONTAINER:
+            stop_docker_container()
 
 if __name__ == "__main__":
     main()
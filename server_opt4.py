@@ -1,118 +1,90 @@
 import socket
 import os
-import subprocess
 import time
 import struct
 import threading
 from concurrent.futures import ThreadPoolExecutor
-import queue
 import json
 import cv2
+from inference_backends import create_backend, warm_up
+import transfer
+import docker_container
+import metrics
+import tracing
+from micro_batcher import Entry, FairQueue
+from rate_limiter import RateLimiter
 
 SAVE_DIRECTORY = r'/home/jetson/edge_server/images' 
 MAX_WORKERS = 4  
+PORT = 12345
 DOCKER_CONTAINER_NAME = 'ultralytics_inference'
-
-def remove_existing_container():
-    print('Checking for existing container...')
-    command = ['sudo', 'docker', 'ps', '-aq', '-f', f'name={DOCKER_CONTAINER_NAME}']
-    try:
-        result = subprocess.run(command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
-        container_id = result.stdout.strip()
-        if container_id:
-            print(f'Removing existing container {container_id}...')
-            remove_command = ['sudo', 'docker', 'rm', '-f', container_id]
-            subprocess.run(remove_command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
-            print('Existing container removed successfully.')
-        else:
-            print('No existing container found.')
-    except subprocess.CalledProcessError as e:
-        print(f'Error checking/removing existing container: {e}')
-        print(f'Error output: {e.stderr}')
+DOCKER_IMAGE = 'ultralytics/ultralytics:latest-jetson-jetpack4'
+MODEL_PATH = 'images/best_v8n.pt'
+INFERENCE_BACKEND = 'docker'  # See inference_backends.BACKENDS
+KEEP_CONTAINER = True  # Leave the container running on shutdown so the next start reuses it
+WARMUP_INFERENCES = 3  # Run before accepting connections
+TRACE_FILE = 'trace.jsonl'  # JSON lines request events, in SAVE_DIRECTORY; None writes them to stdout
+TRACE_SAMPLE_RATE = 0.1  # Share of requests whose events are recorded; failures always are
+TRACE_MAX_PENDING = 4096  # Events waiting for the trace writer; more are dropped and counted
+HEADER_TIMEOUT = 10  # Seconds without data before a connection that has not sent its file name and size is closed
+RECEIVE_TIMEOUT = 60  # Seconds without data before a stalled upload is abandoned
+SEND_TIMEOUT = 30  # Seconds a response write may block on a client that does not read
+RATE_LIMIT = None  # (uploads per second, burst) per peer address, None for no limit
+DEVICE_RATE_LIMITS = {}  # Peer address: (uploads per second, burst) or None, instead of RATE_LIMIT
+
+yolo_client = None
+tracer = None
+rate_limiter = None
 
 def start_docker_container():
-    remove_existing_container()
-    print('Starting YOLOv8 Docker container...')
-    command = [
-        'sudo', 'docker', 'run', '-d', '--name', DOCKER_CONTAINER_NAME, '--ipc=host', '--runtime=nvidia',
-        '-v', f'{SAVE_DIRECTORY}:/ultralytics/images:rw',
-        'ultralytics/ultralytics:latest-jetson-jetpack4', 'sleep', 'infinity'
-    ]
+    image = docker_container.ensure_image(DOCKER_IMAGE)
     try:
-        result = subprocess.run(command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
-        print('Docker container started successfully.')
-    except subprocess.CalledProcessError as e:
+        docker_container.ensure_container(DOCKER_CONTAINER_NAME, image, [(SAVE_DIRECTORY, '/ultralytics/images')],
+                                          ['--ipc=host', '--runtime=nvidia'])
+    except docker_container.ContainerError as e:
         print(f'Error starting Docker container: {e}')
-        print(f'Error output: {e.stderr}')
         exit(1)
 
 def stop_docker_container():
+    if KEEP_CONTAINER:
+        print('Leaving the YOLOv8 Docker container running for the next start.')
+        return
     print('Stopping YOLOv8 Docker container...')
-    command = ['sudo', 'docker', 'stop', DOCKER_CONTAINER_NAME]
     try:
-        subprocess.run(command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        docker_container.stop_container(DOCKER_CONTAINER_NAME)
         print('Docker container stopped successfully.')
-    except subprocess.CalledProcessError as e:
+    except docker_container.ContainerError as e:
         print(f'Error stopping Docker container: {e}')
-        print(f'Error output: {e.stderr}')
-
-def run_inference(image_path):
-    print(f'Running YOLOv8 inference on {image_path}...')
-    command = [
-        'sudo', 'docker', 'exec', DOCKER_CONTAINER_NAME,
-        'yolo', 'detect', 'predict',
-        f'source=images/{os.path.basename(image_path)}',
-        'model=images/best_v8n.pt',
-        'project=images/pred',
-        'save_txt',
-        'exist_ok=True'
-    ]
+
+def run_inference(image_path, timer):
     try:
-        result = subprocess.run(command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
-        print('Inference completed successfully.')
+        with timer.stage('inference'):
+            result = yolo_client.predict(image_path)
+        metrics.BATCH_SIZE.observe(1)
         file_name = os.path.basename(image_path)
         pure_name = os.path.splitext(file_name)[0]
-        return pure_name
-    except subprocess.CalledProcessError as e:
-        print(f'Error running YOLOv8 inference: {e}')
-        print(f'Error output: {e.stderr}')
-        return None
+        return pure_name, result['labels']
+    except Exception as e:
+        timer.trace.error('inference_error', image=image_path, error=str(e))
+        return None, []
 
 def send_file(conn, file_path):
-    with open(file_path, 'rb') as f:
-        file_data = f.read()
-    
-    file_name = os.path.basename(file_path).encode('utf-8')
-    name_length = len(file_name)
-    file_size = len(file_data)
-
-    conn.sendall(struct.pack('!I', name_length))
-    conn.sendall(file_name)
-    conn.sendall(struct.pack('!Q', file_size))
-
-    conn.sendall(file_data)
-    print(f'Sent file: {file_path}')
-
-def receive_file(conn, save_directory):
-    name_length = struct.unpack('!I', conn.recv(4))[0]
-
-    file_name = conn.recv(name_length).decode('utf-8')
-    file_path = os.path.join(save_directory, file_name)
-
-    file_size = struct.unpack('!Q', conn.recv(8))[0]
-
-    print(f'Receiving file: {file_name}, Size: {file_size} bytes')
-
-    with open(file_path, 'wb') as f:
-        remaining = file_size
-        while remaining > 0:
-            chunk_size = 4096 if remaining > 4096 else remaining
-            chunk = conn.recv(chunk_size)
-            if not chunk:
-                raise ConnectionError("Connection closed while receiving file")
-            f.write(chunk)
-            remaining -= len(chunk)
+    transfer.send_file(conn, file_path)
+    metrics.SENT_BYTES.inc(4 + len(os.path.basename(file_path).encode('utf-8')) + 8 + os.path.getsize(file_path))
+
+def receive_file(conn, save_directory, timer):
+    with timer.stage('receive'):
+        conn.settimeout(HEADER_TIMEOUT)
+        file_name, file_size = transfer.recv_header(conn)
+        conn.settimeout(RECEIVE_TIMEOUT)
+        file_path = os.path.join(save_directory, file_name)
+        transfer.receive_to_file(conn, file_path, file_size)
+    size = os.path.getsize(file_path)
+    metrics.RECEIVED_BYTES.inc(size)
+    timer.trace.event('receive', name=os.path.basename(file_path), size=size)
+    return file_path
 
+def crop_to_input(file_path):
     img = cv2.imread(file_path)
     h, w, _ = img.shape
     crop_size = min(h, w)
@@ -123,70 +95,118 @@ def receive_file(conn, save_directory):
     img = img[y:y+crop_size, x:x+crop_size]
     img = cv2.resize(img, (640, 640))
     cv2.imwrite(file_path, img)
-    print(f'File successfully saved at {file_path}')
-    return file_path
 
 def handle_client(conn, addr, inference_queue):
-    print(f'Connected with {addr}')
+    trace = tracer.trace('connect', peer=addr)
+    handed_off = False  # A queued upload is closed by the worker that answers it
     try:
-        file_path = receive_file(conn, SAVE_DIRECTORY)
-        if file_path:
-            inference_queue.put((conn, file_path))
-        else:
-            print("File reception failed.")
+        conn.settimeout(HEADER_TIMEOUT)
+        # `GET /metrics` scrapes the Prometheus metrics, anything else is an upload
+        if conn.recv(4, socket.MSG_PEEK | socket.MSG_WAITALL) == metrics.HTTP_PREFIX:
+            conn.sendall(metrics.http_response(metrics.read_http_head(conn, b'')))
+            return
+        timer = metrics.RequestTimer(trace)
+        file_path = receive_file(conn, SAVE_DIRECTORY, timer)
+        if not file_path:
+            trace.error('receive_failed')
+            return
+        retry_after = rate_limiter.check(addr[0])
+        if retry_after:
+            metrics.RATE_LIMITED.inc()
+            refuse(conn, {'status': 'rate_limited', 'retry_after_ms': int(1000 * min(retry_after, 3600))}, timer)
+            return
+        with timer.stage('preprocess'):
+            crop_to_input(file_path)
+        metrics.IN_FLIGHT.inc()
+        timer.enqueue()
+        # Workers take uploads in turn per peer, so one busy camera cannot starve the others
+        inference_queue.put(Entry((conn, file_path, timer), client=addr[0]))
+        handed_off = True
+    except socket.timeout:
+        metrics.TIMEOUTS.inc(phase='receive')
+        trace.error('timeout', phase='receive')
     except Exception as e:
-        print(f'An error occurred while handling client: {e}')
+        trace.error('error', error=str(e))
     finally:
-        pass
+        if not handed_off:
+            conn.close()
+
+def refuse(conn, header, timer):
+    # Legacy clients only parse a result, so a refused upload is answered by
+    # closing the connection; retry_after_ms is for v2 ERROR frames
+    conn.close()
+    timer.finish('legacy', header['status'])
 
 def inference_worker(inference_queue):
     while True:
-        conn, file_path = inference_queue.get()
+        conn, file_path, timer = inference_queue.get().item
+        timer.record('queue', time.perf_counter() - timer.queued)
+        status = 'send_failed'
         try:
-            predicted_name = run_inference(file_path)
-            predicted_image_path = 'images/pred/predict/' + predicted_name + '.jpg'
+            if transfer.peer_closed(conn):
+                # The client gave up while queued, do not spend an inference on it
+                timer.abandoned()
+                status = 'abandoned'
+                continue
+            predicted_name, labels = run_inference(file_path, timer)
+            conn.settimeout(SEND_TIMEOUT)
+            predicted_image_path = predicted_name and 'images/pred/predict/' + predicted_name + '.jpg'
 
             if predicted_image_path and os.path.exists(predicted_image_path):
-                predicted_text_path = 'images/pred/predict/labels/' + predicted_name + '.txt'
+                sending = time.perf_counter()
                 send_file(conn, predicted_image_path)
 
-                with open(predicted_text_path, 'r') as file:
-                    lines = file.readlines()
-
                 names = {
                     0: 'Belalang', 1: 'Bercak Cokelat', 2: 'Keong', 3: 'Kresek',
                     4: 'Penggerek Batang', 5: 'Penggulung', 6: 'Predator', 7: 'Ulat',
                     8: 'Walang Sangit', 9: 'Wereng'
                 }
 
-                detected_objects = []
-                for line in lines:
-                    box = list(map(float, line.split()))
-                    detected_objects.append(names.get(int(box[0])))
+                # One entry per detection, so clients that count them get real counts
+                detected_objects = [names.get(label) for label in labels]
 
-                output_string = json.dumps(list(set(detected_objects)))
+                output_string = json.dumps(detected_objects)
                 text_data = output_string.encode('utf-8')
                 text_length = len(text_data)
                 conn.sendall(struct.pack('!I', text_length))
                 conn.sendall(text_data)
+                metrics.SENT_BYTES.inc(4 + text_length)
+                timer.record('send', time.perf_counter() - sending)
+                status = 'ok'
             else:
-                print("Predicted image not found or inference failed.")
                 conn.send(b"INFERENCE_FAILED")
+                status = 'inference_failed'
+        except socket.timeout:
+            metrics.TIMEOUTS.inc(phase='send')
+            timer.trace.error('timeout', phase='send')
         except Exception as e:
-            print(f'An error occurred during inference: {e}')
+            timer.trace.error('send_error', error=str(e))
         finally:
             conn.close()
-            print("Connection closed.")
+            metrics.IN_FLIGHT.dec()
+            timer.finish('legacy', status)
+            timer.trace.event('close')
             inference_queue.task_done()
 
 def main():
-    start_docker_container()
+    global yolo_client, tracer, rate_limiter
+    yolo_client = create_backend(INFERENCE_BACKEND, DOCKER_CONTAINER_NAME, MODEL_PATH)
+    if yolo_client.NEEDS_CONTAINER:
+        start_docker_container()
+    yolo_client.start()
+    warm_up(yolo_client, WARMUP_INFERENCES)
+    tracer = tracing.Tracer(TRACE_FILE and os.path.join(SAVE_DIRECTORY, TRACE_FILE), TRACE_SAMPLE_RATE, TRACE_MAX_PENDING)
+    tracer.start()
+    metrics.TRACE_DROPPED.set_function(lambda: tracer.dropped)
+    rate_limiter = RateLimiter(RATE_LIMIT, DEVICE_RATE_LIMITS)
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server_socket.bind(('0.0.0.0', 12345))
+    server_socket.bind(('0.0.0.0', PORT))
     server_socket.listen(5)
     print('Server is listening for connections...')
 
-    inference_queue = queue.Queue()
+    inference_queue = FairQueue()
+    metrics.QUEUE_DEPTH.set_function(inference_queue.qsize)
+    metrics.ACTIVE_CLIENTS.set_function(inference_queue.active_clients)
 
     for _ in range(MAX_WORKERS):
         threading.Thread(target=inference_worker, args=(inference_queue,), daemon=True).start()
@@ -199,7 +219,9 @@ def main():
     except KeyboardInterrupt:
         print('Shutting down server...')
     finally:
-        stop_docker_container()
+        yolo_client.stop()
+        if yolo_client.NEEDS_CONTAINER:
+            stop_docker_container()
 
 if __name__ == "__main__":
     main()
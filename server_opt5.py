@@ -1,229 +1,592 @@
 import socket
+import select
 import os
 import struct
 from Crypto.Cipher import AES
 from Crypto.Util.Padding import pad
 from Crypto.Random import get_random_bytes
-import subprocess
 import time
 import threading
 from concurrent.futures import ThreadPoolExecutor
-import queue
 import json
+from collections import Counter
+from inference_backends import CONTAINER_BACKENDS, create_backend, warm_up
+import build_model
+from micro_batcher import MicroBatcher, PRIORITIES, DEFAULT_PRIORITY
+from disk_writer import DiskWriter
+import wire_protocol
+import stream_crypto
+import transfer
+import docker_container
+import metrics
+import tracing
+from rate_limiter import RateLimiter
+from wire_protocol import MAGIC, recv_exact
 
 SAVE_DIRECTORY = r'/home/jetson/edge_server/images' 
 MAX_WORKERS = 4  
+PORT = 12345
 DOCKER_CONTAINER_NAME = 'ultralytics_inference'
+DOCKER_IMAGE = 'ultralytics/ultralytics:latest-jetson-jetpack4'
 BUFFER_SIZE = 4096
-AES_KEY = b'Sixteen byte key'
+AES_KEY = b'Sixteen byte key'  # Legacy result files; public, the legacy clients have it built in
+SESSION_KEY = None  # v2 frames, from KEY_FILE; without one no session is offered encryption
+KEY_FILE = stream_crypto.KEY_FILE  # Next to this script: the AES key shared with the clients, see stream_crypto.load_key
+BATCH_MAX_SIZE = 8
+BATCH_MAX_WAIT_MS = 20
+BATCH_STATS_INTERVAL = 60
+IN_MEMORY = True  # Keep uploads and results in memory instead of round-tripping through SAVE_DIRECTORY
+PERSIST_UPLOADS = True  # In memory mode, still save uploads and results to disk in the background
+HEADER_TIMEOUT = 10  # Seconds without data before a connection that has not said what it is sending is closed
+RECEIVE_TIMEOUT = 60  # Seconds without data before a stalled upload is abandoned; also bounds v2 session writes
+SEND_TIMEOUT = 30  # Seconds a legacy response write may block on a client that does not read
+SESSION_IDLE_TIMEOUT = 300  # Seconds a v2 session may wait between requests
+RATE_LIMIT = None  # (uploads per second, burst) per device, None for no limit
+DEVICE_RATE_LIMITS = {}  # Device id or peer address: (uploads per second, burst) or None, instead of RATE_LIMIT
+LEGACY_PRIORITY = 'interactive'  # Legacy clients are the field apps; v2 requests name their class, see micro_batcher
+TRACE_FILE = 'trace.jsonl'  # JSON lines request events, in SAVE_DIRECTORY; None writes them to stdout
+TRACE_SAMPLE_RATE = 0.1  # Share of requests whose events are recorded; failures always are
+TRACE_MAX_PENDING = 4096  # Events waiting for the trace writer; more are dropped and counted
 
-def remove_existing_container():
-    print('Checking for existing container...')
-    command = ['sudo', 'docker', 'ps', '-aq', '-f', f'name={DOCKER_CONTAINER_NAME}']
-    try:
-        result = subprocess.run(command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
-        container_id = result.stdout.strip()
-        if container_id:
-            print(f'Removing existing container {container_id}...')
-            remove_command = ['sudo', 'docker', 'rm', '-f', container_id]
-            subprocess.run(remove_command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
-            print('Existing container removed successfully.')
-        else:
-            print('No existing container found.')
-    except subprocess.CalledProcessError as e:
-        print(f'Error checking/removing existing container: {e}')
-        print(f'Error output: {e.stderr}')
-
-import subprocess
+CLASS_NAMES = {
+    0: 'Belalang', 1: 'Bercak Cokelat', 2: 'Keong', 3: 'Kresek',
+    4: 'Penggerek Batang', 5: 'Penggulung', 6: 'Predator', 7: 'Ulat',
+    8: 'Walang Sangit', 9: 'Wereng'
+}
 
 DOCKER_CONTAINER_NAME = 'yolov8_container'
 SAVE_DIRECTORY = '/path/to/save/directory'
+MODEL_PATH = 'images/best_v8n.engine'
+INFERENCE_BACKEND = 'docker'  # See inference_backends.BACKENDS
+KEEP_CONTAINER = True  # Leave the container running on shutdown so the next start reuses it
+MODEL_WEIGHTS = 'best_v8n.pt'  # In SAVE_DIRECTORY; the served model is built from it, see build_model.py
+MODEL_PRECISION = 'fp16'
+INPUT_SIZE = 640
+UPLOAD_QUALITY = 90  # JPEG quality clients should use when they resize to the advertised input
+BUILD_ARTIFACTS = True  # False serves MODEL_PATH as it is
+WARMUP_INFERENCES = 3  # Run before accepting connections
 
-def remove_existing_container():
-    try:
-        command = ['sudo', 'docker', 'rm', '-f', DOCKER_CONTAINER_NAME]
-        subprocess.run(command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
-    except subprocess.CalledProcessError as e:
-        print(f'Error removing existing Docker container: {e}')
-        print(f'Error output: {e.stderr}')
+yolo_client = None
+disk_writer = DiskWriter()
+tracer = None
+rate_limiter = None
 
 def start_docker_container():
-    remove_existing_container()
-    print('Starting YOLOv8 Docker container...')
-    command = [
-        'sudo', 'docker', 'run', '-d', '--name', DOCKER_CONTAINER_NAME, '--ipc=host', '--runtime=nvidia', '--gpus=0,1',
-        '-v', f'{SAVE_DIRECTORY}:/ultralytics/images:rw',
-        'ultralytics/ultralytics:latest-jetson-jetpack4', 'sleep', 'infinity'
-    ]
-    
+    image = docker_container.ensure_image(DOCKER_IMAGE)
     try:
-        result = subprocess.run(command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
-        print('Docker container started successfully.')
-    except subprocess.CalledProcessError as e:
+        docker_container.ensure_container(DOCKER_CONTAINER_NAME, image, [(SAVE_DIRECTORY, '/ultralytics/images')],
+                                          ['--ipc=host', '--runtime=nvidia', '--gpus=0,1'])
+    except docker_container.ContainerError as e:
         print(f'Error starting Docker container: {e}')
-        print(f'Error output: {e.stderr}')
         exit(1)
-    
-    print('Installing pycryptodome library...')
-    install_command = [
-        'sudo', 'docker', 'exec', DOCKER_CONTAINER_NAME, 'pip3', 'install', 'pycryptodome'
-    ]
-    try:
-        install_result = subprocess.run(install_command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
-        print('pycryptodome library installed successfully.')
-    except subprocess.CalledProcessError as e:
-        print(f'Error installing pycryptodome library: {e}')
-        print(f'Error output: {e.stderr}')
-        exit
 
 def stop_docker_container():
+    if KEEP_CONTAINER:
+        print('Leaving the YOLOv8 Docker container running for the next start.')
+        return
     print('Stopping YOLOv8 Docker container...')
-    command = ['sudo', 'docker', 'stop', DOCKER_CONTAINER_NAME]
     try:
-        subprocess.run(command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        docker_container.stop_container(DOCKER_CONTAINER_NAME)
         print('Docker container stopped successfully.')
-    except subprocess.CalledProcessError as e:
+    except docker_container.ContainerError as e:
         print(f'Error stopping Docker container: {e}')
-        print(f'Error output: {e.stderr}')
 
 def run_inference(image_path):
-    print(f'Running YOLOv8 inference on {image_path}...')
-    command = [
-        'sudo', 'docker', 'exec', DOCKER_CONTAINER_NAME,
-        'yolo', 'detect', 'predict',
-        f'source=images/{os.path.basename(image_path)}',
-        'model=images/best_v8n.engine',
-        'project=images/pred',
-        'save_txt',
-        'exist_ok=True'
-    ]
     try:
-        result = subprocess.run(command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
-        print('Inference completed successfully.')
+        yolo_client.predict(image_path)
         file_name = os.path.basename(image_path)
         pure_name = os.path.splitext(file_name)[0]
         return pure_name
-    except subprocess.CalledProcessError as e:
-        print(f'Error running YOLOv8 inference: {e}')
-        print(f'Error output: {e.stderr}')
+    except Exception as e:
+        tracer.event('inference_error', image=image_path, error=str(e))
         return None
 
+def run_inference_batch(image_paths):
+    try:
+        results = yolo_client.predict_batch(image_paths)
+    except Exception as e:
+        tracer.event('inference_error', batch_size=len(image_paths), error=str(e))
+        return [(None, [])] * len(image_paths)
+
+    predictions = []
+    for image_path, result in zip(image_paths, results):
+        if result.get('ok'):
+            predictions.append((os.path.splitext(os.path.basename(image_path))[0], result['labels']))
+        else:
+            tracer.event('inference_error', image=image_path, error=result.get('error'))
+            predictions.append((None, []))
+    return predictions
+
+def run_inference_bytes(uploads):
+    try:
+        return yolo_client.predict_bytes(uploads)
+    except Exception as e:
+        tracer.event('inference_error', batch_size=len(uploads), error=str(e))
+        return [None] * len(uploads)
+
 def send_file(conn, file_path):
     with open(file_path, 'rb') as f:
         file_data = f.read()
+    send_bytes(conn, os.path.basename(file_path), file_data)
 
+def send_bytes(conn, file_name, file_data):
     # Encrypt file_data with AES
     iv = get_random_bytes(16)
     cipher = AES.new(AES_KEY, AES.MODE_CBC, iv)
     encrypted_data = cipher.encrypt(pad(file_data, AES.block_size))
 
-    file_name = os.path.basename(file_path).encode('utf-8')
-    name_length = len(file_name)
-    file_size = len(encrypted_data) + len(iv)
-
-    conn.sendall(struct.pack('!I', name_length))
-    conn.sendall(file_name)
-    conn.sendall(struct.pack('!Q', file_size))
+    transfer.send_header(conn, file_name, len(encrypted_data) + len(iv))
     conn.sendall(iv)
     conn.sendall(encrypted_data)
+    metrics.SENT_BYTES.inc(4 + len(file_name.encode('utf-8')) + 8 + len(iv) + len(encrypted_data))
 
-def receive_file(conn, save_directory):
-    name_length = struct.unpack('!I', conn.recv(4))[0]
-
-    file_name = conn.recv(name_length).decode('utf-8')
+def receive_file(conn, save_directory, trace, name_length=None):
+    file_name, file_size = transfer.recv_header(conn, name_length)
+    conn.settimeout(RECEIVE_TIMEOUT)
     file_path = os.path.join(save_directory, file_name)
+    transfer.receive_to_file(conn, file_path, file_size)
+    trace.event('saved', path=file_path)
+    return file_path
 
-    file_size = struct.unpack('!Q', conn.recv(8))[0]
+def receive_upload(conn, trace, name_length=None):
+    file_name, file_size = transfer.recv_header(conn, name_length)
+    trace.event('receive', name=file_name, size=file_size)
+    conn.settimeout(RECEIVE_TIMEOUT)
+    return file_name, transfer.receive_bytes(conn, file_size)
 
-    print(f'Receiving file: {file_name}, Size: {file_size} bytes')
+def over_rate_limit(client):
+    # The reply header when the device is over its rate limit, else None
+    retry_after = rate_limiter.check(client)
+    if not retry_after:
+        return None
+    metrics.RATE_LIMITED.inc()
+    return {'status': 'rate_limited', 'retry_after_ms': int(1000 * min(retry_after, 3600))}
 
-    with open(file_path, 'wb') as f:
-        remaining = file_size
-        while remaining > 0:
-            chunk_size = 4096 if remaining > 4096 else remaining
-            chunk = conn.recv(chunk_size)
-            if not chunk:
-                raise ConnectionError("Connection closed while receiving file")
-            f.write(chunk)
-            remaining -= len(chunk)
+def refuse(conn, header, timer):
+    # Legacy clients only parse a result, so a refused upload is answered by
+    # closing the connection; retry_after_ms is for v2 ERROR frames
+    conn.close()
+    timer.finish('legacy', header['status'])
 
-    print(f'File successfully saved at {file_path}')
-    return file_path
+def enqueue(batcher, target, upload, timer, size, client, deadline=None):
+    metrics.RECEIVED_BYTES.inc(size)
+    metrics.IN_FLIGHT.inc()
+    timer.enqueue()
+    batcher.put((target, upload, timer), timer.priority, deadline, client)
 
-def handle_client(conn, addr, inference_queue):
-    print(f'Connected with {addr}')
+def handle_client(conn, addr, batcher):
+    trace = tracer.trace('connect', peer=addr)
+    handed_off = False  # A queued upload or a session closes the connection itself when done
     try:
-        file_path = receive_file(conn, SAVE_DIRECTORY)
-        if file_path:
-            inference_queue.put((conn, file_path))
+        conn.settimeout(HEADER_TIMEOUT)
+        # v2 clients open with MAGIC, legacy clients with the file name length,
+        # and `GET /metrics` scrapes the Prometheus metrics
+        prefix = recv_exact(conn, 4)
+        if prefix == MAGIC:
+            handed_off = True
+            handle_session(ClientSession(conn, addr, trace), batcher)
+            return
+        if prefix == metrics.HTTP_PREFIX:
+            conn.sendall(metrics.http_response(metrics.read_http_head(conn)))
+            return
+        name_length = struct.unpack('!I', prefix)[0]
+        timer = metrics.RequestTimer(trace)
+        timer.priority = LEGACY_PRIORITY
+
+        if IN_MEMORY:
+            with timer.stage('receive'):
+                file_name, data = receive_upload(conn, trace, name_length)
+            limited = over_rate_limit(addr[0])
+            if limited:
+                refuse(conn, limited, timer)
+                return
+            if PERSIST_UPLOADS:
+                disk_writer.write(os.path.join(SAVE_DIRECTORY, os.path.basename(file_name)), data)
+            enqueue(batcher, conn, (file_name, data), timer, len(data), addr[0])
+            handed_off = True
+            return
+        with timer.stage('receive'):
+            file_path = receive_file(conn, SAVE_DIRECTORY, trace, name_length)
+        limited = file_path and over_rate_limit(addr[0])
+        if limited:
+            refuse(conn, limited, timer)
+        elif file_path:
+            enqueue(batcher, conn, file_path, timer, os.path.getsize(file_path), addr[0])
+            handed_off = True
         else:
-            print("File reception failed.")
+            trace.error('receive_failed')
+    except socket.timeout:
+        metrics.TIMEOUTS.inc(phase='receive')
+        trace.error('timeout', phase='receive')
     except Exception as e:
-        print(f'An error occurred while handling client: {e}')
+        trace.error('error', error=str(e))
     finally:
+        if not handed_off:
+            conn.close()
+
+class ClientSession:
+    # A v2 connection. Responses from the inference pool are written under a
+    # lock, and the connection is closed once the client has stopped sending
+    # and every accepted request has been answered. A session whose client
+    # disconnected without BYE, or stopped reading, is gone: its queued
+    # requests are dropped instead of run.
+    def __init__(self, conn, addr, trace):
+        self.conn = conn
+        self.trace = trace
+        self.device = addr[0]  # Replaced by the device id from the HELLO, if any
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.reading = True
+        self.closed = False
+        self.gone = False
+        self.key = None  # Set when the client asked for encryption
+
+    def send(self, frame_type, request_id, header, body=b''):
+        with self.lock:
+            if self.gone:
+                raise ConnectionError('Client went away')
+            if not self.closed:
+                try:
+                    sent = wire_protocol.send_frame(self.conn, frame_type, request_id, header, body, self.key)
+                except OSError:
+                    # A half-written frame cannot be recovered; wake the reader too
+                    self.gone = True
+                    try:
+                        self.conn.shutdown(socket.SHUT_RDWR)
+                    except OSError:
+                        pass
+                    raise
+                metrics.SENT_BYTES.inc(sent)
+
+    def begin_request(self):
+        with self.lock:
+            self.pending += 1
+
+    def finish_request(self):
+        with self.lock:
+            self.pending -= 1
+            self._close_if_done()
+
+    def stop_reading(self, gone=False):
+        with self.lock:
+            self.reading = False
+            self.gone = self.gone or gone
+            self._close_if_done()
+
+    def _close_if_done(self):
+        if not self.reading and self.pending == 0 and not self.closed:
+            self.closed = True
+            self.conn.close()
+            self.trace.event('close')
+
+class SessionReply:
+    def __init__(self, session, request_id, timings=False, labels_only=False):
+        self.session = session
+        self.request_id = request_id
+        self.timings = timings  # Return the stage timings in the response header
+        self.labels_only = labels_only  # Detections only, no annotated image is rendered or sent
+
+def input_geometry():
+    # Advertised in the HELLO reply so clients resize before uploading. The
+    # model letterboxes whole photos here, so uploads are only scaled down
+    # and boxes stay relative to the original photo.
+    return {'size': INPUT_SIZE, 'mode': 'letterbox', 'quality': UPLOAD_QUALITY}
+
+def handle_session(session, batcher):
+    gone = True  # Unless the client says BYE
+    try:
+        frame_type, _, hello, _ = wire_protocol.recv_frame(session.conn)
+        if frame_type != wire_protocol.HELLO:
+            raise ConnectionError(f'Expected HELLO, got frame type {frame_type}')
+        server_hello = {'version': wire_protocol.PROTOCOL_VERSION, 'input': input_geometry()}
+        if hello.get('encryption') == stream_crypto.CIPHER and SESSION_KEY:
+            server_hello['encryption'] = stream_crypto.CIPHER
+        session.send(wire_protocol.HELLO, 0, server_hello)
+        if 'encryption' in server_hello:
+            session.key = SESSION_KEY
+        # Devices name themselves so they keep their fair share and rate limit across addresses
+        session.device = str(hello.get('device') or session.device)
+        session.trace.event('session', client_version=hello.get('version'), encryption=session.key is not None,
+                            device=session.device)
+
+        session.conn.settimeout(RECEIVE_TIMEOUT)
+        while True:
+            # Wait for the next frame before starting its clock. Responses
+            # are written from other threads meanwhile, so the idle wait
+            # cannot be a socket timeout.
+            if not select.select([session.conn], [], [], SESSION_IDLE_TIMEOUT)[0]:
+                metrics.TIMEOUTS.inc(phase='idle')
+                session.trace.event('timeout', phase='idle')
+                gone = False
+                break
+            if not session.conn.recv(1, socket.MSG_PEEK):
+                break
+            timer = metrics.RequestTimer()
+            received = time.monotonic()
+            with timer.stage('receive'):
+                frame_type, request_id, header, body = wire_protocol.recv_frame(session.conn, session.key)
+            if frame_type == wire_protocol.BYE:
+                gone = False
+                break
+            if frame_type != wire_protocol.REQUEST:
+                session.send(wire_protocol.ERROR, request_id, {'status': 'bad_frame'})
+                continue
+            file_name = os.path.basename(header.get('name', f'{request_id}.jpg'))
+            limited = over_rate_limit(session.device)
+            if limited:
+                session.send(wire_protocol.ERROR, request_id, dict(limited, name=file_name))
+                timer.finish('v2', limited['status'])
+                continue
+            timer.trace = tracer.trace('receive', connection=session.trace.id, request=request_id, name=file_name, size=len(body))
+            timer.priority = header.get('priority') if header.get('priority') in PRIORITIES else DEFAULT_PRIORITY
+            # The deadline budget counts from when the request started arriving
+            deadline = received + header['deadline_ms'] / 1000.0 if header.get('deadline_ms') else None
+            if PERSIST_UPLOADS:
+                disk_writer.write(os.path.join(SAVE_DIRECTORY, file_name), body)
+            session.begin_request()
+            reply = SessionReply(session, request_id, bool(header.get('timings')), bool(header.get('labels_only')))
+            enqueue(batcher, reply, (file_name, body), timer, len(body), session.device, deadline)
+    except ConnectionError:
         pass
+    except socket.timeout:
+        metrics.TIMEOUTS.inc(phase='receive')
+        session.trace.error('timeout', phase='receive')
+    except Exception as e:
+        gone = False
+        session.trace.error('error', error=str(e))
+    finally:
+        session.stop_reading(gone)
+
+def detection_payload(boxes):
+    # Compact detections: each box is [class id, confidence, x, y, w, h] with
+    # normalized center coordinates, plus names and counts per detected class
+    class_ids = sorted(set(box[0] for box in boxes))
+    return {
+        'classes': {class_id: CLASS_NAMES.get(class_id) for class_id in class_ids},
+        'counts': dict(Counter(CLASS_NAMES.get(box[0]) for box in boxes)),
+        'boxes': boxes,
+    }
+
+def send_session_result(reply, file_name, result, timer):
+    session = reply.session
+    status = 'send_failed'
+    try:
+        if result and result.get('ok'):
+            with timer.stage('postprocess'):
+                header = {
+                    'status': 'ok',
+                    'name': file_name,
+                    'objects': list(set(CLASS_NAMES.get(label) for label in result['labels'])),
+                    'detections': detection_payload(result.get('boxes', [])),
+                }
+            if reply.timings:
+                # Stages up to the response itself, in milliseconds; send cannot be included
+                header['timings'] = timer.milliseconds()
+            body = b'' if reply.labels_only else result['image']
+            with timer.stage('send'):
+                session.send(wire_protocol.RESPONSE, reply.request_id, header, body)
+            status = 'ok'
+            if PERSIST_UPLOADS and body:
+                disk_writer.write(os.path.join(SAVE_DIRECTORY, 'pred', 'predict', file_name), body)
+        else:
+            session.send(wire_protocol.ERROR, reply.request_id, {'status': 'inference_failed', 'name': file_name})
+            status = 'inference_failed'
+    except Exception as e:
+        timer.trace.error('send_error', error=str(e))
+    finally:
+        session.finish_request()
+        metrics.IN_FLIGHT.dec()
+        timer.finish('v2', status)
 
-def inference_worker(inference_queue):
-    while True:
-        conn, file_path = inference_queue.get()
-        try:
-            predicted_name = run_inference(file_path)
-            predicted_image_path = 'images/pred/predict/' + predicted_name + '.jpg'
+def send_result(conn, predicted_name, labels, timer):
+    status = 'send_failed'
+    try:
+        conn.settimeout(SEND_TIMEOUT)
+        predicted_image_path = predicted_name and 'images/pred/predict/' + predicted_name + '.jpg'
 
-            if predicted_image_path and os.path.exists(predicted_image_path):
-                predicted_text_path = 'images/pred/predict/labels/' + predicted_name + '.txt'
+        if predicted_image_path and os.path.exists(predicted_image_path):
+            with timer.stage('send'):
                 send_file(conn, predicted_image_path)
+                send_labels(conn, labels)
+            status = 'ok'
+        else:
+            conn.send(b"INFERENCE_FAILED")
+            status = 'inference_failed'
+    except Exception as e:
+        timer.trace.error('send_error', error=str(e))
+    finally:
+        conn.close()
+        metrics.IN_FLIGHT.dec()
+        timer.finish('legacy', status)
+        timer.trace.event('close')
 
-                with open(predicted_text_path, 'r') as file:
-                    lines = file.readlines()
+def send_labels(conn, labels):
+    # One entry per detection, so clients that count them get real counts
+    detected_objects = [CLASS_NAMES.get(label) for label in labels]
+    output_string = json.dumps(detected_objects)
+    text_data = output_string.encode('utf-8')
+    text_length = len(text_data)
+    conn.sendall(struct.pack('!I', text_length))
+    conn.sendall(text_data)
+    metrics.SENT_BYTES.inc(4 + text_length)
 
-                names = {
-                    0: 'Belalang', 1: 'Bercak Cokelat', 2: 'Keong', 3: 'Kresek',
-                    4: 'Penggerek Batang', 5: 'Penggulung', 6: 'Predator', 7: 'Ulat',
-                    8: 'Walang Sangit', 9: 'Wereng'
-                }
+def send_result_bytes(conn, file_name, result, timer):
+    status = 'send_failed'
+    try:
+        conn.settimeout(SEND_TIMEOUT)
+        if result and result.get('ok'):
+            with timer.stage('send'):
+                send_bytes(conn, file_name, result['image'])
+                send_labels(conn, result['labels'])
+            status = 'ok'
+            if PERSIST_UPLOADS:
+                disk_writer.write(os.path.join(SAVE_DIRECTORY, 'pred', 'predict', os.path.basename(file_name)), result['image'])
+        else:
+            conn.send(b"INFERENCE_FAILED")
+            status = 'inference_failed'
+    except Exception as e:
+        timer.trace.error('send_error', error=str(e))
+    finally:
+        conn.close()
+        metrics.IN_FLIGHT.dec()
+        timer.finish('legacy', status)
+        timer.trace.event('close')
 
-                detected_objects = []
-                for line in lines:
-                    box = list(map(float, line.split()))
-                    detected_objects.append(names.get(int(box[0])))
-
-                output_string = json.dumps(list(set(detected_objects)))
-                text_data = output_string.encode('utf-8')
-                text_length = len(text_data)
-                conn.sendall(struct.pack('!I', text_length))
-                conn.sendall(text_data)
-            else:
-                print("Predicted image not found or inference failed.")
-                conn.send(b"INFERENCE_FAILED")
-        except Exception as e:
-            print(f'An error occurred during inference: {e}')
-        finally:
-            conn.close()
-            print("Connection closed.")
-            inference_queue.task_done()
+def send_expired(reply, file_name, timer):
+    try:
+        reply.session.send(wire_protocol.ERROR, reply.request_id, {'status': 'deadline_exceeded', 'name': file_name})
+    except Exception as e:
+        timer.trace.error('send_error', error=str(e))
+    finally:
+        reply.session.finish_request()
+        metrics.IN_FLIGHT.dec()
+        timer.finish('v2', 'deadline_exceeded')
+
+def expire_requests(items, response_executor):
+    # Dropped by the batcher at their deadline, before inference. Only v2
+    # requests carry deadlines.
+    for reply, (file_name, _), timer in items:
+        timer.expired()
+        response_executor.submit(send_expired, reply, file_name, timer)
+
+def timed(run, batch, inputs):
+    # Runs one forward pass and charges its time to every request in the batch
+    started = time.perf_counter()
+    outputs = run(inputs)
+    finished = time.perf_counter()
+    metrics.BATCH_SIZE.observe(len(batch))
+    for _, _, timer in batch:
+        timer.batched(started, finished)
+    return outputs
+
+def client_gone(target):
+    if isinstance(target, SessionReply):
+        return target.session.gone
+    return transfer.peer_closed(target)
+
+def drop_abandoned(item):
+    target, _, timer = item
+    timer.abandoned()
+    metrics.IN_FLIGHT.dec()
+    if isinstance(target, SessionReply):
+        target.session.finish_request()
+        timer.finish('v2', 'abandoned')
+    else:
+        target.close()
+        timer.finish('legacy', 'abandoned')
+
+def model_input(target, upload):
+    # Labels-only session requests skip rendering the annotated image
+    if isinstance(target, SessionReply) and target.labels_only:
+        return upload + (False,)
+    return upload
+
+def inference_worker(batch, response_executor):
+    # One batched forward pass, then fan the results back out to each client.
+    # Requests whose client has gone away meanwhile are dropped first rather
+    # than spending model time on answers nobody will read.
+    live = []
+    for item in batch:
+        if client_gone(item[0]):
+            drop_abandoned(item)
+        else:
+            live.append(item)
+    batch = live
+    if not batch:
+        return
+    if IN_MEMORY:
+        results = timed(run_inference_bytes, batch, [model_input(target, upload) for target, upload, _ in batch])
+        for (target, (file_name, _), timer), result in zip(batch, results):
+            sender = send_session_result if isinstance(target, SessionReply) else send_result_bytes
+            response_executor.submit(sender, target, file_name, result, timer)
+        return
+
+    # Session requests always arrive in memory, even when legacy uploads go through disk
+    session_items = [item for item in batch if isinstance(item[0], SessionReply)]
+    if session_items:
+        batch = [item for item in batch if not isinstance(item[0], SessionReply)]
+        results = timed(run_inference_bytes, session_items, [model_input(reply, upload) for reply, upload, _ in session_items])
+        for (reply, (file_name, _), timer), result in zip(session_items, results):
+            response_executor.submit(send_session_result, reply, file_name, result, timer)
+        if not batch:
+            return
+
+    predictions = timed(run_inference_batch, batch, [file_path for _, file_path, _ in batch])
+    for (conn, _, timer), (predicted_name, labels) in zip(batch, predictions):
+        response_executor.submit(send_result, conn, predicted_name, labels, timer)
+
+def load_key():
+    global SESSION_KEY
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), KEY_FILE)
+    SESSION_KEY = stream_crypto.load_key(path)
+    if SESSION_KEY is None:
+        print(f'No key file at {path}, v2 sessions will not be encrypted')
 
 def main():
-    start_docker_container()
+    global yolo_client, tracer, rate_limiter
+    needs_container = INFERENCE_BACKEND in CONTAINER_BACKENDS
+    if needs_container:
+        start_docker_container()
+    model_path = MODEL_PATH
+    if BUILD_ARTIFACTS:
+        container = DOCKER_CONTAINER_NAME if needs_container else None
+        model_path = build_model.artifact_for_backend(INFERENCE_BACKEND, SAVE_DIRECTORY, MODEL_WEIGHTS, INPUT_SIZE,
+                                                      MODEL_PRECISION, container) or MODEL_PATH
+    yolo_client = create_backend(INFERENCE_BACKEND, DOCKER_CONTAINER_NAME, model_path)
+    yolo_client.start()
+    warm_up(yolo_client, WARMUP_INFERENCES, INPUT_SIZE)
+    load_key()
+    disk_writer.start()
+    tracer = tracing.Tracer(TRACE_FILE and os.path.join(SAVE_DIRECTORY, TRACE_FILE), TRACE_SAMPLE_RATE, TRACE_MAX_PENDING)
+    tracer.start()
+    metrics.TRACE_DROPPED.set_function(lambda: tracer.dropped)
+    rate_limiter = RateLimiter(RATE_LIMIT, DEVICE_RATE_LIMITS)
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server_socket.bind(('0.0.0.0', 12345))
+    server_socket.bind(('0.0.0.0', PORT))
     server_socket.listen(5)
     print('Server is listening for connections...')
 
-    inference_queue = queue.Queue()
-
-    for _ in range(MAX_WORKERS):
-        threading.Thread(target=inference_worker, args=(inference_queue,), daemon=True).start()
+    response_executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+    batcher = MicroBatcher(
+        lambda batch: inference_worker(batch, response_executor),
+        BATCH_MAX_SIZE, BATCH_MAX_WAIT_MS / 1000.0,
+        lambda items: expire_requests(items, response_executor))
+    threading.Thread(target=batcher.run, daemon=True).start()
+    threading.Thread(target=batcher.report_stats, args=(BATCH_STATS_INTERVAL,), daemon=True).start()
+    metrics.QUEUE_DEPTH.set_function(batcher.qsize)
+    metrics.ACTIVE_CLIENTS.set_function(batcher.queue.active_clients)
 
     try:
         with ThreadPoolExecutor(max_workers=10) as executor:  # Adjust max_workers as needed
             while True:
                 conn, addr = server_socket.accept()
-                executor.submit(handle_client, conn, addr, inference_queue)
+                executor.submit(handle_client, conn, addr, batcher)
     except KeyboardInterrupt:
         print('Shutting down server...')
     finally:
-        stop_docker_container()
+        yolo_client.stop()
+        if yolo_client.NEEDS_CONTAINER:
+            stop_docker_container()
 
 if __name__ == "__main__":
     main()
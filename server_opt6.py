@@ -0,0 +1,733 @@
+import argparse
+import asyncio
+import os
+import struct
+import json
+import time
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from Crypto.Cipher import AES
+from Crypto.Util.Padding import pad
+from Crypto.Random import get_random_bytes
+from inference_backends import BACKENDS, CONTAINER_BACKENDS, create_backend, warm_up
+import build_model
+import docker_container
+from micro_batcher import AsyncMicroBatcher, PRIORITIES, DEFAULT_PRIORITY
+from disk_writer import DiskWriter
+from result_cache import ResultCache, make_key
+import wire_protocol
+import transfer
+import stream_crypto
+import preprocess
+import metrics
+import tracing
+from rate_limiter import RateLimiter
+from wire_protocol import MAGIC, FRAME
+
+SAVE_DIRECTORY = r'/home/jetson/edge_server/images'
+HOST = '0.0.0.0'
+PORT = 12345
+DOCKER_CONTAINER_NAME = 'ultralytics_inference'
+DOCKER_IMAGE = 'ultralytics/ultralytics:latest-jetson-jetpack4'
+MODEL_PATH = 'images/best_v8n.engine'
+INFERENCE_BACKEND = 'docker'  # See inference_backends.BACKENDS
+KEEP_CONTAINER = True  # Leave the container running on shutdown so the next start reuses it
+MODEL_WEIGHTS = 'best_v8n.pt'  # In SAVE_DIRECTORY; the served model is built from it, see build_model.py
+MODEL_PRECISION = 'fp16'
+BUILD_ARTIFACTS = True  # False serves MODEL_PATH as it is
+WARMUP_INFERENCES = 3  # Run before accepting connections
+AES_KEY = b'Sixteen byte key'  # Legacy result files; public, the legacy clients have it built in
+SESSION_KEY = None  # v2 frames, from KEY_FILE; without one no session is offered encryption
+KEY_FILE = stream_crypto.KEY_FILE  # Next to this script: the AES key shared with the clients, see stream_crypto.load_key
+BATCH_MAX_SIZE = 8
+BATCH_MAX_WAIT_MS = 20
+BATCH_STATS_INTERVAL = 60
+INFERENCE_CONCURRENCY = 1  # Batches in flight at once
+QUEUE_MAX_ITEMS = 32  # Uploads waiting for inference, including ones still being received
+QUEUE_MAX_BYTES = 64 * 1024 * 1024
+MAX_UPLOAD_SIZE = 32 * 1024 * 1024
+PERSIST_UPLOADS = True  # Save uploads and results to disk in the background
+CACHE_MAX_BYTES = 64 * 1024 * 1024  # In-memory result cache
+CACHE_DIRECTORY = os.path.join(SAVE_DIRECTORY, 'cache')
+CACHE_MAX_DISK_BYTES = 512 * 1024 * 1024  # 0 disables the disk tier
+PREPROCESS_MODE = 'letterbox'  # 'letterbox', 'center_crop', or None to let the worker decode the JPEG
+PREPROCESS_WORKERS = 4
+HEADER_TIMEOUT = 10  # Seconds for a connection's opening bytes, a legacy name and size or a v2 HELLO or request header
+RECEIVE_TIMEOUT = 60  # Seconds for a whole upload body to arrive
+SEND_TIMEOUT = 30  # Seconds for a response to be taken up by the client
+SESSION_IDLE_TIMEOUT = 300  # Seconds a v2 session may wait between requests
+RATE_LIMIT = None  # (uploads per second, burst) per device, None for no limit
+DEVICE_RATE_LIMITS = {}  # Device id or peer address: (uploads per second, burst) or None, instead of RATE_LIMIT
+LEGACY_PRIORITY = 'interactive'  # Legacy clients are the field apps; v2 requests name their class, see micro_batcher
+UPLOAD_QUALITY = 90  # JPEG quality clients should use when they resize to the advertised input
+TRACE_FILE = 'trace.jsonl'  # JSON lines request events, in SAVE_DIRECTORY; None writes them to stdout
+TRACE_SAMPLE_RATE = 0.1  # Share of requests whose events are recorded; failures always are
+TRACE_MAX_PENDING = 4096  # Events waiting for the trace writer; more are dropped and counted
+REANALYZE_BATCH_SIZE = 32  # Images per forward pass with --reanalyze, at most the model's max batch
+REANALYZE_PREFETCH = 4  # Batches decoded ahead of the model with --reanalyze
+REANALYZE_INDEX = 'reanalysis.jsonl'  # Detections written by --reanalyze, in the directory it reads
+REANALYZE_REPORT_INTERVAL = 30  # Seconds between progress lines
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+CLASS_NAMES = {
+    0: 'Belalang', 1: 'Bercak Cokelat', 2: 'Keong', 3: 'Kresek',
+    4: 'Penggerek Batang', 5: 'Penggulung', 6: 'Predator', 7: 'Ulat',
+    8: 'Walang Sangit', 9: 'Wereng'
+}
+
+yolo_client = None
+disk_writer = DiskWriter()
+batcher = None
+result_cache = None
+tracer = None
+rate_limiter = None
+preprocess_executor = None
+
+
+class ServerBusy(Exception):
+    # args[0] is the reply header, with the reason and when to retry
+    pass
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class PhaseTimeout(Exception):
+    # args[0] is the phase that stalled: receive, send or idle
+    pass
+
+
+class ClientGone(ConnectionError):
+    pass
+
+
+def start_docker_container():
+    image = docker_container.ensure_image(DOCKER_IMAGE)
+    try:
+        docker_container.ensure_container(DOCKER_CONTAINER_NAME, image, [(SAVE_DIRECTORY, '/ultralytics/images')],
+                                          ['--ipc=host', '--runtime=nvidia'])
+    except docker_container.ContainerError as e:
+        print(f'Error starting Docker container: {e}')
+        exit(1)
+
+def stop_docker_container():
+    if KEEP_CONTAINER:
+        print('Leaving the YOLOv8 Docker container running for the next start.')
+        return
+    print('Stopping YOLOv8 Docker container...')
+    try:
+        docker_container.stop_container(DOCKER_CONTAINER_NAME)
+        print('Docker container stopped successfully.')
+    except docker_container.ContainerError as e:
+        print(f'Error stopping Docker container: {e}')
+
+def run_inference_bytes(uploads):
+    try:
+        return yolo_client.predict_bytes(uploads)
+    except Exception as e:
+        tracer.event('inference_error', batch_size=len(uploads), error=str(e))
+        return [None] * len(uploads)
+
+async def inference_worker(batch):
+    # One batched forward pass off the event loop, then wake every waiting
+    # client. Requests cancelled while queued, because their client went
+    # away, are left out of it.
+    batch = [item for item in batch if not item[0].done()]
+    if not batch:
+        return
+    loop = asyncio.get_event_loop()
+    started = time.perf_counter()
+    results = await loop.run_in_executor(None, run_inference_bytes, [upload for _, upload, _ in batch])
+    finished = time.perf_counter()
+    metrics.BATCH_SIZE.observe(len(batch))
+    for (future, _, timer), result in zip(batch, results):
+        timer.batched(started, finished)
+        if not future.done():
+            future.set_result(result)
+
+def expire_requests(items):
+    # Dropped by the batcher at their deadline, before inference
+    for future, _, timer in items:
+        timer.expired()
+        if not future.done():
+            future.set_exception(DeadlineExceeded())
+
+def prepare_upload(file_name, data, render):
+    # Reduced-scale decode and resize to the model input, no re-encoding
+    if PREPROCESS_MODE is None:
+        return (file_name, data, render), None
+    if preprocess.jpeg_size(data) == (preprocess.INPUT_SIZE, preprocess.INPUT_SIZE):
+        # The client already sent the model input, let the worker decode it as is
+        return (file_name, data, render), None
+    image, transform = preprocess.preprocess(data, preprocess.INPUT_SIZE, PREPROCESS_MODE)
+    if image is None:
+        return (file_name, data, render), None
+    return (file_name, image, render), transform
+
+def persist(file_name, data, subdirectory=''):
+    if PERSIST_UPLOADS:
+        disk_writer.write(os.path.join(SAVE_DIRECTORY, subdirectory, os.path.basename(file_name)), data)
+
+async def within(phase, timeout, awaitable):
+    # None waits forever
+    try:
+        return await asyncio.wait_for(awaitable, timeout)
+    except asyncio.TimeoutError:
+        metrics.TIMEOUTS.inc(phase=phase)
+        raise PhaseTimeout(phase)
+
+async def drain(writer):
+    await within('send', SEND_TIMEOUT, writer.drain())
+
+async def until_disconnected(reader):
+    # Legacy clients send nothing after their upload, so the end of the
+    # stream means they gave up waiting
+    try:
+        while await reader.read(65536):
+            pass
+    except ConnectionError:
+        pass
+
+async def unless_disconnected(reader, awaitable):
+    # The result of awaitable, which is cancelled if the client disconnects first
+    task = asyncio.ensure_future(awaitable)
+    watch = asyncio.ensure_future(until_disconnected(reader))
+    try:
+        await asyncio.wait([task, watch], return_when=asyncio.FIRST_COMPLETED)
+        if not task.done():
+            task.cancel()
+            await asyncio.wait([task])
+            if task.cancelled():
+                raise ClientGone()
+    finally:
+        watch.cancel()
+        task.cancel()
+    return task.result()
+
+async def discard(reader, size):
+    while size > 0:
+        chunk = await reader.read(min(65536, size))
+        if not chunk:
+            raise asyncio.IncompleteReadError(b'', size)
+        size -= len(chunk)
+
+async def read_encrypted(reader, size, key, associated_data):
+    # Decrypts chunk by chunk as the body arrives
+    sizes = stream_crypto.chunk_sizes(size)
+    prefix = await reader.readexactly(stream_crypto.NONCE_PREFIX_SIZE)
+    data = bytearray()
+    for index, chunk_size in enumerate(sizes):
+        chunk = await reader.readexactly(chunk_size)
+        data += stream_crypto.decrypt_chunk(key, prefix, index, chunk, index == len(sizes) - 1, associated_data)
+    return bytes(data)
+
+async def receive_upload(reader, file_size, timer, client, key=None, associated_data=b''):
+    # Reserve queue room before reading the body so an overloaded server or
+    # a device over its rate limit is answered straight away instead of
+    # after the whole upload.
+    retry_after = rate_limiter.check(client)
+    if retry_after:
+        await within('receive', RECEIVE_TIMEOUT, discard(reader, file_size))
+        metrics.RATE_LIMITED.inc()
+        raise ServerBusy({'status': 'rate_limited', 'retry_after_ms': int(1000 * min(retry_after, 3600))})
+    if file_size > MAX_UPLOAD_SIZE or not batcher.admit(file_size):
+        await within('receive', RECEIVE_TIMEOUT, discard(reader, file_size))
+        raise ServerBusy(busy_header())
+    try:
+        with timer.stage('receive'):
+            if key:
+                data = await within('receive', RECEIVE_TIMEOUT, read_encrypted(reader, file_size, key, associated_data))
+            else:
+                data = await within('receive', RECEIVE_TIMEOUT, reader.readexactly(file_size))
+    except BaseException:
+        batcher.release(file_size)
+        raise
+    metrics.RECEIVED_BYTES.inc(file_size)
+    return data
+
+async def submit(file_name, data, timer, client, render=True, deadline=None):
+    persist(file_name, data)
+    queued = False
+
+    async def infer():
+        nonlocal queued
+        loop = asyncio.get_event_loop()
+        with timer.stage('preprocess'):
+            upload, transform = await loop.run_in_executor(preprocess_executor, prepare_upload, file_name, data, render)
+        queued = True
+        future = loop.create_future()
+        timer.enqueue()
+        batcher.put((future, upload, timer), len(data), timer.priority, deadline, client)
+        result = await future
+        if result and result.get('ok') and transform:
+            # Report boxes relative to the uploaded photo, not the model input
+            with timer.stage('postprocess'):
+                result['boxes'] = preprocess.unmap_boxes(result['boxes'], transform)
+        return result
+
+    # Resent photos are answered from the cache, concurrent duplicates share one inference
+    version = yolo_client.model_version if render else f'{yolo_client.model_version}:labels'
+    try:
+        return await result_cache.get_or_compute(make_key(data, version), infer)
+    finally:
+        if not queued:
+            batcher.release(len(data))
+            timer.cached = 'preprocess' not in timer.stages
+            if timer.cached:
+                metrics.CACHE_HITS.inc()
+
+def busy_header():
+    return {'status': 'busy', 'retry_after_ms': batcher.retry_after_ms(INFERENCE_CONCURRENCY)}
+
+def labels_to_objects(labels):
+    return list(set(CLASS_NAMES.get(label) for label in labels))
+
+def detection_payload(boxes):
+    # Compact detections: each box is [class id, confidence, x, y, w, h] with
+    # normalized center coordinates, plus names and counts per detected class
+    class_ids = sorted(set(box[0] for box in boxes))
+    return {
+        'classes': {class_id: CLASS_NAMES.get(class_id) for class_id in class_ids},
+        'counts': dict(Counter(CLASS_NAMES.get(box[0]) for box in boxes)),
+        'boxes': boxes,
+    }
+
+async def send_file(writer, file_name, file_data):
+    # Legacy response framing, AES-CBC encrypted as in server_opt5
+    iv = get_random_bytes(16)
+    cipher = AES.new(AES_KEY, AES.MODE_CBC, iv)
+    encrypted_data = cipher.encrypt(pad(file_data, AES.block_size))
+
+    name_bytes = file_name.encode('utf-8')
+    writer.write(struct.pack('!I', len(name_bytes)) + name_bytes + struct.pack('!Q', len(encrypted_data) + len(iv)))
+    writer.write(iv)
+    writer.write(encrypted_data)
+    await drain(writer)
+    metrics.SENT_BYTES.inc(4 + len(name_bytes) + 8 + len(iv) + len(encrypted_data))
+
+async def send_text(writer, text):
+    text_data = text.encode('utf-8')
+    writer.write(struct.pack('!I', len(text_data)) + text_data)
+    await drain(writer)
+    metrics.SENT_BYTES.inc(4 + len(text_data))
+
+async def handle_legacy(reader, writer, name_length, trace):
+    client = writer.get_extra_info('peername')[0]
+    transfer.check_name_length(name_length)
+    file_name = (await within('receive', HEADER_TIMEOUT, reader.readexactly(name_length))).decode('utf-8')
+    file_size = struct.unpack('!Q', await within('receive', HEADER_TIMEOUT, reader.readexactly(8)))[0]
+    trace.event('receive', name=file_name, size=file_size)
+    timer = metrics.RequestTimer(trace)
+    timer.priority = LEGACY_PRIORITY
+
+    try:
+        data = await receive_upload(reader, file_size, timer, client)
+    except ServerBusy as e:
+        # Legacy clients only parse a result, so a refused upload is answered
+        # by closing the connection; retry_after_ms is for v2 ERROR frames
+        timer.finish('legacy', e.args[0]['status'])
+        return
+
+    metrics.IN_FLIGHT.inc()
+    try:
+        try:
+            result = await unless_disconnected(reader, submit(file_name, data, timer, client))
+        except ClientGone:
+            timer.abandoned()
+            timer.finish('legacy', 'abandoned')
+            return
+        if result and result.get('ok'):
+            with timer.stage('send'):
+                await send_file(writer, file_name, result['image'])
+                # One entry per detection, so clients that count them get real counts
+                await send_text(writer, json.dumps([CLASS_NAMES.get(label) for label in result['labels']]))
+            persist(file_name, result['image'], os.path.join('pred', 'predict'))
+            timer.finish('legacy', 'ok')
+        else:
+            writer.write(b"INFERENCE_FAILED")
+            await drain(writer)
+            timer.finish('legacy', 'inference_failed')
+    except PhaseTimeout:
+        timer.finish('legacy', 'send_timeout')
+        raise
+    finally:
+        metrics.IN_FLIGHT.dec()
+
+async def send_frame(writer, write_lock, frame_type, request_id, header, body=b'', key=None):
+    header_bytes = wire_protocol.encode_header(frame_type, request_id, header, key)
+    body_length = stream_crypto.encrypted_size(len(body)) if key and body else len(body)
+    async with write_lock:
+        writer.write(FRAME.pack(frame_type, request_id, len(header_bytes), body_length) + header_bytes)
+        if body and key:
+            # Encrypt the next chunk while the previous one drains
+            for chunk in stream_crypto.encrypt_chunks(key, body, wire_protocol.frame_aad(frame_type, request_id)):
+                writer.write(chunk)
+                await drain(writer)
+        elif body:
+            writer.write(body)
+        await drain(writer)
+    metrics.SENT_BYTES.inc(FRAME.size + len(header_bytes) + body_length)
+
+async def handle_request(writer, write_lock, request_id, file_name, data, timer, client, labels_only=False, key=None,
+                         timings=False, deadline=None):
+    metrics.IN_FLIGHT.inc()
+    try:
+        try:
+            result = await submit(file_name, data, timer, client, render=not labels_only, deadline=deadline)
+        except DeadlineExceeded:
+            await send_frame(writer, write_lock, wire_protocol.ERROR, request_id, {'status': 'deadline_exceeded', 'name': file_name}, key=key)
+            timer.finish('v2', 'deadline_exceeded')
+            return
+        if result and result.get('ok'):
+            with timer.stage('postprocess'):
+                header = {
+                    'status': 'ok',
+                    'name': file_name,
+                    'objects': labels_to_objects(result['labels']),
+                    'detections': detection_payload(result.get('boxes', [])),
+                }
+            if timings:
+                # Stages up to the response itself, in milliseconds; send cannot be included
+                header['timings'] = timer.milliseconds()
+                header['cached'] = timer.cached
+            body = b'' if labels_only else result['image']
+            with timer.stage('send'):
+                await send_frame(writer, write_lock, wire_protocol.RESPONSE, request_id, header, body, key)
+            if body:
+                persist(file_name, body, os.path.join('pred', 'predict'))
+            timer.finish('v2', 'ok')
+        else:
+            await send_frame(writer, write_lock, wire_protocol.ERROR, request_id, {'status': 'inference_failed', 'name': file_name}, key=key)
+            timer.finish('v2', 'inference_failed')
+    except asyncio.CancelledError:
+        # The client went away, see handle_session
+        timer.abandoned()
+        timer.finish('v2', 'abandoned')
+        raise
+    except PhaseTimeout:
+        # A half-written frame cannot be recovered, drop the connection
+        timer.finish('v2', 'send_timeout')
+        writer.transport.abort()
+    finally:
+        metrics.IN_FLIGHT.dec()
+
+def input_geometry():
+    # Advertised in the HELLO reply so clients crop and resize before uploading
+    return {'size': preprocess.INPUT_SIZE, 'mode': PREPROCESS_MODE or 'letterbox', 'quality': UPLOAD_QUALITY}
+
+async def handle_session(reader, writer, trace):
+    write_lock = asyncio.Lock()
+    pending = []
+    orderly = False  # Set when the client says BYE or stops sending requests
+
+    frame_type, _, header_length, body_length = FRAME.unpack(await within('receive', HEADER_TIMEOUT, reader.readexactly(FRAME.size)))
+    wire_protocol.check_header_length(header_length)
+    hello = wire_protocol.decode_header(frame_type, 0, await within('receive', HEADER_TIMEOUT, reader.readexactly(header_length)))
+    await within('receive', HEADER_TIMEOUT, discard(reader, body_length))
+    if frame_type != wire_protocol.HELLO:
+        return
+    server_hello = {'version': wire_protocol.PROTOCOL_VERSION, 'input': input_geometry()}
+    key = None
+    if hello.get('encryption') == stream_crypto.CIPHER and SESSION_KEY:
+        key = SESSION_KEY
+        server_hello['encryption'] = stream_crypto.CIPHER
+    await send_frame(writer, write_lock, wire_protocol.HELLO, 0, server_hello)
+    # Devices name themselves so they keep their fair share and rate limit across addresses
+    client = str(hello.get('device') or writer.get_extra_info('peername')[0])
+    trace.event('session', client_version=hello.get('version'), encryption=key is not None, device=client)
+
+    try:
+        while True:
+            try:
+                frame = await within('idle', SESSION_IDLE_TIMEOUT, reader.readexactly(FRAME.size))
+            except asyncio.IncompleteReadError:
+                break
+            except PhaseTimeout:
+                trace.event('timeout', phase='idle')
+                orderly = True
+                break
+            frame_type, request_id, header_length, body_length = FRAME.unpack(frame)
+            wire_protocol.check_header_length(header_length)
+            header_bytes = await within('receive', HEADER_TIMEOUT, reader.readexactly(header_length))
+            try:
+                header = wire_protocol.decode_header(frame_type, request_id, header_bytes, key)
+            except ValueError as e:
+                # A header that does not decrypt cannot be trusted, nor anything after it
+                trace.error('rejected', error=str(e))
+                orderly = True
+                break
+            if frame_type == wire_protocol.BYE:
+                orderly = True
+                break
+            if frame_type != wire_protocol.REQUEST:
+                await within('receive', RECEIVE_TIMEOUT, discard(reader, body_length))
+                await send_frame(writer, write_lock, wire_protocol.ERROR, request_id, {'status': 'bad_frame'}, key=key)
+                continue
+
+            file_name = os.path.basename(header.get('name', f'{request_id}.jpg'))
+            # The deadline budget counts from when the request header arrived
+            deadline = time.monotonic() + header['deadline_ms'] / 1000.0 if header.get('deadline_ms') else None
+            request_trace = tracer.trace('receive', connection=trace.id, request=request_id, name=file_name, size=body_length)
+            timer = metrics.RequestTimer(request_trace)
+            timer.priority = header.get('priority') if header.get('priority') in PRIORITIES else DEFAULT_PRIORITY
+            try:
+                data = await receive_upload(reader, body_length, timer, client, key, wire_protocol.frame_aad(frame_type, request_id))
+            except ServerBusy as e:
+                await send_frame(writer, write_lock, wire_protocol.ERROR, request_id, dict(e.args[0], name=file_name), key=key)
+                timer.finish('v2', e.args[0]['status'])
+                continue
+            except ValueError as e:
+                # The stream was tampered with or corrupted, it cannot be trusted past this point
+                request_trace.error('rejected', error=str(e))
+                await send_frame(writer, write_lock, wire_protocol.ERROR, request_id, {'status': 'bad_encryption', 'name': file_name}, key=key)
+                timer.finish('v2', 'bad_encryption')
+                orderly = True
+                break
+            labels_only = bool(header.get('labels_only'))
+            timings = bool(header.get('timings'))
+            pending.append(asyncio.ensure_future(handle_request(writer, write_lock, request_id, file_name, data, timer,
+                                                                client, labels_only, key, timings, deadline)))
+            pending = [task for task in pending if not task.done()]
+    finally:
+        # Answer everything that was accepted before closing, unless the
+        # client disconnected or stalled and nobody would read the answers
+        if not orderly:
+            for task in pending:
+                task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+
+async def handle_metrics(reader, writer):
+    head = metrics.HTTP_PREFIX + await reader.readuntil(b'\r\n\r\n')
+    writer.write(metrics.http_response(head))
+    await drain(writer)
+
+async def handle_client(reader, writer):
+    trace = tracer.trace('connect', peer=writer.get_extra_info('peername'))
+    try:
+        # v2 clients open with MAGIC, legacy clients with the file name length,
+        # and `GET /metrics` scrapes the Prometheus metrics
+        prefix = await within('receive', HEADER_TIMEOUT, reader.readexactly(4))
+        if prefix == MAGIC:
+            await handle_session(reader, writer, trace)
+        elif prefix == metrics.HTTP_PREFIX:
+            await handle_metrics(reader, writer)
+        else:
+            await handle_legacy(reader, writer, struct.unpack('!I', prefix)[0], trace)
+    except transfer.PayloadTooLarge as e:
+        trace.error('rejected', error=str(e))
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+        pass
+    except PhaseTimeout as e:
+        trace.error('timeout', phase=e.args[0])
+    except Exception as e:
+        trace.error('error', error=str(e))
+    finally:
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except Exception:
+            pass
+        trace.event('close')
+
+async def report_stats():
+    while True:
+        await asyncio.sleep(BATCH_STATS_INTERVAL)
+        stats = batcher.stats.snapshot()
+        stats.update(queue_depth=batcher.depth(), queued_bytes=batcher.queued_bytes, rejected=batcher.rejected)
+        print(f'Batch stats: {json.dumps(stats)}')
+        print(f'Cache stats: {json.dumps(result_cache.stats())}')
+        print(f'Trace stats: {json.dumps({"written": tracer.written, "dropped": tracer.dropped})}')
+
+def load_archived(file_path):
+    # Decoded model input and transform of an archived photo, None if it cannot be read
+    try:
+        with open(file_path, 'rb') as f:
+            data = f.read()
+    except OSError:
+        return None, None
+    if PREPROCESS_MODE is None:
+        return data, None
+    return preprocess.preprocess(data, preprocess.INPUT_SIZE, PREPROCESS_MODE)
+
+def load_index(index_path, model_version):
+    # Files the index already has for this model; a line cut short by an
+    # interruption is skipped and its file analyzed again
+    done = set()
+    if not os.path.exists(index_path):
+        return done
+    with open(index_path) as f:
+        for line in f:
+            try:
+                row = json.loads(line)
+            except ValueError:
+                continue
+            if row.get('model') == model_version and row.get('status') != 'inference_failed':
+                done.add(row['file'])
+    return done
+
+def reanalysis_row(name, result, transform):
+    row = {'file': name, 'model': yolo_client.model_version}
+    if not (result and result.get('ok')):
+        row['status'] = 'inference_failed'
+        return row
+    boxes = result.get('boxes', [])
+    if transform:
+        boxes = preprocess.unmap_boxes(boxes, transform)
+    row.update(status='ok', objects=labels_to_objects(result['labels']), detections=detection_payload(boxes))
+    return row
+
+def reanalyze(directory, index_path):
+    # Runs every photo in directory through the current model, without the
+    # network listener. Photos are decoded on PREPROCESS_WORKERS threads a
+    # few batches ahead of the model, and each batch's detections are
+    # appended to the index and synced before the next one, so a rerun
+    # after an interruption resumes after the last finished batch.
+    names = sorted(name for name in os.listdir(directory)
+                   if name.lower().endswith(IMAGE_EXTENSIONS) and os.path.isfile(os.path.join(directory, name)))
+    done = load_index(index_path, yolo_client.model_version)
+    todo = [name for name in names if name not in done]
+    batch_size = min(REANALYZE_BATCH_SIZE, yolo_client.max_batch or REANALYZE_BATCH_SIZE)
+    print(f'Reanalyzing {len(todo)} of {len(names)} images in {directory} with model {yolo_client.model_version} '
+          f'in batches of {batch_size}, {len(names) - len(todo)} already in {index_path}')
+
+    decoding = deque()
+    pending = iter(todo)
+
+    def prefetch():
+        while len(decoding) < REANALYZE_PREFETCH * batch_size:
+            name = next(pending, None)
+            if name is None:
+                return
+            decoding.append((name, preprocess_executor.submit(load_archived, os.path.join(directory, name))))
+
+    started = time.monotonic()
+    reported = started
+    analyzed = 0
+    verified = False  # Set once a batch came back with detections
+    with open(index_path, 'ab+') as index:
+        # A line cut short by an interruption must not swallow the next one
+        if index.seek(0, os.SEEK_END):
+            index.seek(-1, os.SEEK_END)
+            if index.read(1) != b'\n':
+                index.write(b'\n')
+        prefetch()
+        while decoding:
+            rows = []
+            batch = []
+            while decoding and len(batch) < batch_size:
+                name, future = decoding.popleft()
+                image, transform = future.result()
+                if image is None:
+                    rows.append({'file': name, 'model': yolo_client.model_version, 'status': 'unreadable'})
+                else:
+                    batch.append((name, image, transform))
+            # Keep the decoders busy while the model runs
+            prefetch()
+            if batch:
+                try:
+                    results = yolo_client.predict_bytes([(name, image, False) for name, image, _ in batch])
+                except Exception as e:
+                    print(f'An error occurred while running a batch: {e}')
+                    results = [None] * len(batch)
+                if not verified and not any(result and result.get('ok') for result in results):
+                    # A model that cannot run at all would mark the whole archive as failed
+                    raise SystemExit('The first batch failed, stopping without recording it')
+                verified = True
+                for (name, _, transform), result in zip(batch, results):
+                    rows.append(reanalysis_row(name, result, transform))
+            index.write(''.join(json.dumps(row) + '\n' for row in rows).encode('utf-8'))
+            index.flush()
+            os.fsync(index.fileno())
+            analyzed += len(rows)
+            now = time.monotonic()
+            if now - reported >= REANALYZE_REPORT_INTERVAL or not decoding:
+                reported = now
+                print(f'Reanalyzed {analyzed}/{len(todo)} images, {analyzed / (now - started):.1f} images/s')
+
+async def serve():
+    workers = [asyncio.ensure_future(batcher.run(inference_worker, expire_requests)) for _ in range(INFERENCE_CONCURRENCY)]
+    workers.append(asyncio.ensure_future(report_stats()))
+    metrics.QUEUE_DEPTH.set_function(batcher.depth)
+    metrics.QUEUED_BYTES.set_function(lambda: batcher.queued_bytes)
+    metrics.ACTIVE_CLIENTS.set_function(batcher.fair.active_clients)
+    server = await asyncio.start_server(handle_client, HOST, PORT)
+    print(f'Server is listening on {server.sockets[0].getsockname()}')
+    try:
+        while True:
+            await asyncio.sleep(3600)
+    finally:
+        server.close()
+        for worker in workers:
+            worker.cancel()
+
+def load_key():
+    global SESSION_KEY
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), KEY_FILE)
+    SESSION_KEY = stream_crypto.load_key(path)
+    if SESSION_KEY is None:
+        print(f'No key file at {path}, v2 sessions will not be encrypted')
+
+def main():
+    global yolo_client, result_cache, tracer, rate_limiter, batcher, preprocess_executor
+    parser = argparse.ArgumentParser(description='Asyncio edge inference server')
+    parser.add_argument('--backend', choices=BACKENDS, default=INFERENCE_BACKEND, help='Inference backend')
+    parser.add_argument('--model', help='Model path relative to the directory above SAVE_DIRECTORY, instead of a built artifact')
+    parser.add_argument('--reanalyze', nargs='?', const=SAVE_DIRECTORY, metavar='DIRECTORY',
+                        help='Run every image in DIRECTORY (default SAVE_DIRECTORY) through the model and exit, without serving')
+    parser.add_argument('--index', help=f'Detections file for --reanalyze, default {REANALYZE_INDEX} in its directory')
+    args = parser.parse_args()
+
+    # Built here rather than at import, so constants overridden before main()
+    # runs (fake_docker.py --set) take effect
+    batcher = AsyncMicroBatcher(BATCH_MAX_SIZE, BATCH_MAX_WAIT_MS / 1000.0, QUEUE_MAX_ITEMS, QUEUE_MAX_BYTES)
+    preprocess_executor = ThreadPoolExecutor(max_workers=PREPROCESS_WORKERS)
+    needs_container = args.backend in CONTAINER_BACKENDS
+    if needs_container:
+        start_docker_container()
+    model_path = args.model or MODEL_PATH
+    if BUILD_ARTIFACTS and not args.model:
+        container = DOCKER_CONTAINER_NAME if needs_container else None
+        model_path = build_model.artifact_for_backend(args.backend, SAVE_DIRECTORY, MODEL_WEIGHTS, preprocess.INPUT_SIZE,
+                                                      MODEL_PRECISION, container) or MODEL_PATH
+    yolo_client = create_backend(args.backend, DOCKER_CONTAINER_NAME, model_path)
+    yolo_client.start()
+    warm_up(yolo_client, WARMUP_INFERENCES, preprocess.INPUT_SIZE)
+    if args.reanalyze:
+        try:
+            reanalyze(args.reanalyze, args.index or os.path.join(args.reanalyze, REANALYZE_INDEX))
+        except KeyboardInterrupt:
+            print('Reanalysis interrupted, run it again to resume.')
+        finally:
+            yolo_client.stop()
+            if yolo_client.NEEDS_CONTAINER:
+                stop_docker_container()
+        return
+    load_key()
+    disk_writer.start()
+    tracer = tracing.Tracer(TRACE_FILE and os.path.join(SAVE_DIRECTORY, TRACE_FILE), TRACE_SAMPLE_RATE, TRACE_MAX_PENDING)
+    tracer.start()
+    metrics.TRACE_DROPPED.set_function(lambda: tracer.dropped)
+    result_cache = ResultCache(CACHE_MAX_BYTES, CACHE_DIRECTORY, CACHE_MAX_DISK_BYTES)
+    rate_limiter = RateLimiter(RATE_LIMIT, DEVICE_RATE_LIMITS)
+
+    loop = asyncio.get_event_loop()
+    main_task = asyncio.ensure_future(serve())
+    try:
+        loop.run_until_complete(main_task)
+    except KeyboardInterrupt:
+        print('Shutting down server...')
+        main_task.cancel()
+        try:
+            loop.run_until_complete(main_task)
+        except asyncio.CancelledError:
+            pass
+    finally:
+        yolo_client.stop()
+        if yolo_client.NEEDS_CONTAINER:
+            stop_docker_container()
+        loop.close()
+
+if __name__ == "__main__":
+    main()
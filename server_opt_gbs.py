@@ -4,14 +4,23 @@ import os
 import socket
 import struct
 
+SAVE_DIRECTORY = r'/home/jetson/edge_server/images'
+DOCKER_IMAGE = 'ultralytics/ultralytics:latest-jetson-jetpack4'
+WEIGHTS_PATH = '/workspace/best_v8n.pt'
+MAX_CONCURRENCY = 1  # Raise only if the GPU has headroom for parallel docker exec calls
+HOST = '0.0.0.0'
+PORT = 12345
+
 class DockerInferenceManager:
-    def __init__(self, save_directory, docker_image, weights_path):
+    def __init__(self, save_directory, docker_image, weights_path, max_concurrency=1):
         self.save_directory = save_directory
         self.docker_image = docker_image
         self.weights_path = weights_path
+        self.max_concurrency = max_concurrency  # docker exec calls allowed at once
         self.queue = asyncio.Queue()
         self.container_id = None
         self.is_running = False
+        self.consumers = []
 
     async def start(self):
         command = [
@@ -27,10 +36,24 @@ class DockerInferenceManager:
         print(f"Started persistent container with ID: {self.container_id}")
 
         self.is_running = True
+        self.consumers = [asyncio.ensure_future(self.consume()) for _ in range(self.max_concurrency)]
+
+    async def consume(self):
+        # Each submitted image is inferred exactly once, by one of max_concurrency consumers
         while self.is_running:
-            image_path = await self.queue.get()
-            await self.process_image(image_path)
-            self.queue.task_done()
+            image_path, future = await self.queue.get()
+            try:
+                # Skip images whose client has already given up
+                if future.cancelled():
+                    continue
+                result = await self.process_image(image_path)
+                if not future.done():
+                    future.set_result(result)
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            finally:
+                self.queue.task_done()
 
     async def process_image(self, image_path):
         print(f'Running YOLOv8 inference on {image_path}...')
@@ -55,9 +78,10 @@ class DockerInferenceManager:
                 return None
             else:
                 print('Inference completed successfully.')
-                predicted_path = f'/workspace/pred/predict/{os.path.basename(image_path)}'
+                # /workspace/pred/predict in the container is save_directory/pred/predict on the host
+                predicted_path = os.path.join(self.save_directory, 'pred/predict', os.path.basename(image_path))
                 print(f"Predicted image path: {predicted_path}")
-                if os.path.exists(os.path.join(self.save_directory, 'pred/predict', os.path.basename(image_path))):
+                if os.path.exists(predicted_path):
                     print("Predicted image file exists on host system")
                 else:
                     print("Predicted image file does not exist on host system")
@@ -66,11 +90,15 @@ class DockerInferenceManager:
             print(f'Error running YOLOv8 inference: {e}')
         return None
 
-    async def add_image(self, image_path):
-        await self.queue.put(image_path)
+    async def submit(self, image_path):
+        future = asyncio.get_event_loop().create_future()
+        await self.queue.put((image_path, future))
+        return future
 
     async def stop(self):
         self.is_running = False
+        for consumer in self.consumers:
+            consumer.cancel()
         if self.container_id:
             command = ['sudo', 'docker', 'stop', self.container_id]
             process = await asyncio.create_subprocess_exec(*command)
@@ -97,13 +125,18 @@ async def send_file(writer, file_path):
     
     bytes_sent = 0
     with open(file_path, 'rb') as f:
-        while True:
-            chunk = f.read(4096)
-            if not chunk:
-                break
-            writer.write(chunk)
-            await writer.drain()
-            bytes_sent += len(chunk)
+        loop = asyncio.get_event_loop()
+        if hasattr(loop, 'sendfile'):
+            # Python 3.7+: kernel sendfile(2) straight from the page cache
+            bytes_sent = await loop.sendfile(writer.transport, f)
+        else:
+            while True:
+                chunk = f.read(65536)
+                if not chunk:
+                    break
+                writer.write(chunk)
+                await writer.drain()
+                bytes_sent += len(chunk)
     print(f'Sent file: {file_name}, total bytes sent: {bytes_sent}')
 
 async def receive_file(reader, save_directory):
@@ -140,8 +173,7 @@ async def handle_client(reader, writer, inference_manager):
         print(f"Received file: {file_path}")
 
         if file_path:
-            await inference_manager.add_image(file_path)
-            predicted_image_path = await inference_manager.process_image(file_path)
+            predicted_image_path = await (await inference_manager.submit(file_path))
             print(f"Predicted image path: {predicted_image_path}")
 
             if predicted_image_path and os.path.exists(predicted_image_path):
@@ -166,16 +198,12 @@ async def handle_client(reader, writer, inference_manager):
         await writer.wait_closed()
 
 async def main():
-    save_directory = r'/home/jetson/edge_server/images'
-    docker_image = 'ultralytics/ultralytics:latest-jetson-jetpack4'
-    weights_path = '/workspace/best_v8n.pt'
-
-    inference_manager = DockerInferenceManager(save_directory, docker_image, weights_path)
-    inference_task = asyncio.ensure_future(inference_manager.start())
+    inference_manager = DockerInferenceManager(SAVE_DIRECTORY, DOCKER_IMAGE, WEIGHTS_PATH, MAX_CONCURRENCY)
+    await inference_manager.start()
 
     server = await asyncio.start_server(
         lambda r, w: handle_client(r, w, inference_manager),
-        '0.0.0.0', 12345)
+        HOST, PORT)
 
     addr = server.sockets[0].getsockname()
     print(f'Serving on {addr}')
@@ -186,7 +214,6 @@ async def main():
     except asyncio.CancelledError:
         pass
     finally:
-        inference_task.cancel()
         await inference_manager.stop()
         server.close()
         await server.wait_closed()
@@ -1,5 +1,5 @@
 #!/bin/bash
 echo "jetson" | sudo -S su
 cd edge_server
-sudo python3 server_opt3.py &
+sudo python3 server_opt6.py &
 python3 show_ip.py
\ No newline at end of file
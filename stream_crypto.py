@@ -0,0 +1,90 @@
+import os
+import struct
+from Crypto.Cipher import AES
+from Crypto.Random import get_random_bytes
+
+# Chunked AES-GCM for frame headers and bodies, so neither side has to hold
+# a padded copy of the whole payload and each chunk can go out while the next
+# one is being encrypted.
+#
+# An encrypted body is an 8 byte random nonce prefix followed by chunks of
+# up to CHUNK_SIZE plaintext bytes, each encrypted under nonce = prefix +
+# !I chunk index and followed by its 16 byte tag. Every chunk authenticates
+# the caller's associated data plus a final-chunk flag, so chunks cannot be
+# reordered, moved to another frame, or cut off at a chunk boundary.
+
+CIPHER = 'aes-gcm-headers'  # Frame headers as well as bodies; plain 'aes-gcm' left the headers in the clear
+CHUNK_SIZE = 64 * 1024
+NONCE_PREFIX_SIZE = 8
+TAG_SIZE = 16
+KEY_FILE = 'edge.key'  # The key a server and its clients share, see load_key
+
+
+def load_key(path):
+    # The AES key as hex in a file kept out of the source, e.g. written with
+    #   python3 -c "import os; print(os.urandom(16).hex())" > edge.key
+    # and copied to the server and every client. None when there is no file.
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        try:
+            key = bytes.fromhex(f.read().strip())
+        except ValueError:
+            raise ValueError(f'{path} does not hold a hex key')
+    if len(key) not in (16, 24, 32):
+        raise ValueError(f'{path} holds a {len(key)} byte key, AES takes 16, 24 or 32')
+    return key
+
+
+def encrypted_size(size):
+    chunks = max(1, -(-size // CHUNK_SIZE))
+    return NONCE_PREFIX_SIZE + size + chunks * TAG_SIZE
+
+
+def _cipher(key, prefix, index, associated_data, final):
+    cipher = AES.new(key, AES.MODE_GCM, nonce=prefix + struct.pack('!I', index), mac_len=TAG_SIZE)
+    cipher.update(associated_data + (b'\x01' if final else b'\x00'))
+    return cipher
+
+
+def encrypt_chunks(key, data, associated_data=b''):
+    # Yields the nonce prefix, then ciphertext + tag for each chunk
+    prefix = get_random_bytes(NONCE_PREFIX_SIZE)
+    yield prefix
+    view = memoryview(data)
+    chunks = max(1, -(-len(view) // CHUNK_SIZE))
+    for index in range(chunks):
+        cipher = _cipher(key, prefix, index, associated_data, index == chunks - 1)
+        ciphertext, tag = cipher.encrypt_and_digest(view[index * CHUNK_SIZE:(index + 1) * CHUNK_SIZE])
+        yield ciphertext + tag
+
+
+def chunk_sizes(size):
+    # Sizes of the encrypted chunks that follow the nonce prefix in a body of size bytes
+    remaining = size - NONCE_PREFIX_SIZE
+    if remaining < TAG_SIZE:
+        raise ValueError('Encrypted body is too short')
+    sizes = []
+    while remaining > 0:
+        chunk_size = min(CHUNK_SIZE + TAG_SIZE, remaining)
+        if chunk_size < TAG_SIZE:
+            raise ValueError('Encrypted body has a truncated chunk')
+        sizes.append(chunk_size)
+        remaining -= chunk_size
+    return sizes
+
+
+def decrypt_chunk(key, prefix, index, chunk, final, associated_data=b''):
+    # Raises ValueError if the chunk was modified, reordered or truncated
+    cipher = _cipher(key, prefix, index, associated_data, final)
+    return cipher.decrypt_and_verify(chunk[:-TAG_SIZE], chunk[-TAG_SIZE:])
+
+
+def decrypt(key, read_exact, size, associated_data=b''):
+    # Reads and decrypts a body of size bytes using read_exact(n)
+    sizes = chunk_sizes(size)
+    prefix = read_exact(NONCE_PREFIX_SIZE)
+    data = bytearray()
+    for index, chunk_size in enumerate(sizes):
+        data += decrypt_chunk(key, prefix, index, read_exact(chunk_size), index == len(sizes) - 1, associated_data)
+    return bytes(data)
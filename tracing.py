@@ -0,0 +1,117 @@
+import itertools
+import json
+import os
+import queue
+import random
+import sys
+import threading
+import time
+
+# Structured request tracing. Each connection and request gets a Trace with
+# its own id; its events are JSON lines such as
+#
+#   {"ts": 1700000000.123456, "trace": 42, "event": "receive", "name": "a.jpg", "size": 51234}
+#
+# Events are put on a bounded queue and serialised and written by a
+# background thread, so a slow disk or terminal never stalls the request
+# path: when the queue is full the event is dropped and counted instead.
+# Only sample_rate of the traces record their events; errors are always
+# recorded.
+
+DEFAULT_MAX_PENDING = 4096
+DEFAULT_MAX_BYTES = 16 * 1024 * 1024  # The trace file is rotated to <path>.1 beyond this
+WRITE_BATCH = 256  # Events written per flush at most
+
+
+class Trace:
+    __slots__ = ('tracer', 'id', 'sampled')
+
+    def __init__(self, tracer, trace_id, sampled):
+        self.tracer = tracer
+        self.id = trace_id
+        self.sampled = sampled
+
+    def event(self, event, **fields):
+        if self.sampled:
+            self.tracer.emit(self.id, event, fields)
+
+    def error(self, event, **fields):
+        self.tracer.emit(self.id, event, fields)
+
+
+class Tracer:
+    def __init__(self, path=None, sample_rate=1.0, max_pending=DEFAULT_MAX_PENDING, max_bytes=DEFAULT_MAX_BYTES):
+        # path None writes to stdout
+        self.path = path
+        self.sample_rate = sample_rate
+        self.max_bytes = max_bytes
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.ids = itertools.count(1)
+        self.dropped = 0
+        self.written = 0
+        self.file = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def trace(self, event=None, **fields):
+        # A new trace, optionally opened with an event
+        trace = Trace(self, next(self.ids), self.sample_rate >= 1 or random.random() < self.sample_rate)
+        if event:
+            trace.event(event, **fields)
+        return trace
+
+    def event(self, event, **fields):
+        # An event that belongs to no request, always recorded
+        self.emit(None, event, fields)
+
+    def emit(self, trace_id, event, fields):
+        try:
+            self.queue.put_nowait((time.time(), trace_id, event, fields))
+        except queue.Full:
+            self.dropped += 1
+
+    def open(self):
+        if self.path is None:
+            return sys.stdout
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        return open(self.path, 'a')
+
+    def rotate(self):
+        if self.path is None or self.file.tell() < self.max_bytes:
+            return
+        self.file.close()
+        os.replace(self.path, self.path + '.1')
+        self.file = self.open()
+
+    def run(self):
+        self.file = self.open()
+        while True:
+            events = [self.queue.get()]
+            while len(events) < WRITE_BATCH:
+                try:
+                    events.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            lines = []
+            for timestamp, trace_id, event, fields in events:
+                record = {'ts': round(timestamp, 6), 'trace': trace_id, 'event': event}
+                record.update(fields)
+                lines.append(json.dumps(record, default=str))
+            try:
+                self.file.write('\n'.join(lines) + '\n')
+                self.file.flush()
+                self.written += len(lines)
+                self.rotate()
+            except OSError as e:
+                self.dropped += len(lines)
+                print(f'Error writing trace events: {e}')
+            finally:
+                for _ in events:
+                    self.queue.task_done()
+
+    def flush(self):
+        self.queue.join()
@@ -0,0 +1,116 @@
+import os
+import socket
+import struct
+import threading
+
+# Payload transfer for the blocking socket servers and clients. On-disk files
+# go out with socket.sendfile(), which uses the kernel's sendfile(2) instead
+# of reading the file into Python, and incoming payloads are read with
+# recv_into() into preallocated buffers rather than one new bytes object per
+# recv() call.
+#
+# Legacy framing: !I name length, name, !Q payload size, payload.
+
+MAX_PAYLOAD_SIZE = 64 * 1024 * 1024  # Larger announced payloads are refused before reading them
+MAX_NAME_LENGTH = 4096  # Longer announced file names are refused the same way
+RECV_BUFFER_SIZE = 256 * 1024  # Per-thread staging buffer when streaming a payload to disk
+
+_buffers = threading.local()
+
+
+class PayloadTooLarge(ConnectionError):
+    pass
+
+
+def _recv_buffer():
+    # One reusable buffer per thread, so concurrent handlers never share it
+    view = getattr(_buffers, 'view', None)
+    if view is None:
+        view = _buffers.view = memoryview(bytearray(RECV_BUFFER_SIZE))
+    return view
+
+
+def recv_into_exact(conn, view):
+    received = 0
+    while received < len(view):
+        count = conn.recv_into(view[received:])
+        if not count:
+            raise ConnectionError("Connection closed while receiving data")
+        received += count
+
+
+def recv_exact(conn, size):
+    data = bytearray(size)
+    recv_into_exact(conn, memoryview(data))
+    return data
+
+
+def check_name_length(name_length):
+    # Before anything is allocated for it: the length comes from the client
+    if name_length > MAX_NAME_LENGTH:
+        raise PayloadTooLarge(f"File name of {name_length} bytes exceeds the limit of {MAX_NAME_LENGTH} bytes")
+
+
+def recv_header(conn, name_length=None, max_size=MAX_PAYLOAD_SIZE):
+    # Returns (file name, payload size); the name is reduced to its basename
+    if name_length is None:
+        name_length = struct.unpack('!I', recv_exact(conn, 4))[0]
+    check_name_length(name_length)
+    file_name = recv_exact(conn, name_length).decode('utf-8')
+    file_size = struct.unpack('!Q', recv_exact(conn, 8))[0]
+    if file_size > max_size:
+        raise PayloadTooLarge(f"Payload of {file_size} bytes exceeds the limit of {max_size} bytes")
+    return os.path.basename(file_name), file_size
+
+
+def send_header(conn, file_name, file_size):
+    name_bytes = file_name.encode('utf-8')
+    conn.sendall(struct.pack('!I', len(name_bytes)) + name_bytes + struct.pack('!Q', file_size))
+
+
+def send_file(conn, file_path):
+    with open(file_path, 'rb') as f:
+        file_size = os.fstat(f.fileno()).st_size
+        send_header(conn, os.path.basename(file_path), file_size)
+        conn.sendfile(f)
+    return file_size
+
+
+def peer_closed(conn):
+    # True when the peer has closed or reset the connection. Only meaningful
+    # while the peer is waiting for an answer and sends nothing, as legacy
+    # clients do after their upload.
+    timeout = conn.gettimeout()
+    conn.setblocking(False)
+    try:
+        return conn.recv(1, socket.MSG_PEEK) == b''
+    except BlockingIOError:
+        return False
+    except OSError:
+        return True
+    finally:
+        conn.settimeout(timeout)
+
+
+def receive_bytes(conn, file_size):
+    # Reads a payload straight into a buffer of its final size
+    return recv_exact(conn, file_size)
+
+
+def receive_to_file(conn, file_path, file_size):
+    view = _recv_buffer()
+    with open(file_path, 'wb') as f:
+        remaining = file_size
+        while remaining > 0:
+            count = conn.recv_into(view[:min(remaining, len(view))])
+            if not count:
+                raise ConnectionError("Connection closed while receiving file")
+            f.write(view[:count])
+            remaining -= count
+
+
+def receive_file(conn, save_directory, name_length=None, max_size=MAX_PAYLOAD_SIZE):
+    file_name, file_size = recv_header(conn, name_length, max_size)
+    file_path = os.path.join(save_directory, file_name)
+    receive_to_file(conn, file_path, file_size)
+    return file_path
@@ -0,0 +1,109 @@
+import io
+import struct
+import json
+import stream_crypto
+import transfer
+from transfer import recv_exact
+
+# Version 2 of the edge server protocol: one connection carries many
+# requests, each tagged with a request id, and responses may arrive in any
+# order.
+#
+# A v2 connection starts with MAGIC, followed by a HELLO frame in each
+# direction. Every frame is !BIIQ (frame type, request id, header length,
+# body length) + JSON header + body.
+#
+# Legacy one-shot clients start with a !I file name length instead. MAGIC read
+# as !I is far larger than any file name, so the server can tell them apart
+# from the first four bytes.
+#
+# A client may ask for encryption by putting 'encryption': CIPHER in its
+# HELLO. If the server's HELLO echoes it, the header and body of every later
+# frame in both directions are each chunked AES-GCM (see stream_crypto),
+# bound to the frame type and request id and to which of the two they are.
+# The header length in the frame then counts the encrypted header.
+#
+# A REQUEST header may name a scheduling class, 'priority' (one of
+# micro_batcher.PRIORITIES, 'normal' when absent), and a latency budget,
+# 'deadline_ms', counted from when the server starts receiving the request.
+# A request still queued when its budget runs out is not run; it is
+# answered with an ERROR frame whose status is 'deadline_exceeded'.
+
+MAGIC = b'PA3M'
+PROTOCOL_VERSION = 2
+FRAME = struct.Struct('!BIIQ')
+MAX_HEADER_SIZE = 64 * 1024  # Larger announced frame headers are refused before reading them
+
+HELLO = 1
+REQUEST = 2
+RESPONSE = 3
+ERROR = 4
+BYE = 5
+
+
+def frame_aad(frame_type, request_id):
+    return struct.pack('!BI', frame_type, request_id)
+
+
+def header_aad(frame_type, request_id):
+    # One byte longer than the body's, so a header cannot pass for a body
+    return frame_aad(frame_type, request_id) + b'H'
+
+
+def encode_header(frame_type, request_id, header, key=None):
+    header_bytes = json.dumps(header).encode('utf-8')
+    if key:
+        header_bytes = b''.join(stream_crypto.encrypt_chunks(key, header_bytes, header_aad(frame_type, request_id)))
+    return header_bytes
+
+
+def decode_header(frame_type, request_id, header_bytes, key=None):
+    # Raises ValueError if an encrypted header was modified or moved to another frame
+    if not header_bytes:
+        return {}
+    if key:
+        header_bytes = stream_crypto.decrypt(key, io.BytesIO(header_bytes).read, len(header_bytes), header_aad(frame_type, request_id))
+    return json.loads(header_bytes.decode('utf-8'))
+
+
+def check_header_length(header_length):
+    if header_length > MAX_HEADER_SIZE:
+        raise transfer.PayloadTooLarge(f"Frame header of {header_length} bytes exceeds the limit of {MAX_HEADER_SIZE} bytes")
+
+
+def send_frame(conn, frame_type, request_id, header, body=b'', key=None):
+    # Returns the bytes sent
+    header_bytes = encode_header(frame_type, request_id, header, key)
+    body_length = stream_crypto.encrypted_size(len(body)) if key and body else len(body)
+    conn.sendall(FRAME.pack(frame_type, request_id, len(header_bytes), body_length) + header_bytes)
+    if body and key:
+        # Each chunk is sent while the next one is encrypted
+        for chunk in stream_crypto.encrypt_chunks(key, body, frame_aad(frame_type, request_id)):
+            conn.sendall(chunk)
+    elif body:
+        conn.sendall(body)
+    return FRAME.size + len(header_bytes) + body_length
+
+
+def recv_frame(conn, key=None):
+    frame_type, request_id, header_length, body_length = FRAME.unpack(recv_exact(conn, FRAME.size))
+    if body_length > transfer.MAX_PAYLOAD_SIZE:
+        raise transfer.PayloadTooLarge(f"Frame body of {body_length} bytes exceeds the limit of {transfer.MAX_PAYLOAD_SIZE} bytes")
+    check_header_length(header_length)
+    header = decode_header(frame_type, request_id, recv_exact(conn, header_length), key) if header_length else {}
+    if body_length and key:
+        body = stream_crypto.decrypt(key, lambda size: recv_exact(conn, size), body_length, frame_aad(frame_type, request_id))
+    else:
+        body = recv_exact(conn, body_length) if body_length else b''
+    return frame_type, request_id, header, body
+
+
+def client_hello(conn, header=None):
+    hello = {'version': PROTOCOL_VERSION}
+    hello.update(header or {})
+    conn.sendall(MAGIC)
+    send_frame(conn, HELLO, 0, hello)
+    frame_type, _, server_hello, _ = recv_frame(conn)
+    if frame_type != HELLO:
+        raise ConnectionError(f"Expected HELLO from server, got frame type {frame_type}")
+    return server_hello
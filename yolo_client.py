@@ -0,0 +1,149 @@
+import os
+import subprocess
+import threading
+import struct
+import json
+
+# Host side of yolo_worker.py: keeps one worker process running inside the
+# inference container and sends it predict requests over stdin/stdout.
+
+FRAME_HEADER = struct.Struct('!II')
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'yolo_worker.py')
+CONTAINER_WORKER_PATH = '/ultralytics/yolo_worker.py'
+
+
+class YoloWorkerError(Exception):
+    pass
+
+
+class InferenceBackend:
+    # Requests in the yolo_worker.py protocol. Subclasses decide where the
+    # worker logic runs by implementing start(), stop() and request().
+    NEEDS_CONTAINER = False
+    model_version = None
+    max_batch = None  # Images per forward pass, None when the model takes any batch
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def request(self, header, payload=b''):
+        raise NotImplementedError
+
+    def predict_batch(self, image_paths):
+        sources = [f'images/{os.path.basename(image_path)}' for image_path in image_paths]
+        header, _ = self.request({'op': 'predict', 'sources': sources, 'project': 'images/pred'})
+        if not header.get('ok'):
+            raise YoloWorkerError(header.get('error', 'Inference failed'))
+        return header['results']
+
+    def predict(self, image_path):
+        result = self.predict_batch([image_path])[0]
+        if not result.get('ok'):
+            raise YoloWorkerError(result.get('error', 'Inference failed'))
+        return result
+
+    def predict_bytes(self, images):
+        # images are (name, data) or (name, data, render) tuples, where data is
+        # either encoded image bytes or a decoded uint8 BGR array
+        items = []
+        blobs = []
+        for image in images:
+            data = image[1]
+            item = {'name': image[0], 'render': image[2] if len(image) > 2 else True}
+            if hasattr(data, 'shape'):
+                item['shape'] = list(data.shape)
+                data = data.tobytes()
+            item['size'] = len(data)
+            items.append(item)
+            blobs.append(data)
+        header, payload = self.request({'op': 'predict_bytes', 'images': items}, b''.join(blobs))
+        if not header.get('ok'):
+            raise YoloWorkerError(header.get('error', 'Inference failed'))
+        results = header['results']
+        offset = 0
+        for result in results:
+            result['image'] = payload[offset:offset + result['size']]
+            offset += result['size']
+        return results
+
+
+class YoloClient(InferenceBackend):
+    NEEDS_CONTAINER = True
+
+    def __init__(self, container_name, model_path):
+        self.container_name = container_name
+        self.model_path = model_path
+        self.process = None
+        self.model_version = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        print('Copying YOLOv8 worker into container...')
+        copy_command = ['sudo', 'docker', 'cp', WORKER_SCRIPT, f'{self.container_name}:{CONTAINER_WORKER_PATH}']
+        subprocess.run(copy_command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+
+        print(f'Starting YOLOv8 worker with model {self.model_path}...')
+        command = [
+            'sudo', 'docker', 'exec', '-i', self.container_name,
+            'python3', '-u', CONTAINER_WORKER_PATH,
+            '--model', self.model_path
+        ]
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        header, _ = self._read_message()
+        if not header.get('ready'):
+            raise YoloWorkerError(f'Worker failed to start: {header}')
+        self.model_version = header.get('version')
+        self.max_batch = header.get('max_batch')
+        print('YOLOv8 worker is ready.')
+
+    def stop(self):
+        if self.process is None:
+            return
+        try:
+            self.process.stdin.close()
+            self.process.wait(timeout=10)
+        except (OSError, subprocess.TimeoutExpired):
+            self.process.kill()
+        self.process = None
+
+    def _read_exact(self, size):
+        data = b''
+        while len(data) < size:
+            chunk = self.process.stdout.read(size - len(data))
+            if not chunk:
+                raise YoloWorkerError('Worker closed its output')
+            data += chunk
+        return data
+
+    def _read_message(self):
+        header_length, payload_length = FRAME_HEADER.unpack(self._read_exact(FRAME_HEADER.size))
+        header = json.loads(self._read_exact(header_length).decode('utf-8'))
+        payload = self._read_exact(payload_length) if payload_length else b''
+        return header, payload
+
+    def _write_message(self, header, payload=b''):
+        header_bytes = json.dumps(header).encode('utf-8')
+        self.process.stdin.write(FRAME_HEADER.pack(len(header_bytes), len(payload)))
+        self.process.stdin.write(header_bytes)
+        if payload:
+            self.process.stdin.write(payload)
+        self.process.stdin.flush()
+
+    def request(self, header, payload=b''):
+        with self.lock:
+            # Restart the worker once if it died since the last request
+            for attempt in range(2):
+                try:
+                    if self.process is None or self.process.poll() is not None:
+                        self.stop()
+                        self.start()
+                    self._write_message(header, payload)
+                    return self._read_message()
+                except (OSError, YoloWorkerError) as e:
+                    print(f'YOLOv8 worker request failed: {e}')
+                    self.stop()
+                    if attempt:
+                        raise YoloWorkerError(str(e))
@@ -0,0 +1,195 @@
+import os
+import sys
+import struct
+import json
+import argparse
+import hashlib
+
+# Long-lived YOLOv8 process that runs inside the inference container.
+# The model is loaded once and requests arrive on stdin, framed as
+# !II (header length, payload length) + JSON header + payload.
+# Responses use the same framing on stdout.
+
+FRAME_HEADER = struct.Struct('!II')
+
+
+def read_exact(stream, size):
+    data = b''
+    while len(data) < size:
+        chunk = stream.read(size - len(data))
+        if not chunk:
+            raise EOFError('Input closed')
+        data += chunk
+    return data
+
+
+def read_message(stream):
+    header_length, payload_length = FRAME_HEADER.unpack(read_exact(stream, FRAME_HEADER.size))
+    header = json.loads(read_exact(stream, header_length).decode('utf-8'))
+    payload = read_exact(stream, payload_length) if payload_length else b''
+    return header, payload
+
+
+def write_message(stream, header, payload=b''):
+    header_bytes = json.dumps(header).encode('utf-8')
+    stream.write(FRAME_HEADER.pack(len(header_bytes), len(payload)))
+    stream.write(header_bytes)
+    if payload:
+        stream.write(payload)
+    stream.flush()
+
+
+def box_rows(result):
+    # [class id, confidence, x, y, w, h] per box, straight from the model output
+    boxes = result.boxes
+    return [
+        [int(cls), round(conf, 3)] + [round(v, 4) for v in xywhn]
+        for cls, conf, xywhn in zip(boxes.cls.tolist(), boxes.conf.tolist(), boxes.xywhn.tolist())
+    ]
+
+
+def save_prediction(result, source, project, save_txt=False, save_conf=False):
+    # Same layout as `yolo detect predict project=... exist_ok=True`
+    output_directory = os.path.join(project, 'predict')
+    os.makedirs(output_directory, exist_ok=True)
+
+    file_name = os.path.basename(source)
+    pure_name = os.path.splitext(file_name)[0]
+
+    import cv2
+    cv2.imwrite(os.path.join(output_directory, file_name), result.plot())
+
+    rows = box_rows(result)
+    if save_txt:
+        labels_directory = os.path.join(output_directory, 'labels')
+        os.makedirs(labels_directory, exist_ok=True)
+        with open(os.path.join(labels_directory, pure_name + '.txt'), 'w') as f:
+            for row in rows:
+                values = row[2:] + [row[1]] if save_conf else row[2:]
+                f.write('%d %s\n' % (row[0], ' '.join('%g' % v for v in values)))
+    return pure_name, rows
+
+
+def model_max_batch(model, model_path):
+    # Images one forward pass can take. OnnxModel reads it from its input
+    # shape; TensorRT engines have it in their build_model.py manifest, and
+    # engines exported without one were built for a single image.
+    if hasattr(model, 'max_batch'):
+        return model.max_batch
+    engine = model_path.endswith('.engine')
+    try:
+        with open(model_path + '.json') as f:
+            return json.load(f).get('batch', 1 if engine else None)
+    except (OSError, ValueError):
+        return 1 if engine else None
+
+
+def predict(model, images, max_batch=None):
+    # Batches larger than the model takes run as several forward passes
+    step = max_batch or len(images)
+    predictions = []
+    for start in range(0, len(images), step):
+        predictions.extend(model.predict(images[start:start + step], verbose=False))
+    return predictions
+
+
+def handle_predict(model, header, max_batch=None):
+    import cv2
+    project = header.get('project', 'images/pred')
+    sources = header['sources']
+    images = [cv2.imread(source) for source in sources]
+    loaded = [i for i, image in enumerate(images) if image is not None]
+
+    results = [{'ok': False, 'error': f'Could not read {source}'} for source in sources]
+    # As few forward passes as the model allows for the readable images
+    if loaded:
+        predictions = predict(model, [images[i] for i in loaded], max_batch)
+        for i, prediction in zip(loaded, predictions):
+            pure_name, rows = save_prediction(prediction, sources[i], project, header.get('save_txt', False))
+            results[i] = {'ok': True, 'name': pure_name, 'labels': [row[0] for row in rows], 'boxes': rows}
+    return {'ok': True, 'results': results}
+
+
+def handle_predict_bytes(model, header, payload, max_batch=None):
+    import cv2
+    import numpy as np
+    images = []
+    offset = 0
+    for item in header['images']:
+        data = np.frombuffer(payload, dtype=np.uint8, count=item['size'], offset=offset)
+        if item.get('shape'):
+            # Already decoded and resized by the server, hand it to the model as is
+            images.append(data.reshape(item['shape']))
+        else:
+            images.append(cv2.imdecode(data, cv2.IMREAD_COLOR))
+        offset += item['size']
+    loaded = [i for i, image in enumerate(images) if image is not None]
+
+    results = [{'ok': False, 'error': f"Could not decode {item['name']}", 'size': 0} for item in header['images']]
+    blobs = [b''] * len(images)
+    if loaded:
+        predictions = predict(model, [images[i] for i in loaded], max_batch)
+        for i, prediction in zip(loaded, predictions):
+            # Labels-only requests skip rendering and encoding the annotated image
+            if header['images'][i].get('render', True):
+                ok, encoded = cv2.imencode('.jpg', prediction.plot())
+                blobs[i] = encoded.tobytes() if ok else b''
+            rows = box_rows(prediction)
+            results[i] = {'ok': True, 'labels': [row[0] for row in rows], 'boxes': rows, 'size': len(blobs[i])}
+    return {'ok': True, 'results': results}, b''.join(blobs)
+
+
+def handle_message(model, header, payload=b'', max_batch=None):
+    op = header.get('op')
+    try:
+        if op == 'predict':
+            return handle_predict(model, header, max_batch), b''
+        if op == 'predict_bytes':
+            return handle_predict_bytes(model, header, payload, max_batch)
+        if op == 'ping':
+            return {'ok': True}, b''
+        return {'ok': False, 'error': f'Unknown op: {op}'}, b''
+    except Exception as e:
+        return {'ok': False, 'error': str(e)}, b''
+
+
+def model_version(model_path):
+    digest = hashlib.sha256()
+    with open(model_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()[:16]
+
+
+def serve(model, model_path, stdin, stdout, version=None):
+    version = version or model_version(model_path)
+    max_batch = model_max_batch(model, model_path)
+    write_message(stdout, {'ok': True, 'ready': True, 'model': model_path, 'version': version, 'max_batch': max_batch})
+    while True:
+        try:
+            header, payload = read_message(stdin)
+        except EOFError:
+            break
+
+        response, response_payload = handle_message(model, header, payload, max_batch)
+        write_message(stdout, response, response_payload)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', default='images/best_v8n.engine')
+    args = parser.parse_args()
+
+    # Keep the framed channel on the original stdout and send everything
+    # else (ultralytics logging, prints) to stderr.
+    stdout = os.fdopen(os.dup(sys.stdout.fileno()), 'wb')
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    stdin = sys.stdin.buffer
+
+    from ultralytics import YOLO
+    model = YOLO(args.model, task='detect')
+    serve(model, args.model, stdin, stdout)
+
+
+if __name__ == '__main__':
+    main()